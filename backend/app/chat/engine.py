@@ -2,13 +2,75 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
+import json
+import time
+from datetime import datetime, timedelta
 from click import UUID
-from typing import List
-from llama_index.vector_stores.pinecone import PineconeVectorStore
-from llama_index import VectorStoreIndex
-from llama_index.core.llms.types import ChatMessage
+from typing import List, Optional, Tuple
+from llama_index import ServiceContext, VectorStoreIndex
 from llama_index.chat_engine.types import StreamingAgentChatResponse
-from app.db.models import Channel, ChannelStatusEnum, Chat, ChatResponse, ChatResponseStatusEnum
+from beanie.odm.enums import SortDirection
+from beanie.odm.operators.find.logical import And, Or
+from beanie.operators import Set, SetOnInsert
+from app.db.models import ActiveChatSessionMap, Channel, ChannelStatusEnum, Chat, ChatMessage, ChatResponse, ChatResponseStatusEnum
+from app.db.migrations import migrate_chat
+from app.db.vector_store import get_vector_store
+from app.chat.memory import HistoryWindow, load_history_window, schedule_history_summary_refresh
+from app.chat.retrieval_cache import CachedVectorStoreIndex, get_index_version
+from app.chat.response_cache import (CachedResponseStream,
+                                     CachingResponseStream,
+                                     chat_scope,
+                                     response_cache,
+                                     response_cache_enabled)
+from app.utils.cache import TTLCache
+from app.utils.embedding import get_embed_model
+from app.utils.metrics import CHAT_STAGE_SECONDS, metrics
+
+# Vector stores and indexes keyed by (index name, namespace, chat mode, chat kwargs)
+_chat_index_cache = TTLCache(maxsize=int(os.environ.get('CHAT_INDEX_CACHE_SIZE', 256)),
+                             ttl=float(os.environ.get('CHAT_INDEX_CACHE_TTL', 3600)))
+metrics.register_stats("chat_index_cache", _chat_index_cache.stats)
+
+# Minimum time between two refreshes of a session map's TTL
+ACTIVE_CHAT_SESSION_TOUCH = timedelta(seconds=float(os.environ.get('ACTIVE_CHAT_SESSION_TOUCH_SECONDS', 24*3600)))
+
+def _engine_kwargs(chat: Chat) -> dict:
+    """Return the chat_kwargs of the chat engine, without the keys handled by the history window and the response cache."""
+    return {key: value for key, value in chat.chat_kwargs.items()
+            if key not in HistoryWindow.KEYS and key != 'response_cache'}
+
+def _chat_index_key(chat: Chat) -> Tuple[str, str, str, str]:
+    """Build the cache key of the vector index used by the chat."""
+    return (chat.vector_index_name,
+            chat.vector_namespace,
+            str(chat.chat_mode),
+            json.dumps(_engine_kwargs(chat), sort_keys=True, default=str))
+
+def get_chat_index(chat: Chat) -> VectorStoreIndex:
+    """
+    Return the cached vector index for the chat, building it on a miss.
+
+    Args:
+        chat (Chat): The chat object containing vector index name and namespace.
+
+    Returns:
+        VectorStoreIndex: The vector index backed by the chat's namespace.
+    """
+    key = _chat_index_key(chat)
+    index = _chat_index_cache.get(key)
+    if index is None:
+        with CHAT_STAGE_SECONDS.labels("index_setup").time():
+            # Set up the vector store of the chat's namespace on the configured backend
+            vector_store = get_vector_store(chat.vector_namespace, chat.vector_index_name)
+            index = CachedVectorStoreIndex.from_namespace(vector_store,
+                                                          chat.vector_namespace,
+                                                          service_context=ServiceContext.from_defaults(embed_model=get_embed_model()))
+        _chat_index_cache.set(key, index)
+    return index
+
+def get_chat_index_cache_stats() -> dict:
+    """Return the hit/miss counters of the chat index cache."""
+    return _chat_index_cache.stats()
 
 
 async def create_new_chat(channel_id: str) -> UUID:
@@ -47,15 +109,101 @@ async def create_new_chat(channel_id: str) -> UUID:
         logging.error(f"Failed to create new chat for channel {channel_id}", e)
         raise e
 
-async def get_chat_history(chat_id: str) -> List[ChatResponse]:
+async def set_active_chat(user_session_id: str, channel_id: str, chat_id: str) -> None:
+    """
+    Make a chat the active chat of a session with a channel, with a single atomic upsert.
+
+    Args:
+        user_session_id (str): The ID of the user's session.
+        channel_id (str): The ID of the channel.
+        chat_id (str): The ID of the chat.
+    """
+    now = datetime.now()
+    await ActiveChatSessionMap.find_one(ActiveChatSessionMap.user_session_id == user_session_id,
+                                        ActiveChatSessionMap.channel_id == channel_id
+                                        ).update(Set({ActiveChatSessionMap.active_chat_id: chat_id,
+                                                      ActiveChatSessionMap.updated_at: now}),
+                                                 SetOnInsert({ActiveChatSessionMap.user_session_id: user_session_id,
+                                                              ActiveChatSessionMap.channel_id: channel_id,
+                                                              ActiveChatSessionMap.created_at: now}),
+                                                 upsert=True)
+
+async def get_active_chat_id(user_session_id: str, channel_id: str) -> Optional[str]:
+    """
+    Return the active chat of a session with a channel.
+
+    The session map expires ACTIVE_CHAT_SESSION_TTL_DAYS after its last update, so
+    a session in use is touched, at most once per ACTIVE_CHAT_SESSION_TOUCH_SECONDS.
+
+    Until `compact_active_chat_sessions` has built the unique index, a session may still
+    have several maps with a channel, and `set_active_chat` updates any one of them; the
+    most recently updated map holds the active chat.
+
+    Args:
+        user_session_id (str): The ID of the user's session.
+        channel_id (str): The ID of the channel.
+
+    Returns:
+        str, optional: The ID of the active chat, or None if the session has no chat with the channel.
+    """
+    session_map = await ActiveChatSessionMap.find(ActiveChatSessionMap.user_session_id == user_session_id,
+                                                  ActiveChatSessionMap.channel_id == channel_id
+                                                  ).sort([(ActiveChatSessionMap.updated_at, SortDirection.DESCENDING)]
+                                                  ).first_or_none()
+    if not session_map:
+        return None
+    if datetime.now() - session_map.updated_at > ACTIVE_CHAT_SESSION_TOUCH:
+        await session_map.set({ActiveChatSessionMap.updated_at: datetime.now()})
+    return session_map.active_chat_id
+
+async def load_chat_messages(chat: Chat,
+                             before: Optional[str] = None,
+                             limit: Optional[int] = None) -> List[ChatMessage]:
+    """
+    Load the completed messages of a chat from the chat_messages collection.
+
+    Args:
+        chat (Chat): The chat to load the messages of.
+        before (str, optional): Cursor; only messages older than the message with this ID are returned.
+        limit (int, optional): The maximum number of (most recent) messages to return.
+
+    Returns:
+        List[ChatMessage]: The messages, oldest first.
+    """
+    # Move any legacy embedded history to the chat_messages collection
+    if chat.chat_history:
+        await migrate_chat(chat)
+
+    # Walk the (chat_id, created_at, _id) index backwards from the cursor
+    query = ChatMessage.find(ChatMessage.chat_id == chat.id,
+                             ChatMessage.status == ChatResponseStatusEnum.COMPLETED)
+    if before:
+        cursor = await ChatMessage.get(before)
+        if not cursor:
+            raise ValueError(f"Cursor message {before} not found for chat {chat.id}")
+        query = query.find(Or(ChatMessage.created_at < cursor.created_at,
+                              And(ChatMessage.created_at == cursor.created_at, ChatMessage.id < cursor.id)))
+    query = query.sort([(ChatMessage.created_at, SortDirection.DESCENDING),
+                        (ChatMessage.id, SortDirection.DESCENDING)])
+    if limit:
+        query = query.limit(limit)
+    messages = await query.to_list()
+    return list(reversed(messages))
+
+async def get_chat_history(chat_id: str,
+                           before: Optional[str] = None,
+                           limit: Optional[int] = 100) -> List[ChatResponse]:
     """
-    Retrieve chat history based on the provided chat_id.
+    Retrieve a page of chat history based on the provided chat_id.
 
     Args:
     chat_id (str): The ID of the chat to retrieve history from.
+    before (str, optional): Cursor; only messages older than the message with this ID are returned.
+        Pass the ID of the oldest message of the previous page to get the next one.
+    limit (int, optional): The maximum number of messages to return. None returns all of them.
 
     Returns:
-    List[ChatResponse]: The chat history.
+    List[ChatResponse]: The completed messages of the page, oldest first.
 
     Raises:
     ValueError: If the chat is not found.
@@ -69,48 +217,82 @@ async def get_chat_history(chat_id: str) -> List[ChatResponse]:
             raise ValueError(f"Chat not found for chat {chat_id}")
 
         # Return the chat history
-        return [c for c  in chat.chat_history if c.status == ChatResponseStatusEnum.COMPLETED]
+        return await load_chat_messages(chat, before=before, limit=limit)
     except Exception as e:
         # Log and raise the exception if failed to retrieve chat history
         logger.error(f"Failed to get chat history for chat {chat_id}", e)
         raise e
-    
+
+async def save_chat_messages(chat: Chat, responses: List[ChatResponse]) -> None:
+    """
+    Append messages to the chat history with a single insert.
+
+    Args:
+        chat (Chat): The chat the messages belong to.
+        responses (List[ChatResponse]): The messages to append, e.g. the user and assistant pair of a turn.
+    """
+    with CHAT_STAGE_SECONDS.labels("save_messages").time():
+        await ChatMessage.insert_many(ChatMessage.from_responses(chat.id, responses))
+
 async def generate_chat_response_stream(chat: Chat, user_message:str) -> StreamingAgentChatResponse:
     """
     Generate a streaming chat response based on the user message.
 
+    Standalone questions of chats using the response cache are answered from
+    the cache when a similar question was answered before, and their fresh
+    answers are cached once streamed.
+
     Args:
         chat (Chat): The chat object containing vector index name, namespace, and chat history.
         user_message (str): The user's message.
 
     Returns:
-        StreamingAgentChatResponse: The streaming chat response.
+        StreamingAgentChatResponse: The streaming chat response, or a replay of a cached answer.
     """
     try:
-        # Set up the vector store using Pinecone API
-        vector_store = PineconeVectorStore(
-            api_key=os.environ['PINECONE_API_KEY'],
-            index_name=chat.vector_index_name,
-            namespace=chat.vector_namespace,
-        )
-        
-        # Create an index from the vector store
-        index = VectorStoreIndex.from_vector_store(vector_store)
-        
-        # Create a query engine from the index
+        started_at = time.perf_counter()
+        with CHAT_STAGE_SECONDS.labels("history_load").time():
+            chat_history = await load_history_window(chat)
+        # Cached answers and retrievals are stamped with the channel's index version
+        index_version = await get_index_version(chat.vector_namespace)
+
+        # Answers only depend on the question when there is no history to condense it with
+        cache_answer = None
+        if not chat_history and response_cache_enabled(chat):
+            scope = chat_scope(chat, index_version)
+            embedding = await get_embed_model().aget_query_embedding(user_message)
+            cached = response_cache.get(scope, user_message, embedding)
+            if cached is not None:
+                return CachedResponseStream(cached.answer)
+
+            cache_answer = lambda answer: response_cache.set(scope, user_message, embedding, answer,
+                                                             time.perf_counter() - started_at)
+
+        # Get the cached index for the chat's namespace
+        index = get_chat_index(chat)
+
+        # Create a lightweight, per-request chat engine on top of the index
         chat_engine = index.as_chat_engine(
             chat_mode=chat.chat_mode,
-            kwargs=chat.chat_kwargs
+            index_version=index_version,
+            kwargs=_engine_kwargs(chat)
         )
 
-        # Query the channel and get the response
-        return await chat_engine.astream_chat(
+        # Query the channel with the bounded window of chat history and get the response
+        stream = await chat_engine.astream_chat(
             user_message, 
-            chat_history=[ChatMessage.parse_obj(c.model_dump())
-                          for c in chat.chat_history
-                          if c.status == ChatResponseStatusEnum.COMPLETED
-                         ]
+            chat_history=chat_history
         )
+        return CachingResponseStream(stream, cache_answer) if cache_answer else stream
     except Exception as e:
         logger.error(f"Failed to generate chat response for chat {chat.id}", e)
         raise e
+
+def update_history_summary(chat: Chat) -> None:
+    """
+    Refresh the rolling summary of the chat in the background, if enabled in its chat_kwargs.
+
+    Args:
+        chat (Chat): The chat whose turn has just been saved.
+    """
+    schedule_history_summary_refresh(chat, get_chat_index(chat).service_context.llm)
@@ -0,0 +1,167 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel
+from beanie.odm.enums import SortDirection
+from llama_index.core.llms.types import ChatMessage as LLMChatMessage, MessageRole
+from llama_index.llms.llm import LLM
+from llama_index.utils import get_tokenizer
+
+from app.db.models import Chat, ChatMessage, ChatResponseStatusEnum
+from app.db.migrations import migrate_chat
+
+# Defaults used when the chat_kwargs of a chat do not set them
+DEFAULT_HISTORY_TURNS = 10
+DEFAULT_HISTORY_TOKEN_BUDGET = 3000
+
+SUMMARY_PROMPT = (
+    "Progressively summarize the conversation below, adding onto the previous summary "
+    "and returning a new summary. Keep the facts, names and recommendations mentioned.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New lines of conversation:\n{lines}\n\n"
+    "New summary:"
+)
+
+# Keeps references to the background summary refreshes so they are not garbage collected
+_summary_tasks = set()
+
+class ChatMessageView(BaseModel):
+    """Projection of a chat message with only the fields the LLM needs."""
+    role: MessageRole
+    content: Optional[str] = ""
+    created_at: datetime
+
+class HistoryWindow:
+    """History windowing settings of a chat, read from its chat_kwargs."""
+
+    # The chat_kwargs used by the window, not passed on to the chat engine
+    KEYS = ('history_turns', 'history_token_budget', 'history_summary')
+
+    def __init__(self, chat_kwargs: dict) -> None:
+        """
+        Args:
+            chat_kwargs (dict): The chat kwargs. Recognised keys:
+                - history_turns (int): The number of most recent turns passed to the LLM.
+                - history_token_budget (int): The maximum number of history tokens passed to the LLM.
+                - history_summary (bool): Keep a rolling summary of the turns outside the window.
+        """
+        self.turns = int(chat_kwargs.get('history_turns', DEFAULT_HISTORY_TURNS))
+        self.token_budget = int(chat_kwargs.get('history_token_budget', DEFAULT_HISTORY_TOKEN_BUDGET))
+        self.summary = bool(chat_kwargs.get('history_summary', False))
+
+def _count_tokens(text: str) -> int:
+    return len(get_tokenizer()(text or ""))
+
+async def _find_recent_messages(chat: Chat, limit: int) -> List[ChatMessageView]:
+    """Return the most recent completed messages of the chat, oldest first."""
+    messages = await ChatMessage.find(
+        ChatMessage.chat_id == chat.id,
+        ChatMessage.status == ChatResponseStatusEnum.COMPLETED
+    ).sort([(ChatMessage.created_at, SortDirection.DESCENDING),
+            (ChatMessage.id, SortDirection.DESCENDING)]
+    ).limit(limit).project(ChatMessageView).to_list()
+    return list(reversed(messages))
+
+def _fit_window(messages: List[ChatMessageView], budget: int) -> List[ChatMessageView]:
+    """Return the newest messages that fit in the token budget, starting at a user message."""
+    kept = []
+    for message in reversed(messages):
+        budget -= _count_tokens(message.content)
+        if budget < 0:
+            break
+        kept.append(message)
+    kept.reverse()
+
+    # Do not start the window in the middle of a turn
+    while kept and kept[0].role != MessageRole.USER:
+        kept.pop(0)
+    return kept
+
+async def load_history_window(chat: Chat) -> List[LLMChatMessage]:
+    """
+    Load the window of chat history passed to the LLM.
+
+    Only the last `history_turns` turns are read from MongoDB, and the oldest
+    messages are dropped until the window fits the token budget. The rolling
+    summary, when enabled, is prepended as a system message.
+
+    Args:
+        chat (Chat): The chat to load the history window of.
+
+    Returns:
+        List[LLMChatMessage]: The chat history for the chat engine.
+    """
+    window = HistoryWindow(chat.chat_kwargs)
+
+    # Move any legacy embedded history to the chat_messages collection
+    if chat.chat_history:
+        await migrate_chat(chat)
+
+    messages = await _find_recent_messages(chat, window.turns * 2) if window.turns > 0 else []
+
+    summary = chat.history_summary if window.summary else None
+    kept = _fit_window(messages, window.token_budget - _count_tokens(summary))
+
+    history = [LLMChatMessage(role=m.role, content=m.content) for m in kept]
+    if summary:
+        history.insert(0, LLMChatMessage(role=MessageRole.SYSTEM,
+                                         content=f"Summary of the earlier conversation:\n{summary}"))
+    return history
+
+async def refresh_history_summary(chat: Chat, llm: LLM) -> None:
+    """
+    Fold the messages that left the history window into the chat's rolling summary.
+
+    Only the messages between the last summarised message and the start of the
+    window are sent to the LLM, so each refresh costs O(turn) rather than O(chat).
+    The window starts where `load_history_window` starts it, so the messages
+    dropped by the token budget are summarised too.
+
+    Args:
+        chat (Chat): The chat to refresh the summary of.
+        llm (LLM): The LLM used to write the summary.
+    """
+    window = HistoryWindow(chat.chat_kwargs)
+    if not window.summary:
+        return
+
+    try:
+        recent = await _find_recent_messages(chat, window.turns * 2) if window.turns > 0 else []
+        kept = _fit_window(recent, window.token_budget - _count_tokens(chat.history_summary))
+
+        # Messages that left the window since the last refresh
+        query = ChatMessage.find(ChatMessage.chat_id == chat.id,
+                                 ChatMessage.status == ChatResponseStatusEnum.COMPLETED)
+        if kept:
+            query = query.find(ChatMessage.created_at < kept[0].created_at)
+        if chat.history_summarised_until:
+            query = query.find(ChatMessage.created_at > chat.history_summarised_until)
+        dropped = await query.sort([(ChatMessage.created_at, SortDirection.ASCENDING)]
+                                   ).project(ChatMessageView).to_list()
+        if not dropped:
+            return
+
+        lines = "\n".join(f"{m.role.value}: {m.content}" for m in dropped)
+        response = await llm.acomplete(SUMMARY_PROMPT.format(summary=chat.history_summary or "", lines=lines))
+
+        await chat.set({Chat.history_summary: response.text.strip(),
+                        Chat.history_summarised_until: dropped[-1].created_at})
+    except Exception as e:
+        logger.error(f"Failed to refresh history summary for chat {chat.id}", e)
+
+def schedule_history_summary_refresh(chat: Chat, llm: LLM) -> None:
+    """
+    Refresh the rolling summary in the background, off the response path.
+
+    Args:
+        chat (Chat): The chat to refresh the summary of.
+        llm (LLM): The LLM used to write the summary.
+    """
+    if not HistoryWindow(chat.chat_kwargs).summary:
+        return
+    task = asyncio.create_task(refresh_history_summary(chat, llm))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
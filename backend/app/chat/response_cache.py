@@ -0,0 +1,168 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import threading
+from typing import AsyncGenerator, Callable, Hashable, List, Optional, Tuple
+import numpy as np
+
+from app.db.models import Chat
+from app.utils.cache import TTLCache
+from app.utils.metrics import metrics
+
+def response_cache_enabled(chat: Chat) -> bool:
+    """Whether the chat opted in to the response cache, through its chat_kwargs or RESPONSE_CACHE_ENABLED."""
+    default = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+    return bool(chat.chat_kwargs.get('response_cache', default))
+
+def normalise_question(question: str) -> str:
+    """Lowercase the question and collapse whitespace and trailing punctuation."""
+    return re.sub(r"\s+", " ", question.lower()).strip(" ?!.")
+
+class CachedAnswer:
+    """An answer of the response cache."""
+
+    def __init__(self, question: str, embedding: List[float], answer: str, latency: float) -> None:
+        """
+        Args:
+            question (str): The normalised question.
+            embedding (List[float]): The embedding of the question.
+            answer (str): The answer.
+            latency (float): Seconds it took to generate the answer.
+        """
+        self.question = question
+        self.embedding = np.asarray(embedding, dtype=np.float32)
+        self.embedding /= np.linalg.norm(self.embedding) or 1.0
+        self.answer = answer
+        self.latency = latency
+
+class CachedResponseStream:
+    """Replays a cached answer with the `async_response_gen` interface of a chat engine stream."""
+
+    def __init__(self, answer: str) -> None:
+        self.response = answer
+
+    async def async_response_gen(self) -> AsyncGenerator[str, None]:
+        for token in re.findall(r"\s*\S+", self.response):
+            yield token
+
+class CachingResponseStream:
+    """Wraps a chat engine stream and hands the full answer to a callback once it completes."""
+
+    def __init__(self, stream, on_complete: Callable[[str], None]) -> None:
+        self.stream = stream
+        self.on_complete = on_complete
+
+    async def async_response_gen(self) -> AsyncGenerator[str, None]:
+        deltas = []
+        async for delta in self.stream.async_response_gen():
+            deltas.append(delta)
+            yield delta
+        self.on_complete("".join(deltas))
+
+class ResponseCache:
+    """
+    Semantic cache of answers to standalone questions, per channel namespace.
+
+    A question hits the cache when it matches a cached question exactly (once
+    normalised), or when the cosine similarity of their embeddings reaches
+    `threshold`. Each scope is an LRU with a TTL, and the scopes themselves
+    are evicted LRU.
+    """
+
+    def __init__(self,
+                 maxsize: int = int(os.environ.get('RESPONSE_CACHE_SIZE', 200)),
+                 ttl: float = float(os.environ.get('RESPONSE_CACHE_TTL', 24*3600)),
+                 threshold: float = float(os.environ.get('RESPONSE_CACHE_THRESHOLD', 0.95)),
+                 max_scopes: int = int(os.environ.get('RESPONSE_CACHE_SCOPES', 256))) -> None:
+        """
+        Args:
+            maxsize (int): The maximum number of answers cached per scope.
+            ttl (float): Seconds after which an answer expires.
+            threshold (float): The minimum cosine similarity of two questions sharing an answer.
+            max_scopes (int): The maximum number of scopes, i.e. channel namespaces, cached.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._scopes = TTLCache(maxsize=max_scopes)
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.latency_saved = 0.0
+
+    def _scope(self, scope: Hashable, create: bool = False) -> Optional[TTLCache]:
+        with self._lock:
+            answers = self._scopes.get(scope)
+            if answers is None and create:
+                answers = TTLCache(maxsize=self.maxsize, ttl=self.ttl)
+                self._scopes.set(scope, answers)
+            return answers
+
+    def get(self, scope: Hashable, question: str, embedding: List[float]) -> Optional[CachedAnswer]:
+        """
+        Return the cached answer of the most similar question of the scope, if similar enough.
+
+        Args:
+            scope (Hashable): The scope, see `chat_scope`.
+            question (str): The question.
+            embedding (List[float]): The embedding of the question.
+
+        Returns:
+            CachedAnswer, optional: The cached answer, or None on a miss.
+        """
+        self.lookups += 1
+        answers = self._scope(scope)
+        cached = None
+        if answers is not None:
+            question = normalise_question(question)
+            cached = answers.get(question)
+            if cached is None:
+                candidates = answers.items()
+                if candidates:
+                    query = np.asarray(embedding, dtype=np.float32)
+                    query /= np.linalg.norm(query) or 1.0
+                    scores = np.stack([answer.embedding for _, answer in candidates]) @ query
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.threshold:
+                        # Mark the answer as recently used
+                        cached = answers.get(candidates[best][0])
+        if cached is not None:
+            self.hits += 1
+            self.latency_saved += cached.latency
+        return cached
+
+    def set(self, scope: Hashable, question: str, embedding: List[float], answer: str, latency: float) -> None:
+        """
+        Cache the answer to a question.
+
+        Args:
+            scope (Hashable): The scope, see `chat_scope`.
+            question (str): The question.
+            embedding (List[float]): The embedding of the question.
+            answer (str): The answer.
+            latency (float): Seconds it took to generate the answer.
+        """
+        if not answer:
+            return
+        question = normalise_question(question)
+        self._scope(scope, create=True).set(question, CachedAnswer(question, embedding, answer, latency))
+
+    def stats(self) -> dict:
+        """Return the lookup and hit counters, the hit rate and the generation time saved by hits."""
+        return {"lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+                "scopes": len(self._scopes)}
+
+def chat_scope(chat: Chat, index_version: int = 0) -> Tuple[str, str, str, int]:
+    """
+    The scope of a chat's cached answers: answers are shared by chats of the same index,
+    namespace and mode, until the channel's index version changes.
+    """
+    return (chat.vector_index_name, chat.vector_namespace, str(chat.chat_mode), index_version)
+
+response_cache = ResponseCache()
+metrics.register_stats("response_cache", response_cache.stats)
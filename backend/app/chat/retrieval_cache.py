@@ -0,0 +1,206 @@
+"""
+Cache of the retrieval step of the chat engines: condensed query -> top-k nodes.
+
+Retrieval against a namespace is deterministic until the channel is
+re-indexed, so results are keyed by the channel's index_version. Onboarding
+bumps the version, which invalidates every cached result of the channel in
+O(1), across processes.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import json
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, List, Optional
+from pydantic import BaseModel
+from llama_index import ServiceContext, VectorStoreIndex
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.vector_stores.types import VectorStore
+
+from app.db.models import Channel, RetrievalCacheEntry
+from app.utils.cache import TTLCache
+from app.utils.metrics import CHAT_STAGE_SECONDS, metrics
+
+class ChannelVersionView(BaseModel):
+    """Projection of a channel with only its index version."""
+    index_version: int = 0
+
+# Index versions of the channels, re-read from MongoDB every INDEX_VERSION_TTL seconds
+_index_versions = TTLCache(maxsize=1024, ttl=float(os.environ.get('INDEX_VERSION_TTL', 15)))
+
+async def get_index_version(vector_namespace: str) -> int:
+    """
+    Return the index version of the channel of a namespace.
+
+    Args:
+        vector_namespace (str): The namespace, i.e. the channel id.
+
+    Returns:
+        int: The index version, 0 if the channel is unknown.
+    """
+    version = _index_versions.get(vector_namespace)
+    if version is None:
+        channel = await Channel.find_one(Channel.id == vector_namespace).project(ChannelVersionView)
+        version = channel.index_version if channel else 0
+        _index_versions.set(vector_namespace, version)
+    return version
+
+def normalise_query(query: str) -> str:
+    """Lowercase the query and collapse whitespace."""
+    return re.sub(r"\s+", " ", query.lower()).strip()
+
+class RetrievalCache:
+    """
+    Bounded cache of retrieval results.
+
+    Results are always kept in an in-memory LRU. With the "mongo" backend they
+    are also stored in the retrieval_cache collection, shared by every process
+    and expired by a TTL index; only the async path reads MongoDB.
+    """
+
+    def __init__(self,
+                 backend: str = os.environ.get('RETRIEVAL_CACHE_BACKEND', 'memory'),
+                 maxsize: int = int(os.environ.get('RETRIEVAL_CACHE_SIZE', 2048)),
+                 ttl: float = float(os.environ.get('RETRIEVAL_CACHE_TTL', 6*3600))) -> None:
+        """
+        Args:
+            backend (str): "memory", "mongo", or "off" to disable the cache.
+            maxsize (int): The maximum number of results kept in memory.
+            ttl (float): Seconds after which a result expires.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.mongo_hits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend != 'off'
+
+    def key(self, vector_namespace: str, index_version: int, query: str, top_k: int, filters: Any) -> str:
+        """Build the key of a retrieval: (namespace, index version, normalised query, top k, filters)."""
+        filters = filters.json() if hasattr(filters, "json") else json.dumps(filters, default=str)
+        raw = json.dumps([vector_namespace, index_version, normalise_query(query), top_k, filters])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[NodeWithScore]]:
+        nodes = self._memory.get(key)
+        return list(nodes) if nodes is not None else None
+
+    async def aget(self, key: str) -> Optional[List[NodeWithScore]]:
+        nodes = self.get(key)
+        if nodes is None and self.backend == 'mongo':
+            entry = await RetrievalCacheEntry.get(key)
+            if entry and entry.expires_at > datetime.now():
+                nodes = [NodeWithScore(node=json_to_doc(n["node"]), score=n["score"]) for n in entry.nodes]
+                self._memory.set(key, nodes)
+                self.mongo_hits += 1
+        return nodes
+
+    def set(self, key: str, nodes: List[NodeWithScore]) -> None:
+        self._memory.set(key, list(nodes))
+
+    async def aset(self, key: str, nodes: List[NodeWithScore]) -> None:
+        self.set(key, nodes)
+        if self.backend == 'mongo':
+            entry = RetrievalCacheEntry(id=key,
+                                        nodes=[{"node": doc_to_json(n.node), "score": n.score} for n in nodes],
+                                        expires_at=datetime.now() + timedelta(seconds=self.ttl))
+            try:
+                await entry.save()
+            except Exception as e:
+                # The in-memory copy still serves this process
+                logger.error(f"Failed to store retrieval cache entry {key}", e)
+
+    def stats(self) -> dict:
+        """Return the counters of the in-memory tier and the MongoDB hits."""
+        return {**self._memory.stats(), "backend": self.backend, "mongo_hits": self.mongo_hits}
+
+retrieval_cache = RetrievalCache()
+metrics.register_stats("retrieval_cache", retrieval_cache.stats)
+
+class CachedRetriever(BaseRetriever):
+    """Serves the retrievals of a wrapped retriever from the retrieval cache."""
+
+    def __init__(self,
+                 retriever: BaseRetriever,
+                 vector_namespace: str,
+                 index_version: int,
+                 cache: RetrievalCache = retrieval_cache) -> None:
+        """
+        Args:
+            retriever (BaseRetriever): The retriever of the index, e.g. a VectorIndexRetriever.
+            vector_namespace (str): The namespace the retriever queries.
+            index_version (int): The index version of the namespace's channel.
+            cache (RetrievalCache): The cache.
+        """
+        super().__init__(callback_manager=retriever.callback_manager)
+        self.retriever = retriever
+        self.vector_namespace = vector_namespace
+        self.index_version = index_version
+        self.cache = cache
+
+    def _key(self, query_bundle: QueryBundle) -> str:
+        return self.cache.key(self.vector_namespace,
+                              self.index_version,
+                              query_bundle.query_str,
+                              getattr(self.retriever, "_similarity_top_k", None),
+                              getattr(self.retriever, "_filters", None))
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        key = self._key(query_bundle)
+        nodes = self.cache.get(key)
+        if nodes is None:
+            with CHAT_STAGE_SECONDS.labels("retrieve").time():
+                nodes = self.retriever.retrieve(query_bundle)
+            self.cache.set(key, nodes)
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        key = self._key(query_bundle)
+        nodes = await self.cache.aget(key)
+        if nodes is None:
+            with CHAT_STAGE_SECONDS.labels("retrieve").time():
+                nodes = await self.retriever.aretrieve(query_bundle)
+            await self.cache.aset(key, nodes)
+        return nodes
+
+class CachedVectorStoreIndex(VectorStoreIndex):
+    """
+    VectorStoreIndex whose retrievers go through the retrieval cache.
+
+    The chat engines build their retrievers with `as_retriever(**kwargs)`, so
+    passing `index_version` to `as_chat_engine` enables the cache for that
+    engine.
+    """
+
+    vector_namespace: Optional[str] = None
+
+    @classmethod
+    def from_namespace(cls, vector_store: VectorStore, vector_namespace: str,
+                       service_context: ServiceContext) -> "CachedVectorStoreIndex":
+        """
+        Build the index of a namespace's vector store.
+
+        Args:
+            vector_store (VectorStore): The vector store of the namespace.
+            vector_namespace (str): The namespace, i.e. the channel id.
+            service_context (ServiceContext): Provides the embedding model and LLM.
+
+        Returns:
+            CachedVectorStoreIndex: The index.
+        """
+        index = cls.from_vector_store(vector_store, service_context=service_context)
+        index.vector_namespace = vector_namespace
+        return index
+
+    def as_retriever(self, index_version: Optional[int] = None, **kwargs: Any) -> BaseRetriever:
+        retriever = super().as_retriever(**kwargs)
+        if index_version is None or self.vector_namespace is None or not retrieval_cache.enabled:
+            return retriever
+        return CachedRetriever(retriever, self.vector_namespace, index_version)
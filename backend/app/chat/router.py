@@ -3,16 +3,20 @@ logger = logging.getLogger(__name__)
 
 from fastapi import APIRouter, HTTPException, Request, Body
 from click import UUID
-from typing import Generator, List
+from typing import Generator, List, Optional
 from sse_starlette.sse import EventSourceResponse
-from beanie.odm.operators.find.logical import And
-from beanie.odm.enums import SortDirection
 from llama_index.core.llms.types import MessageRole
-from app.utils.encoder import UUIDEncoder
 
-from app.db.models import ChatResponse, Chat, ChatResponseStatusEnum, ActiveChatSessionMap
-from app.chat.engine import create_new_chat, get_chat_history, generate_chat_response_stream
+from app.db.models import ChatResponse, Chat, ChatResponseStatusEnum
+from app.chat.engine import create_new_chat, set_active_chat, get_active_chat_id, get_chat_history, generate_chat_response_stream, save_chat_messages, update_history_summary, get_chat_index_cache_stats
+from app.chat.response_cache import response_cache
+from app.chat.retrieval_cache import retrieval_cache
+from app.utils.session import get_session_id
+from app.utils.loop_monitor import loop_monitor
+from app.chat.stream import StreamModeEnum, get_stream_encoder, coalesce_deltas, frame_size, stream_metrics
+from app.utils.metrics import CHAT_STAGE_SECONDS, SSE_STREAMS_IN_FLIGHT
 import json
+import time
 
 chat_router = APIRouter()
 
@@ -33,12 +37,9 @@ async def initiate(request: Request, channel_id: str = Body(..., embed=True)) ->
         # Create a new chat with the specified channel ID
         chat_id = await create_new_chat(channel_id)
 
-        session_id = request.cookies.get('sessionId')
+        session_id = get_session_id(request)
         if session_id:
-            session_map = ActiveChatSessionMap(user_session_id=session_id
-                                               , channel_id=channel_id
-                                               , active_chat_id=str(chat_id))
-            await session_map.save()
+            await set_active_chat(session_id, channel_id, str(chat_id))
         
         return str(chat_id)
     except Exception as e:
@@ -59,41 +60,39 @@ async def get_chat_id(request: Request, channel_id: str = Body(..., embed=True))
         str: The retrieved chat ID.
     """
     # Retrieve session ID from request cookies
-    session_id = request.cookies.get('sessionId')
+    session_id = get_session_id(request)
 
     # Check if session ID exists
     if session_id:
-        # Find active chat session map based on session ID and channel ID
-        session_map_list = await ActiveChatSessionMap.find(And(
-            ActiveChatSessionMap.user_session_id == session_id
-            , ActiveChatSessionMap.channel_id == channel_id),
-            limit=1,
-            sort=[("updated_at", SortDirection.DESCENDING)]
-            ).to_list()
-
-        # If active chat session map exists, return the active chat ID from latest session
-        if session_map_list:
-            return session_map_list[0].active_chat_id
+        # Find the active chat of the session with the channel
+        active_chat_id = await get_active_chat_id(session_id, channel_id)
+        if active_chat_id:
+            return active_chat_id
     
     # If no active chat session map exists, initiate a new chat and return the chat ID
     return await initiate(request, channel_id)
 
 @chat_router.post("/history/")
-async def chat_history(request: Request, chat_id: str = Body(..., embed=True)) -> List[ChatResponse]:
+async def chat_history(request: Request,
+                       chat_id: str = Body(..., embed=True),
+                       before: Optional[str] = Body(None, embed=True),
+                       limit: int = Body(100, embed=True)) -> List[ChatResponse]:
     """
-    Retrieves the chat history for the specified chat ID.
+    Retrieves a page of the chat history for the specified chat ID.
 
     Args:
         request (Request): The incoming request object.
         chat_id (str): The ID of the chat to retrieve the history for.
+        before (str, optional): Cursor; the ID of the oldest message already loaded.
+        limit (int): The maximum number of messages to return.
 
     Returns:
-        List[ChatMessage]: A list of ChatMessage objects representing the chat history.
+        List[ChatMessage]: A list of ChatMessage objects representing the chat history, oldest first.
     """
     #TODO: Add user authentication
     try:
         # Retrieve chat history
-        chat_history = await get_chat_history(chat_id)
+        chat_history = await get_chat_history(chat_id, before=before, limit=limit)
         return chat_history
     except Exception as e:
         # Raise exception if chat history retrieval fails
@@ -102,7 +101,8 @@ async def chat_history(request: Request, chat_id: str = Body(..., embed=True)) -
 @chat_router.get("/{chat_id}/message_stream/")
 async def message_stream(request: Request,
                          chat_id: str,
-                         user_message: str ) -> EventSourceResponse:
+                         user_message: str,
+                         stream_mode: StreamModeEnum = StreamModeEnum.DELTA) -> EventSourceResponse:
     """
     Endpoint for streaming chat responses.
 
@@ -110,10 +110,16 @@ async def message_stream(request: Request,
         request (Request): The incoming request object.
         chat_id (str): The ID of the chat.
         user_message (str): The message from the user.
+        stream_mode (StreamModeEnum): `delta` streams start/delta/completed events,
+            `snapshot` streams the whole accumulated message per delta for old clients.
 
     Returns:
         EventSourceResponse: The response stream.
     """
+    chat = None
+    started_at = time.perf_counter()
+    # Created up front so it sorts before the assistant's answer
+    user_response = ChatResponse(role=MessageRole.USER, content=user_message, status=ChatResponseStatusEnum.COMPLETED)
     try:
         # Get the chat by ID
         chat = await Chat.get(chat_id)
@@ -128,16 +134,13 @@ async def message_stream(request: Request,
         
         # If stream not generated, add failed response to chat history and raise an error
         if not stream:
-            chat.chat_history.append(ChatResponse(role=MessageRole.USER
-                                                  , content=user_message
-                                                  , status=ChatResponseStatusEnum.FAILED
-                                                  , error="No stream generated"
-                                                  ))
-            await chat.save()
+            user_response.update_fields(status=ChatResponseStatusEnum.FAILED, status_reason="No stream generated")
+            await save_chat_messages(chat, [user_response])
             raise HTTPException(status_code=500, detail="chat response stream generation failed")
         
-        # Initialize the chat response
+        # Initialize the chat response and the encoder of the requested protocol
         chat_response = ChatResponse(role=MessageRole.ASSISTANT, content="", status=ChatResponseStatusEnum.IN_PROGRESS)
+        encoder = get_stream_encoder(stream_mode)
         
         # Define the stream response generator
         async def stream_response_generator(chat) -> Generator[ChatResponse, None, None]:
@@ -153,29 +156,45 @@ async def message_stream(request: Request,
             Raises:
                 HTTPException: If chat response generation failed.
             """
-            async for delta in stream.async_response_gen():
-                chat_response.content += delta
-                serialised_chat_response = json.dumps(chat_response.dict(), cls=UUIDEncoder)
-                yield serialised_chat_response
-            chat_response.status = ChatResponseStatusEnum.COMPLETED
-            chat.chat_history.append(ChatResponse(role=MessageRole.USER,
-                                                  content=user_message,
-                                                  status=ChatResponseStatusEnum.COMPLETED
-                                                  )
-                                                  )
-            chat.chat_history.append(chat_response)
-            chat = await chat.save()
-            serialised_chat_response = json.dumps(chat_response.dict(), cls=UUIDEncoder)
-            yield serialised_chat_response
+            SSE_STREAMS_IN_FLIGHT.inc()
+            try:
+                frames, frame_bytes = 0, 0
+                start_event = encoder.start(chat_response)
+                if start_event:
+                    frames, frame_bytes = frames + 1, frame_bytes + frame_size(start_event)
+                    yield start_event
+                deltas = []
+                first_token_at = None
+                # Coalesce LLM deltas into fewer, larger frames
+                async for delta in coalesce_deltas(stream.async_response_gen()):
+                    if first_token_at is None:
+                        # From the request to the first token: history, condensing, retrieval and LLM latency
+                        first_token_at = time.perf_counter()
+                        CHAT_STAGE_SECONDS.labels("llm_first_token").observe(first_token_at - started_at)
+                    deltas.append(delta)
+                    if stream_mode == StreamModeEnum.SNAPSHOT:
+                        chat_response.content = "".join(deltas)
+                    event = encoder.delta(chat_response, delta)
+                    frames, frame_bytes = frames + 1, frame_bytes + frame_size(event)
+                    yield event
+                if first_token_at is not None:
+                    CHAT_STAGE_SECONDS.labels("llm_stream").observe(time.perf_counter() - first_token_at)
+                chat_response.content = "".join(deltas)
+                chat_response.status = ChatResponseStatusEnum.COMPLETED
+                # Append the user and assistant pair of the turn in one write
+                await save_chat_messages(chat, [user_response, chat_response])
+                update_history_summary(chat)
+                event = encoder.completed(chat_response)
+                stream_metrics.record(frames + 1, frame_bytes + frame_size(event))
+                yield event
+            finally:
+                SSE_STREAMS_IN_FLIGHT.dec()
         return EventSourceResponse(stream_response_generator(chat))
     except Exception as e:
         logger.error(f"Failed to generate chat response stream for chat {chat_id}", e)
-        chat.chat_history.append(ChatResponse(role=MessageRole.USER
-                                                  , content=user_message
-                                                  , status=ChatResponseStatusEnum.FAILED
-                                                  , error="exception raised"
-                                                  ))
-        await chat.save()
+        if chat:
+            user_response.update_fields(status=ChatResponseStatusEnum.FAILED, status_reason="exception raised")
+            await save_chat_messages(chat, [user_response])
         raise HTTPException(status_code=500, detail="chat response generation failed")
 
 @chat_router.post("/message/")
@@ -195,15 +214,32 @@ async def message(request: Request,
     """
     try:
         # Get the response from the message stream
-        response: EventSourceResponse = await message_stream(request, chat_id, user_message)
+        response: EventSourceResponse = await message_stream(request, chat_id, user_message,
+                                                             stream_mode=StreamModeEnum.DELTA)
         final_message = None
         # Iterate through the response body to get the final message
         async for message in response.body_iterator:
             final_message = message
         # Return the final message if it's not None, otherwise raise an exception
         if final_message is not None:
-            return final_message
+            return json.loads(final_message["data"])
         else:
             raise HTTPException(status_code=500, detail="chat response generation failed")
     except:
         raise HTTPException(status_code=500, detail="chat response generation failed")
+
+
+@chat_router.get("/stats/")
+async def stats(request: Request) -> dict:
+    """
+    Endpoint exposing the counters of the chat caches, of the response streams and of the event loop of this process.
+
+    Returns:
+    - dict: The stats of the response, retrieval and chat index caches, of the streams and the event loop lag.
+    """
+    # TODO: Restrict access only to admins
+    return {"response_cache": response_cache.stats(),
+            "retrieval_cache": retrieval_cache.stats(),
+            "chat_index_cache": get_chat_index_cache_stats(),
+            "streams": stream_metrics.stats(),
+            "event_loop": loop_monitor.stats()}
@@ -0,0 +1,202 @@
+"""
+Encoders for the server-sent events emitted by the chat message stream
+"""
+import os
+import time
+import json
+import asyncio
+import threading
+from enum import Enum
+from typing import AsyncIterator, Optional
+from app.db.models import ChatResponse
+from app.utils.encoder import UUIDEncoder
+from app.utils.metrics import metrics
+
+class StreamModeEnum(Enum):
+    # One event per delta carrying the whole accumulated message (legacy clients)
+    SNAPSHOT = 'snapshot'
+    # A start event, one small event per delta and a final completed event
+    DELTA = 'delta'
+
+class StreamEventEnum(Enum):
+    START = 'start'
+    DELTA = 'delta'
+    COMPLETED = 'completed'
+
+def serialise_chat_response(chat_response: ChatResponse) -> str:
+    """
+    Serialise the full chat response.
+
+    Args:
+        chat_response (ChatResponse): The chat response to serialise.
+
+    Returns:
+        str: The JSON encoded chat response.
+    """
+    return json.dumps(chat_response.dict(), cls=UUIDEncoder)
+
+class SnapshotStreamEncoder:
+    """Encodes every stream event as a snapshot of the whole chat response."""
+
+    def start(self, chat_response: ChatResponse) -> None:
+        # Snapshot clients only expect message events
+        return None
+
+    def delta(self, chat_response: ChatResponse, delta: str) -> str:
+        return serialise_chat_response(chat_response)
+
+    def completed(self, chat_response: ChatResponse) -> str:
+        return serialise_chat_response(chat_response)
+
+class DeltaStreamEncoder:
+    """Encodes stream events incrementally so each delta costs O(len(delta))."""
+
+    def start(self, chat_response: ChatResponse) -> dict:
+        # Carry the response id and metadata once, without the content
+        metadata = chat_response.dict(exclude={"content"})
+        return {"event": StreamEventEnum.START.value,
+                "id": str(chat_response.id),
+                "data": json.dumps(metadata, cls=UUIDEncoder)}
+
+    def delta(self, chat_response: ChatResponse, delta: str) -> dict:
+        return {"event": StreamEventEnum.DELTA.value,
+                "data": json.dumps({"delta": delta})}
+
+    def completed(self, chat_response: ChatResponse) -> dict:
+        return {"event": StreamEventEnum.COMPLETED.value,
+                "id": str(chat_response.id),
+                "data": serialise_chat_response(chat_response)}
+
+def get_stream_encoder(stream_mode: StreamModeEnum):
+    """
+    Return the encoder for the requested stream mode.
+
+    Args:
+        stream_mode (StreamModeEnum): The streaming protocol requested by the client.
+
+    Returns:
+        SnapshotStreamEncoder | DeltaStreamEncoder: The stream encoder.
+    """
+    if stream_mode == StreamModeEnum.SNAPSHOT:
+        return SnapshotStreamEncoder()
+    return DeltaStreamEncoder()
+
+class FlushPolicy:
+    """Controls how stream deltas are coalesced into SSE frames."""
+
+    def __init__(self,
+                 window_ms: float = float(os.environ.get('STREAM_FLUSH_WINDOW_MS', 40)),
+                 max_window_ms: float = float(os.environ.get('STREAM_FLUSH_MAX_WINDOW_MS', 250)),
+                 max_bytes: int = int(os.environ.get('STREAM_FLUSH_BYTES', 512))) -> None:
+        """
+        Args:
+            window_ms (float): Time window over which deltas are batched. 0 flushes every delta.
+            max_window_ms (float): Upper bound of the window when the client is slow to consume frames.
+            max_bytes (int): Flush as soon as the pending text reaches this many bytes.
+        """
+        self.window_ms = window_ms
+        self.max_window_ms = max(max_window_ms, window_ms)
+        self.max_bytes = max_bytes
+
+class StreamMetrics:
+    """Process-wide counters of frames sent per streamed answer."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.answers = 0
+        self.frames = 0
+        self.frame_bytes = 0
+
+    def record(self, frames: int, frame_bytes: int) -> None:
+        with self._lock:
+            self.answers += 1
+            self.frames += frames
+            self.frame_bytes += frame_bytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"answers": self.answers,
+                    "frames": self.frames,
+                    "frames_per_answer": self.frames / self.answers if self.answers else 0.0,
+                    "avg_frame_bytes": self.frame_bytes / self.frames if self.frames else 0.0}
+
+stream_metrics = StreamMetrics()
+metrics.register_stats("streams", stream_metrics.stats)
+
+def frame_size(event) -> int:
+    """Return the payload size in bytes of an encoded stream event."""
+    data = event["data"] if isinstance(event, dict) else event
+    return len(data.encode())
+
+async def coalesce_deltas(deltas: AsyncIterator[str],
+                          policy: Optional[FlushPolicy] = None) -> AsyncIterator[str]:
+    """
+    Batch stream deltas by time window or byte threshold.
+
+    The window adapts to backpressure: when the consumer takes longer than the
+    window to accept a frame (slow client), the window doubles up to
+    `max_window_ms` so fewer, larger frames are sent; it shrinks back once the
+    client keeps up.
+
+    Args:
+        deltas (AsyncIterator[str]): The deltas generated by the LLM.
+        policy (FlushPolicy, optional): The flush policy. Defaults to the environment configured policy.
+
+    Yields:
+        str: The coalesced deltas.
+    """
+    policy = policy or FlushPolicy()
+    if policy.window_ms <= 0:
+        async for delta in deltas:
+            yield delta
+        return
+
+    # Drain the LLM stream in the background so slow clients never stall it
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def produce():
+        try:
+            async for delta in deltas:
+                queue.put_nowait(delta)
+        finally:
+            queue.put_nowait(done)
+
+    producer = asyncio.create_task(produce())
+    window = policy.window_ms / 1000
+    try:
+        finished = False
+        while not finished:
+            # Block for the first delta of the frame, then batch until the window closes
+            item = await queue.get()
+            if item is done:
+                break
+            pending = [item]
+            pending_bytes = len(item.encode())
+            deadline = time.monotonic() + window
+            while pending_bytes < policy.max_bytes:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is done:
+                    finished = True
+                    break
+                pending.append(item)
+                pending_bytes += len(item.encode())
+
+            sent_at = time.monotonic()
+            yield "".join(pending)
+            # The time spent suspended in yield is the time the client took to take the frame
+            consume_time = time.monotonic() - sent_at
+            if consume_time > window:
+                window = min(window * 2, policy.max_window_ms / 1000)
+            else:
+                window = max(window / 2, policy.window_ms / 1000)
+        # Surface errors raised by the LLM stream
+        await producer
+    finally:
+        producer.cancel()
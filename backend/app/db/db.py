@@ -1,7 +1,8 @@
 import os
 from beanie import init_beanie
 from motor.motor_asyncio import AsyncIOMotorClient
-from app.db.models import Channel, ChannelOnBoardingRequest, Chat, ActiveChatSessionMap, User
+from app.db.query_audit import QueryAuditor, query_audit_enabled
+from app.db.models import Channel, ChannelOnBoardingRequest, Chat, ChatMessage, ActiveChatSessionMap, EmbeddingCacheEntry, RetrievalCacheEntry, User, VideoIngestion
 
 class MongoDBClientSingleton:
     __instance = None
@@ -17,15 +18,30 @@ class MongoDBClientSingleton:
             raise Exception("Only one instance of MongoDbClientSingleton is allowed")
         else:
             db_uri =  os.environ['MONGO_URI']
-            self.async_client = AsyncIOMotorClient(db_uri)
+            # Log slow queries and collection scans when auditing
+            self.query_auditor = QueryAuditor(db_uri) if query_audit_enabled() else None
+            self.async_client = AsyncIOMotorClient(db_uri,
+                                                   event_listeners=[self.query_auditor] if self.query_auditor else [])
             MongoDBClientSingleton.__instance = self
 
 async def init_db():
+    # Beanie creates the indexes declared in the models' Settings
     mongo_client = MongoDBClientSingleton.get_instance().async_client
     await init_beanie(database=mongo_client[os.environ['DB_NAME']], document_models=[
         ChannelOnBoardingRequest,
         Channel,
         Chat,
+        ChatMessage,
         ActiveChatSessionMap,
-        User
+        User,
+        VideoIngestion,
+        EmbeddingCacheEntry,
+        RetrievalCacheEntry
         ])
+
+def close_db() -> None:
+    """Close the MongoDB client and the query auditor, if auditing."""
+    instance = MongoDBClientSingleton.get_instance()
+    if instance.query_auditor is not None:
+        instance.query_auditor.close()
+    instance.async_client.close()
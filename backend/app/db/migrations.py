@@ -0,0 +1,120 @@
+"""
+One-off data migrations. Run with `python -m app.db.migrations`.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from app.db.models import ACTIVE_CHAT_SESSION_UNIQUE_INDEX, ActiveChatSessionMap, Chat, ChatMessage
+
+DUPLICATE_KEY_ERROR = 11000
+
+async def migrate_chat(chat: Chat) -> int:
+    """
+    Move the embedded chat history of a chat into the chat_messages collection.
+
+    Messages keep the ids of their responses and the ones already copied, by an
+    interrupted run or by a concurrent request migrating the same chat, are
+    skipped, so the migration can run concurrently and be re-run safely.
+
+    Args:
+        chat (Chat): The chat with a legacy embedded chat history.
+
+    Returns:
+        int: The number of migrated messages.
+    """
+    if not chat.chat_history:
+        return 0
+
+    messages = ChatMessage.from_responses(chat.id, chat.chat_history)
+    try:
+        await ChatMessage.insert_many(messages, ordered=False)
+    except BulkWriteError as e:
+        # Only tolerate the messages that are already there
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+            raise e
+    await chat.set({Chat.chat_history: []})
+    return len(messages)
+
+async def migrate_chat_history() -> int:
+    """
+    Migrate every chat that still has an embedded chat history.
+
+    Returns:
+        int: The number of migrated messages.
+    """
+    migrated = 0
+    async for chat in Chat.find({"chat_history.0": {"$exists": True}}):
+        migrated += await migrate_chat(chat)
+    logger.info(f"Migrated {migrated} chat messages to the chat_messages collection")
+    return migrated
+
+async def remove_duplicate_chat_sessions(batch_size: int = 1000) -> int:
+    """
+    Keep only the most recently updated session map of each session and channel.
+
+    Args:
+        batch_size (int): The number of duplicate maps deleted per query.
+
+    Returns:
+        int: The number of deleted session maps.
+    """
+    collection = ActiveChatSessionMap.get_motor_collection()
+    duplicates = collection.aggregate([
+        {"$sort": {"updated_at": -1}},
+        {"$group": {"_id": {"user_session_id": "$user_session_id", "channel_id": "$channel_id"},
+                    "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ], allowDiskUse=True)
+
+    removed, batch = 0, []
+    async for group in duplicates:
+        batch.extend(group["ids"][1:])
+        while len(batch) >= batch_size:
+            removed += (await collection.delete_many({"_id": {"$in": batch[:batch_size]}})).deleted_count
+            batch = batch[batch_size:]
+    if batch:
+        removed += (await collection.delete_many({"_id": {"$in": batch}})).deleted_count
+    return removed
+
+async def compact_active_chat_sessions(max_attempts: int = 3) -> int:
+    """
+    Migrate the append-only session maps to one map per session and channel.
+
+    Removes the duplicate maps, then creates the unique index. Does nothing
+    once the index exists, so it is safe to run at every startup.
+
+    Args:
+        max_attempts (int): Attempts when duplicates are inserted again before the index is built.
+
+    Returns:
+        int: The number of deleted session maps.
+    """
+    collection = ActiveChatSessionMap.get_motor_collection()
+    index_name = ACTIVE_CHAT_SESSION_UNIQUE_INDEX.document["name"]
+    if index_name in await collection.index_information():
+        return 0
+
+    removed = 0
+    for attempt in range(1, max_attempts + 1):
+        removed += await remove_duplicate_chat_sessions()
+        try:
+            await collection.create_indexes([ACTIVE_CHAT_SESSION_UNIQUE_INDEX])
+            break
+        except (DuplicateKeyError, OperationFailure) as e:
+            # Maps appended by processes still running the previous version
+            if attempt == max_attempts:
+                raise e
+    logger.info(f"Compacted the active chat sessions, removed {removed} duplicate maps")
+    return removed
+
+async def main():
+    from app.db.db import init_db
+    await init_db()
+    await migrate_chat_history()
+    await compact_active_chat_sessions()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
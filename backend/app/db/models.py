@@ -1,14 +1,17 @@
 """
 Pydantic Schemas for the API
 """
+import os
 from uuid import UUID, uuid4
-from datetime import datetime
-from typing import List, Optional, Set
+from datetime import datetime, timedelta
+from typing import List, Optional, Set, Union
 from enum import Enum
 from pydantic import BaseModel, Field,  HttpUrl, model_validator
-from beanie import Document, Indexed
+from beanie import Document, Indexed, PydanticObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from llama_index.core.llms.types import MessageRole
 from llama_index.chat_engine.types import ChatMode
+from app.db.transcript import CompactTranscript
 
 class Thumbnail(BaseModel):
     url: HttpUrl  # URL of the thumbnail image
@@ -39,8 +42,26 @@ class Channel(Document, Base):
     url: HttpUrl = Field(None, description="URL of the channel")
     thumbnails: Optional[List[Thumbnail]] = Field(None, description="Thumbnails of the channel")
     status: Optional[ChannelStatusEnum] = Field(ChannelStatusEnum.INACTIVE, description="Status of the channel")
+    index_version: int = Field(0, description="Incremented every time the channel's vectors change")
     class Settings:
         name = "channels"
+        indexes = [
+            # Default channels: active channels by last update
+            IndexModel([("status", ASCENDING), ("updated_at", ASCENDING)])
+        ]
+
+class ChannelView(BaseModel):
+    """Projection of a channel with only the fields the UI shows."""
+    id: str = Field(..., alias="_id", description='Unique YT channel id')
+    title: str = Field(None, description="Title of the channel")
+    description: Optional[str] = Field(None, description="Description of the channel")
+    url: HttpUrl = Field(None, description="URL of the channel")
+    thumbnails: Optional[List[Thumbnail]] = Field(None, description="Thumbnails of the channel")
+    status: Optional[ChannelStatusEnum] = Field(ChannelStatusEnum.INACTIVE, description="Status of the channel")
+
+    class Config:
+        populate_by_name = True
+        from_attributes = True
 
 class TranscriptSegment(BaseModel):
     text: str = Field(None, description="Transcript text") 
@@ -53,7 +74,50 @@ class Video(BaseModel):
     title: str = Field(None, description="Title of the video")
     channel: Channel = Field(None, description="Channel of the video")
     duration: Optional[int] = Field(None, description="Duration of the video in seconds")
-    transcript: List[TranscriptSegment] = Field(None, description="Transcript of the video")
+    transcript: Union[CompactTranscript, List[TranscriptSegment]] = Field(None, description="Transcript of the video, serialised as a list of segments")
+    transcript_language: Optional[str] = Field(None, description="Language code of the transcript track")
+    transcript_kind: Optional[str] = Field(None, description="Kind of the transcript track: manual, generated or translated")
+
+class VideoIngestionStatusEnum(Enum):
+    COMMITTED = 'committed'
+    # Vectors being replaced; re-indexed by the next sync if the process stops before they are committed
+    PENDING = 'pending'
+    FAILED = 'failed'
+    DELETED = 'deleted'
+
+class VideoIngestion(Document, Base):
+    id: Indexed(str) = Field(..., description="Unique YT video id")
+    channel_id: str = Field(..., description="Unique YT channel id")
+    transcript_hash: Optional[str] = Field(None, description="SHA-256 of the indexed transcript text")
+    transcript_language: Optional[str] = Field(None, description="Language code of the indexed transcript track")
+    transcript_kind: Optional[str] = Field(None, description="Kind of the indexed transcript track: manual, generated or translated")
+    chunk_ids: List[str] = Field(default_factory=list, description="Ids of the video's nodes in the vector store")
+    embedded_at: Optional[datetime] = Field(None, description="Datetime the video's nodes were upserted")
+    status: VideoIngestionStatusEnum = Field(..., description="Ingestion status of the video")
+    status_reason: Optional[str] = Field(None, description="Status reason of the ingestion")
+    class Settings:
+        name = "video_ingestions"
+        indexes = [
+            # Ledger of a channel, and its committed videos
+            IndexModel([("channel_id", ASCENDING), ("status", ASCENDING)])
+        ]
+
+class EmbeddingCacheEntry(Document, Base):
+    id: Indexed(str) = Field(..., description="SHA-256 of the embedding model name, input type and text")
+    embedding_model: str = Field(..., description="Name of the embedding model")
+    vector: bytes = Field(..., description="Embedding as little-endian float32 values")
+    class Settings:
+        name = "embedding_cache"
+
+class RetrievalCacheEntry(Document, Base):
+    id: Indexed(str) = Field(..., description="SHA-256 of the namespace, index version, query, top k and filters")
+    nodes: List[dict] = Field(default_factory=list, description="Retrieved nodes with their scores")
+    expires_at: datetime = Field(..., description="Datetime after which MongoDB deletes the entry")
+    class Settings:
+        name = "retrieval_cache"
+        indexes = [
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0)
+        ]
 
 class ChannelOnBoardingRequestStatusEnum(Enum):
     PENDING = 'pending'
@@ -68,8 +132,31 @@ class ChannelOnBoardingRequest(Document, Base):
     channel_id: str = Field(..., description="Unique YT channel id")
     requested_by: Optional[str] = Field(None, description="Requested by user id")
     status: ChannelOnBoardingRequestStatusEnum = Field(ChannelOnBoardingRequestStatusEnum.PENDING, description="Status of the request")
+    refresh: bool = Field(False, description="True to delta sync an already onboarded channel")
+    resync: bool = Field(False, description="True to re-check the transcripts of already indexed videos on refresh")
+    rebuild: bool = Field(False, description="True to re-index the channel from the transcript archive, without YouTube")
+    incremental: bool = Field(False, description="True to only sync the uploads newer than the newest indexed video on refresh")
+    videos_total: Optional[int] = Field(None, description="Number of videos to fetch transcripts for")
+    videos_fetched: Optional[int] = Field(None, description="Number of videos with a fetched transcript")
+    videos_failed: Optional[int] = Field(None, description="Number of videos whose transcript could not be fetched")
+    videos_indexed: Optional[int] = Field(None, description="Number of videos embedded and upserted to the vector store")
+    nodes_indexed: Optional[int] = Field(None, description="Number of nodes upserted to the vector store")
+    checkpointed_at: Optional[datetime] = Field(None, description="Datetime of the last committed batch")
+    attempts: int = Field(0, description="Number of times a worker leased the request")
+    next_attempt_at: Optional[datetime] = Field(None, description="Datetime from which a worker may lease the queued request")
+    lease_owner: Optional[str] = Field(None, description="Id of the worker processing the request")
+    lease_expires_at: Optional[datetime] = Field(None, description="Datetime after which another worker may take over the request")
+    heartbeat_at: Optional[datetime] = Field(None, description="Datetime of the last heartbeat of the lease owner")
+    last_error: Optional[str] = Field(None, description="Error of the last failed attempt")
     class Settings:
         name = "onboarding_requests"
+        indexes = [
+            # Queued requests due for an attempt, and requests whose lease expired
+            IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+            IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)]),
+            # Requests of a channel, e.g. its completed onboarding
+            IndexModel([("channel_id", ASCENDING), ("status", ASCENDING)])
+        ]
 
 
 class ChatResponseStatusEnum(Enum):
@@ -91,21 +178,64 @@ class ChatResponse(Base):
 class Chat(Document, Base):
     vector_index_name: str = Field(..., description="Name of the vector index")
     vector_namespace: str = Field(..., description="Namespace of the vector index")
-    chat_history: Optional[List[ChatResponse]] = Field(default_factory=list, description="Chat history of the chat")
+    chat_history: Optional[List[ChatResponse]] = Field(default_factory=list, description="Legacy embedded chat history, migrated to the chat_messages collection")
     chat_mode: ChatMode = Field(ChatMode.CONDENSE_PLUS_CONTEXT, description="Chat mode of the chat")
     chat_kwargs: dict = Field(default_factory=dict, description="Additional chat kwargs")
+    history_summary: Optional[str] = Field(None, description="Rolling summary of the turns outside the history window")
+    history_summarised_until: Optional[datetime] = Field(None, description="Creation datetime of the last summarised message")
     is_expired: Optional[bool] = Field(False, description="True if the chat has expired")
 
     class Settings:
         name = "chats"
 
+class ChatMessage(Document, ChatResponse):
+    # The id of the ChatResponse, so the ids of the streamed and stored messages match
+    id: UUID = Field(default_factory=uuid4, description="Unique identifier")
+    chat_id: PydanticObjectId = Field(..., description="Id of the chat the message belongs to")
+
+    @classmethod
+    def from_responses(cls, chat_id: PydanticObjectId, responses: List[ChatResponse]) -> List["ChatMessage"]:
+        """
+        Build the messages of a chat from responses, keeping their ids.
+
+        MongoDB stores datetimes in milliseconds and the ids are random, so the
+        creation datetimes are made strictly increasing to keep the responses' order.
+        """
+        messages, previous = [], None
+        for response in responses:
+            created_at = response.created_at.replace(microsecond=response.created_at.microsecond // 1000 * 1000)
+            if previous is not None and created_at <= previous:
+                created_at = previous + timedelta(milliseconds=1)
+            messages.append(cls(chat_id=chat_id, **response.model_dump(exclude={"created_at"}), created_at=created_at))
+            previous = created_at
+        return messages
+
+    class Settings:
+        name = "chat_messages"
+        indexes = [
+            # _id breaks ties between messages created in the same millisecond
+            IndexModel([("chat_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)])
+        ]
+
 class ActiveChatSessionMap(Document, Base):
-    user_session_id: Indexed(str) = Field(..., description="User or session id")
-    channel_id: Indexed(str) = Field(..., description="Channel id")
+    user_session_id: str = Field(..., description="User or session id")
+    channel_id: str = Field(..., description="Channel id")
     active_chat_id: str = Field(..., description="Active chat id")
 
     class Settings:
         name = "active_chat_sessions"
+        indexes = [
+            # Latest chat of a session with a channel, while duplicate maps remain
+            IndexModel([("user_session_id", ASCENDING), ("channel_id", ASCENDING), ("updated_at", DESCENDING)]),
+            # Expire the sessions not used for ACTIVE_CHAT_SESSION_TTL_DAYS
+            IndexModel([("updated_at", ASCENDING)],
+                       expireAfterSeconds=int(os.environ.get('ACTIVE_CHAT_SESSION_TTL_DAYS', 30))*24*3600)
+        ]
+
+# One session map per session and channel. Created by `compact_active_chat_sessions` once the
+# duplicate rows of the former append-only maps are removed, as it cannot be built over them.
+ACTIVE_CHAT_SESSION_UNIQUE_INDEX = IndexModel([("user_session_id", ASCENDING), ("channel_id", ASCENDING)],
+                                              unique=True, name="user_session_id_1_channel_id_1_unique")
 
 class User(Document, Base):
     id: Indexed(str) = Field(..., description="User or session id")
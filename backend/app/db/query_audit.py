@@ -0,0 +1,144 @@
+"""
+Query audit mode: logs slow queries and queries that scan a whole collection.
+
+Enabled with QUERY_AUDIT_ENABLED=true. A pymongo CommandListener sees every
+command sent by the Motor client; the first query of each shape, and every
+query slower than QUERY_AUDIT_SLOW_MS, is explained on a background thread
+and logged with its winning plan when it is slow or uses a COLLSCAN.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import MongoClient, monitoring
+
+# Commands whose plan can be explained
+AUDITED_COMMANDS = {"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"}
+
+# Command fields that are not part of the query itself
+SESSION_FIELDS = {"lsid", "$db", "$clusterTime", "txnNumber", "$readPreference", "readConcern",
+                  "writeConcern", "startTransaction", "autocommit", "apiVersion"}
+
+def query_audit_enabled() -> bool:
+    return os.environ.get('QUERY_AUDIT_ENABLED', 'false').lower() == 'true'
+
+def query_shape(value: Any) -> Any:
+    """
+    Return the shape of a query: its structure and field names, without the values.
+
+    Lists of values, e.g. of an $in, have the shape of their first value; lists of
+    documents, e.g. the stages of a pipeline or the clauses of an $or, keep every one.
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(item, (dict, list, tuple)) for item in value):
+            return [query_shape(item) for item in value]
+        return [query_shape(item) for item in value[:1]]
+    return 1
+
+def command_shape(command_name: str, command: dict) -> str:
+    """Return the key of a command's shape, with the collection it runs on."""
+    return json.dumps([command_name, command.get(command_name), query_shape(command)],
+                      sort_keys=True, default=str)
+
+def plan_stages(plan: dict) -> List[str]:
+    """Return the stages of an explained plan, depth first."""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(plan_stages(child))
+    return stages
+
+def winning_plan(explained: dict) -> dict:
+    """Return the winning plan of an explain result, for queries and aggregations."""
+    planner = explained.get("queryPlanner")
+    if planner is None:
+        # Aggregations report the plan of their $cursor stage
+        for stage in explained.get("stages", []):
+            if "$cursor" in stage:
+                planner = stage["$cursor"].get("queryPlanner")
+                break
+    plan = (planner or {}).get("winningPlan", {})
+    # Plans run by the slot based engine nest the classic plan
+    return plan.get("queryPlan", plan)
+
+class QueryAuditor(monitoring.CommandListener):
+    """Explains new query shapes and slow queries, logging the slow ones and the collection scans."""
+
+    def __init__(self,
+                 mongo_uri: str,
+                 slow_ms: float = float(os.environ.get('QUERY_AUDIT_SLOW_MS', 100)),
+                 max_findings: int = 1000) -> None:
+        """
+        Args:
+            mongo_uri (str): The URI of the MongoDB server, used to explain the queries.
+            slow_ms (float): Queries slower than this many milliseconds are explained and logged.
+            max_findings (int): The number of recent findings kept for `stats`.
+        """
+        self.mongo_uri = mongo_uri
+        self.slow_ms = slow_ms
+        self.findings = deque(maxlen=max_findings)
+        self._commands: Dict[int, Tuple[str, dict]] = {}
+        self._explained_shapes = set()
+        self._client: Optional[MongoClient] = None
+        # A single thread explains the queries, off the path of the audited ones
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-audit")
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in AUDITED_COMMANDS:
+            command = {key: value for key, value in event.command.items() if key not in SESSION_FIELDS}
+            self._commands[event.request_id] = (event.database_name, command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        audited = self._commands.pop(event.request_id, None)
+        if audited is None:
+            return
+        database, command = audited
+        duration_ms = event.duration_micros / 1000
+        shape = command_shape(event.command_name, command)
+        if duration_ms >= self.slow_ms or shape not in self._explained_shapes:
+            self._explained_shapes.add(shape)
+            self._executor.submit(self._explain, database, event.command_name, command, duration_ms)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._commands.pop(event.request_id, None)
+
+    def _explain(self, database: str, command_name: str, command: dict, duration_ms: float) -> None:
+        try:
+            if self._client is None:
+                self._client = MongoClient(self.mongo_uri)
+            explained = self._client[database].command({"explain": command, "verbosity": "queryPlanner"})
+        except Exception as e:
+            logger.error(f"Failed to explain {command_name} on {database}.{command.get(command_name)}", e)
+            return
+        plan = winning_plan(explained)
+        stages = plan_stages(plan)
+        collection_scan = "COLLSCAN" in stages
+        if collection_scan or duration_ms >= self.slow_ms:
+            finding = {"collection": command.get(command_name),
+                       "command": command_name,
+                       "duration_ms": round(duration_ms, 2),
+                       "collection_scan": collection_scan,
+                       "stages": stages,
+                       "query": json.loads(json.dumps(command, default=str))}
+            self.findings.append(finding)
+            logger.warning(f"{'COLLSCAN' if collection_scan else 'Slow'} {command_name} on "
+                           f"{finding['collection']} ({duration_ms:.1f} ms): {json.dumps(finding['query'])} "
+                           f"plan: {json.dumps(plan, default=str)}")
+
+    def stats(self) -> dict:
+        """Return the number of explained query shapes and the recent findings."""
+        return {"explained_shapes": len(self._explained_shapes),
+                "collection_scans": sum(finding["collection_scan"] for finding in self.findings),
+                "findings": list(self.findings)}
+
+    def close(self) -> None:
+        """Stop explaining queries, dropping the pending ones, and close the explain client."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self._client is not None:
+            self._client.close()
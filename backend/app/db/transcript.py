@@ -0,0 +1,227 @@
+"""
+Compact, columnar storage of video transcripts.
+
+A channel's transcripts have millions of caption lines. Instead of one
+validated TranscriptSegment model per line, a CompactTranscript keeps the
+timestamps in two `array('i')` columns and the texts in a single string
+with offsets, and converts to and from TranscriptSegment lists at the API
+boundaries.
+"""
+import sys
+import json
+import zlib
+import struct
+from array import array
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional, Sequence, Tuple, Union
+from pydantic_core import core_schema
+
+if TYPE_CHECKING:
+    from app.db.models import TranscriptSegment
+
+# Blob header: format version, number of segments, bytes of the texts, bytes of the chapters
+_HEADER = struct.Struct("<BIII")
+_BLOB_VERSION = 1
+
+def _little_endian(column: array) -> bytes:
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+def _from_little_endian(typecode: str, data: bytes) -> array:
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+class SegmentView:
+    """Read-only view of a segment of a CompactTranscript, with the attributes of a TranscriptSegment."""
+
+    __slots__ = ("text", "start_ms", "end_ms", "chapter")
+
+    def __init__(self, text: str, start_ms: int, end_ms: int, chapter: Optional[str]) -> None:
+        self.text = text
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.chapter = chapter
+
+class CompactTranscript:
+    """
+    Transcript stored as columns: start and end timestamps in milliseconds,
+    the texts joined in one string with their offsets, and the chapters as
+    (first segment, title) runs.
+    """
+
+    __slots__ = ("starts", "ends", "offsets", "text", "chapters")
+
+    def __init__(self,
+                 starts: array,
+                 ends: array,
+                 offsets: array,
+                 text: str,
+                 chapters: Optional[List[Tuple[int, str]]] = None) -> None:
+        """
+        Args:
+            starts (array): The start of each segment in ms, typecode 'i'.
+            ends (array): The end of each segment in ms, typecode 'i'.
+            offsets (array): The offset of each segment's text in `text`, plus the length of `text`, typecode 'q'.
+            text (str): The texts of the segments, concatenated.
+            chapters (List[Tuple[int, str]], optional): The index of the first segment and the title of each chapter.
+        """
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.text = text
+        self.chapters = chapters or []
+
+    @classmethod
+    def from_raw(cls, segments: List[dict]) -> "CompactTranscript":
+        """
+        Build a transcript from the segments returned by youtube_transcript_api.
+
+        Args:
+            segments (List[dict]): The segments, with their text, start and duration in seconds.
+
+        Returns:
+            CompactTranscript: The transcript.
+        """
+        texts = [segment['text'] for segment in segments]
+        starts = array('i', [int(segment['start']*1000) for segment in segments])
+        ends = array('i', [int((segment['start'] + segment['duration'])*1000) for segment in segments])
+        return cls._from_columns(texts, starts, ends)
+
+    @classmethod
+    def from_segments(cls, segments: Sequence["TranscriptSegment"]) -> "CompactTranscript":
+        """Build a transcript from TranscriptSegment models."""
+        chapters, chapter = [], None
+        for i, segment in enumerate(segments):
+            if segment.chapter != chapter:
+                chapter = segment.chapter
+                chapters.append((i, chapter))
+        return cls._from_columns([segment.text or "" for segment in segments],
+                                 array('i', [segment.start_ms or 0 for segment in segments]),
+                                 array('i', [segment.end_ms or 0 for segment in segments]),
+                                 chapters)
+
+    @classmethod
+    def _from_columns(cls, texts: List[str], starts: array, ends: array,
+                      chapters: Optional[List[Tuple[int, str]]] = None) -> "CompactTranscript":
+        offsets = array('q', [0])
+        total = 0
+        for text in texts:
+            total += len(text)
+            offsets.append(total)
+        return cls(starts, ends, offsets, "".join(texts), chapters)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def segment_text(self, i: int) -> str:
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+    def texts(self) -> List[str]:
+        """Return the text of every segment."""
+        offsets, text = self.offsets, self.text
+        return [text[offsets[i]:offsets[i + 1]] for i in range(len(self))]
+
+    def chapter_of(self) -> List[Optional[str]]:
+        """Return the chapter of every segment."""
+        result: List[Optional[str]] = [None] * len(self)
+        for (first, title), (next_first, _) in zip(self.chapters, self.chapters[1:] + [(len(self), None)]):
+            result[first:next_first] = [title] * (next_first - first)
+        return result
+
+    def joined_text(self, separator: str = "\n") -> str:
+        """Return the texts of the segments joined with the separator."""
+        return separator.join(self.texts())
+
+    def __iter__(self) -> Iterator[SegmentView]:
+        chapters = self.chapter_of()
+        for i, text in enumerate(self.texts()):
+            yield SegmentView(text, self.starts[i], self.ends[i], chapters[i])
+
+    def to_segments(self) -> List["TranscriptSegment"]:
+        """Convert the transcript to TranscriptSegment models, e.g. to return it from the API."""
+        # app.db.models imports this module
+        from app.db.models import TranscriptSegment
+        return [TranscriptSegment(text=segment.text,
+                                  start_ms=segment.start_ms,
+                                  end_ms=segment.end_ms,
+                                  chapter=segment.chapter)
+                for segment in self]
+
+    def to_bytes(self, level: int = 6) -> bytes:
+        """
+        Serialise the transcript as a zlib compressed blob.
+
+        Args:
+            level (int): The zlib compression level.
+
+        Returns:
+            bytes: The blob.
+        """
+        text = self.text.encode("utf-8")
+        chapters = json.dumps(self.chapters).encode("utf-8") if self.chapters else b""
+        # Offsets index the decoded text, so they are stored as is
+        payload = b"".join([_HEADER.pack(_BLOB_VERSION, len(self), len(text), len(chapters)),
+                            _little_endian(self.starts),
+                            _little_endian(self.ends),
+                            _little_endian(self.offsets),
+                            text,
+                            chapters])
+        return zlib.compress(payload, level)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> "CompactTranscript":
+        """Deserialise a blob written by `to_bytes`."""
+        payload = memoryview(zlib.decompress(blob))
+        version, n, text_size, chapters_size = _HEADER.unpack_from(payload)
+        if version != _BLOB_VERSION:
+            raise ValueError(f"Unsupported transcript blob version: {version}")
+        position = _HEADER.size
+        columns = []
+        for typecode, count in (('i', n), ('i', n), ('q', n + 1)):
+            size = array(typecode).itemsize * count
+            columns.append(_from_little_endian(typecode, payload[position:position + size]))
+            position += size
+        text = bytes(payload[position:position + text_size]).decode("utf-8")
+        position += text_size
+        chapters = [tuple(chapter) for chapter in json.loads(bytes(payload[position:position + chapters_size]))] \
+            if chapters_size else []
+        return cls(*columns, text, chapters)
+
+    @property
+    def nbytes(self) -> int:
+        """The approximate memory used by the transcript."""
+        return (sys.getsizeof(self.text)
+                + sum(column.buffer_info()[1] * column.itemsize for column in (self.starts, self.ends, self.offsets)))
+
+    def __eq__(self, other: Any) -> bool:
+        return (isinstance(other, CompactTranscript)
+                and self.starts == other.starts and self.ends == other.ends
+                and self.offsets == other.offsets and self.text == other.text
+                and list(self.chapters) == list(other.chapters))
+
+    def __getstate__(self) -> tuple:
+        return (self.starts, self.ends, self.offsets, self.text, self.chapters)
+
+    def __setstate__(self, state: tuple) -> None:
+        self.starts, self.ends, self.offsets, self.text, self.chapters = state
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: Any) -> core_schema.CoreSchema:
+        # Kept as is by the models, serialised as a list of segments
+        return core_schema.is_instance_schema(
+            cls, serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda transcript: [{"text": segment.text,
+                                     "start_ms": segment.start_ms,
+                                     "end_ms": segment.end_ms,
+                                     "chapter": segment.chapter}
+                                    for segment in transcript]))
+
+def as_compact(transcript: Union[CompactTranscript, Sequence["TranscriptSegment"], None]) -> CompactTranscript:
+    """Return the transcript of a video as a CompactTranscript, converting a list of segments."""
+    if isinstance(transcript, CompactTranscript):
+        return transcript
+    return CompactTranscript.from_segments(transcript or [])
@@ -0,0 +1,502 @@
+"""
+Vector store backends, selected by the VECTOR_STORE_BACKEND setting.
+
+- "pinecone" (default): the Pinecone index VECTOR_STORE_INDEX_NAME, one namespace per channel.
+- "local": an in-process NumPy store persisted under LOCAL_VECTOR_STORE_DIR, one directory per namespace.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from pinecone import Pinecone
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.pinecone import PineconeVectorStore
+from llama_index.vector_stores.types import (VectorStore,
+                                             VectorStoreQuery,
+                                             VectorStoreQueryResult,
+                                             MetadataFilters)
+from llama_index.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+from app.utils.cache import TTLCache
+
+# One Pinecone index handle (and so one HTTP connection pool) per index name
+_pinecone_indexes = TTLCache(maxsize=16)
+
+# One local store per (index name, namespace), shared by the chats and onboarding of a process
+_local_stores = TTLCache(maxsize=int(os.environ.get('LOCAL_VECTOR_STORE_CACHE_SIZE', 256)))
+
+def get_pinecone_index(index_name: str):
+    """
+    Return the shared Pinecone index handle for the given index name.
+
+    Args:
+        index_name (str): The name of the Pinecone index.
+
+    Returns:
+        pinecone.Index: The index handle, created on first use.
+    """
+    pinecone_index = _pinecone_indexes.get(index_name)
+    if pinecone_index is None:
+        pinecone_index = Pinecone(api_key=os.environ['PINECONE_API_KEY']).Index(index_name)
+        _pinecone_indexes.set(index_name, pinecone_index)
+    return pinecone_index
+
+class _IVFIndex:
+    """Inverted file index: spherical k-means clusters of the rows, probed nearest-centroid first."""
+
+    def __init__(self, matrix: np.ndarray, nlist: int, iterations: int = 8, seed: int = 0) -> None:
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(matrix), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = matrix[assignments == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+        self.centroids = centroids
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assignments == c) for c in range(nlist)]
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Return the rows of the `nprobe` clusters nearest to the query."""
+        scores = self.centroids @ query
+        probes = np.argpartition(-scores, min(nprobe, len(scores)) - 1)[:nprobe]
+        return np.concatenate([self.lists[c] for c in probes])
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process vector store of one namespace, backed by NumPy segments memory-mapped from disk.
+
+    Rows are L2-normalised on write, so a query is one matrix-vector product
+    followed by an argpartition top-k. Namespaces with at least `ivf_threshold`
+    rows are also clustered into an IVF index and only `nprobe` clusters are
+    scanned per query.
+
+    Each write appends a segment, i.e. the rows of one batch, and switches the
+    manifest to it atomically. Upserts supersede the rows of earlier segments
+    and deletes append tombstones. The newest segments are merged once they
+    outgrow the segment before them, so a row is rewritten O(log N) times and
+    there are O(log N) segments; once more rows are dead than live, everything
+    is compacted into one segment. Other processes load the new segments on
+    their next call, which assumes a single writer per namespace, as
+    onboarding guarantees.
+    """
+
+    stores_text: bool = True
+    is_embedding_query: bool = True
+
+    def __init__(self,
+                 path: str,
+                 ivf_threshold: int = int(os.environ.get('LOCAL_VECTOR_STORE_IVF_THRESHOLD', 50000)),
+                 nprobe: int = int(os.environ.get('LOCAL_VECTOR_STORE_NPROBE', 8))) -> None:
+        """
+        Args:
+            path (str): The directory of the namespace.
+            ivf_threshold (int): The number of rows from which queries use an IVF index. 0 disables it.
+            nprobe (int): The number of IVF clusters scanned per query.
+        """
+        self.path = path
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self._lock = threading.RLock()
+        self._version = None
+        self._segments: List[int] = []
+        self._segment_rows: List[int] = []
+        self._matrices: List[np.ndarray] = []
+        # One entry per row of the segments, superseded rows and tombstones included
+        self._ids: List[str] = []
+        self._ref_doc_ids: List[Optional[str]] = []
+        self._metadata: List[Optional[dict]] = []
+        self._node_metadata: List[dict] = []
+        self._live = np.zeros(0, dtype=bool)
+        # Row of the live version of each node
+        self._positions: Dict[str, int] = {}
+        self._columns: Dict[str, np.ndarray] = {}
+        self._matrix: Optional[np.ndarray] = None
+        self._ivf: Optional[_IVFIndex] = None
+        self._refresh()
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.path, "manifest.json")
+
+    def _segment_paths(self, segment: int) -> Tuple[str, str]:
+        return (os.path.join(self.path, f"vectors-{segment}.npy"),
+                os.path.join(self.path, f"nodes-{segment}.jsonl"))
+
+    def _changed(self) -> None:
+        self._columns = {}
+        self._matrix = None
+        self._ivf = None
+
+    def _apply(self, segment: int, rows: List[dict], matrix: np.ndarray,
+               node_metadata: Optional[List[dict]] = None) -> None:
+        """
+        Append a segment to the in-memory state: its rows supersede or delete the earlier ones.
+        The metadata of the rows' nodes is parsed unless given.
+        """
+        # A new array, as queries running outside the lock may hold the current one
+        live = np.concatenate([self._live, np.zeros(len(rows), dtype=bool)])
+        offset = len(self._ids)
+        for i, row in enumerate(rows):
+            previous = self._positions.pop(row["id"], None)
+            if previous is not None:
+                live[previous] = False
+            self._ids.append(row["id"])
+            self._ref_doc_ids.append(row.get("ref_doc_id"))
+            self._metadata.append(row.get("metadata"))
+            if row.get("deleted"):
+                self._node_metadata.append({})
+            else:
+                # Parsed once, so filtered queries do not decode the node content of every row
+                self._node_metadata.append(node_metadata[i] if node_metadata is not None
+                                           else json.loads(row["metadata"]["_node_content"]).get("metadata", {}))
+                self._positions[row["id"]] = offset + i
+                live[offset + i] = True
+        self._segments.append(segment)
+        self._segment_rows.append(len(rows))
+        self._matrices.append(matrix)
+        self._live = live
+        self._changed()
+
+    def _truncate(self, start: int) -> None:
+        """Drop the segments from `start` on from the in-memory state."""
+        first_row = sum(self._segment_rows[:start])
+        for i in range(first_row, len(self._ids)):
+            if self._positions.get(self._ids[i]) == i:
+                del self._positions[self._ids[i]]
+        # Rows superseded by the dropped segments stay dead; the segments replacing them supersede them again
+        del self._segments[start:], self._segment_rows[start:], self._matrices[start:]
+        # New lists, as queries running outside the lock may hold the current ones
+        self._ids = self._ids[:first_row]
+        self._ref_doc_ids = self._ref_doc_ids[:first_row]
+        self._metadata = self._metadata[:first_row]
+        self._node_metadata = self._node_metadata[:first_row]
+        self._live = self._live[:first_row].copy()
+        self._changed()
+
+    def _load_vectors(self, segment: int, rows: List[dict], dim: int) -> np.ndarray:
+        """Memory-map the vectors of a segment, with a zero row for each tombstone."""
+        vectored = [i for i, row in enumerate(rows) if not row.get("deleted")]
+        # Tombstones have no vector, and a segment of tombstones only has no vectors file
+        matrix = (np.load(self._segment_paths(segment)[0], mmap_mode="r") if vectored
+                  else np.zeros((0, dim), dtype=np.float32))
+        if len(vectored) < len(rows):
+            expanded = np.zeros((len(rows), matrix.shape[1]), dtype=np.float32)
+            expanded[vectored] = matrix
+            matrix = expanded
+        return matrix
+
+    def _read_segment(self, segment: int, dim: int) -> Tuple[List[dict], np.ndarray]:
+        """Read the rows of a segment and its vectors."""
+        with open(self._segment_paths(segment)[1]) as f:
+            rows = [json.loads(line) for line in f]
+        return rows, self._load_vectors(segment, rows, dim)
+
+    def _refresh(self) -> None:
+        """Load the segments another process wrote since the last load."""
+        for _ in range(3):
+            try:
+                with open(self._manifest_path()) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                return
+            if manifest["version"] == self._version:
+                return
+            # Namespaces written before segments were introduced hold a single segment
+            segments = manifest.get("segments", [manifest["version"]])
+            # Segment numbers are never reused, so the segments both lists share are unchanged
+            common = 0
+            while common < min(len(segments), len(self._segments)) and segments[common] == self._segments[common]:
+                common += 1
+            self._truncate(common)
+            try:
+                for segment in segments[common:]:
+                    self._apply(segment, *self._read_segment(segment, manifest.get("dim", 0)))
+            except FileNotFoundError:
+                # Merged away while being read: read the new manifest
+                self._version = None
+                continue
+            self._version = manifest["version"]
+            return
+
+    def _dim(self) -> int:
+        return next((int(m.shape[1]) for m in self._matrices if m.shape[1]), 0)
+
+    def _write_segment(self, rows: List[dict], vectors: np.ndarray) -> int:
+        """Write the files of a new segment and return its number."""
+        os.makedirs(self.path, exist_ok=True)
+        segment = (self._version or 0) + 1
+        vectors_path, nodes_path = self._segment_paths(segment)
+        if len(vectors):
+            np.save(vectors_path, vectors)
+        with open(nodes_path, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+        return segment
+
+    def _write_manifest(self, version: int) -> None:
+        """Switch the namespace to the in-memory segments atomically."""
+        tmp_path = self._manifest_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": version, "segments": self._segments,
+                       "count": len(self._positions), "dim": self._dim()}, f)
+        os.replace(tmp_path, self._manifest_path())
+        self._version = version
+
+    def _append(self, rows: List[dict], vectors: np.ndarray) -> None:
+        """Write a segment of rows, with the vectors of its non-tombstone rows, then merge segments when due."""
+        segment = self._write_segment(rows, vectors)
+        if len(vectors) < len(rows):
+            # Tombstone segments carry no vectors
+            vectors = np.zeros((len(rows), self._dim()), dtype=np.float32)
+        self._apply(segment, rows, vectors)
+        self._write_manifest(segment)
+
+        if len(self._ids) - len(self._positions) > len(self._positions):
+            self._merge(0)
+            return
+        # Merge the newest segments while they outgrow the segment before them
+        start, tail = len(self._segments) - 1, self._segment_rows[-1]
+        while start > 0 and tail >= self._segment_rows[start - 1]:
+            start -= 1
+            tail += self._segment_rows[start]
+        if start < len(self._segments) - 1:
+            self._merge(start)
+
+    def _merge(self, start: int) -> None:
+        """
+        Rewrite the segments from `start` on as one segment, without their superseded rows.
+        Tombstones are kept unless every segment is merged, as they may delete rows of earlier segments.
+        """
+        merged = list(self._segments[start:])
+        first_row = sum(self._segment_rows[:start])
+        kept = [i for i in range(first_row, len(self._ids))
+                if self._live[i] or (start > 0 and self._metadata[i] is None)]
+        rows = [{"id": self._ids[i], "ref_doc_id": self._ref_doc_ids[i], "metadata": self._metadata[i]}
+                if self._metadata[i] is not None else {"id": self._ids[i], "deleted": True}
+                for i in kept]
+        matrix = self._get_matrix()
+        vectors = np.ascontiguousarray(matrix[[i for i in kept if self._metadata[i] is not None]], dtype=np.float32)
+        node_metadata = [self._node_metadata[i] for i in kept]
+        dim = self._dim()
+        segment = self._write_segment(rows, vectors)
+        self._truncate(start)
+        self._apply(segment, rows, self._load_vectors(segment, rows, dim), node_metadata)
+        self._write_manifest(segment)
+
+        # Drop the merged segments; readers holding them keep their open maps
+        for old in merged:
+            for path in self._segment_paths(old):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _get_matrix(self) -> np.ndarray:
+        """Return the vectors of every row as one matrix, concatenated once per change."""
+        if self._matrix is None:
+            self._matrix = (self._matrices[0] if len(self._matrices) == 1
+                            else np.concatenate(self._matrices) if self._matrices
+                            else np.zeros((0, 0), dtype=np.float32))
+        return self._matrix
+
+    def _column(self, key: str) -> np.ndarray:
+        """Return a metadata field of every row, built once per change."""
+        column = self._columns.get(key)
+        if column is None:
+            column = np.empty(len(self._node_metadata), dtype=object)
+            column[:] = [m.get(key) for m in self._node_metadata]
+            self._columns[key] = column
+        return column
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        """
+        Upsert the embedded nodes; nodes with an existing id replace it.
+
+        Args:
+            nodes (List[BaseNode]): The nodes with their embeddings.
+
+        Returns:
+            List[str]: The ids of the nodes.
+        """
+        if not nodes:
+            return []
+        vectors = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1.0, norms)
+        rows = [{"id": node.node_id,
+                 "ref_doc_id": node.ref_doc_id,
+                 "metadata": node_to_metadata_dict(node, remove_text=False, flat_metadata=False)}
+                for node in nodes]
+
+        with self._lock:
+            self._refresh()
+            self._append(rows, vectors)
+        return [node.node_id for node in nodes]
+
+    def _delete_rows(self, rows: List[int]) -> None:
+        if len(rows):
+            self._append([{"id": self._ids[i], "deleted": True} for i in rows],
+                         np.zeros((0, 0), dtype=np.float32))
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Delete the nodes of a document, i.e. of a video.
+
+        Args:
+            ref_doc_id (str): The id of the document.
+        """
+        with self._lock:
+            self._refresh()
+            self._delete_rows([i for i in self._positions.values() if self._ref_doc_ids[i] == ref_doc_id])
+
+    def delete_nodes(self, node_ids: List[str]) -> None:
+        """
+        Delete nodes by id.
+
+        Args:
+            node_ids (List[str]): The ids of the nodes.
+        """
+        with self._lock:
+            self._refresh()
+            self._delete_rows([self._positions[i] for i in set(node_ids) if i in self._positions])
+
+    def _filter_mask(self, query: VectorStoreQuery) -> Optional[np.ndarray]:
+        """Return the live rows allowed by the query's filters, or None if all live rows are."""
+        if not (query.doc_ids or query.node_ids or query.filters):
+            return None
+        mask = self._live.copy()
+        if query.doc_ids:
+            doc_ids = set(query.doc_ids)
+            mask &= np.fromiter((r in doc_ids for r in self._ref_doc_ids), dtype=bool, count=len(mask))
+        if query.node_ids:
+            node_ids = np.array([self._positions[i] for i in set(query.node_ids) if i in self._positions], dtype=int)
+            selected = np.zeros(len(mask), dtype=bool)
+            selected[node_ids] = True
+            mask &= selected
+        if query.filters:
+            filters = query.filters.legacy_filters() if isinstance(query.filters, MetadataFilters) else query.filters
+            for f in filters:
+                mask &= self._column(f.key) == f.value
+        return mask
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Return the top-k nodes by cosine similarity to the query embedding.
+
+        Args:
+            query (VectorStoreQuery): The query with its embedding.
+
+        Returns:
+            VectorStoreQueryResult: The nodes, similarities and ids, most similar first.
+        """
+        with self._lock:
+            self._refresh()
+            if not self._positions or query.query_embedding is None:
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            ids, metadata, matrix = self._ids, self._metadata, self._get_matrix()
+            mask = self._filter_mask(query)
+            live = self._live
+            if mask is None and self.ivf_threshold and len(self._positions) >= self.ivf_threshold and self._ivf is None:
+                rows = np.flatnonzero(live)
+                ivf = _IVFIndex(np.asarray(matrix[rows]), nlist=int(np.sqrt(len(rows))))
+                ivf.lists = [rows[members] for members in ivf.lists]
+                self._ivf = ivf
+            ivf = self._ivf
+
+        q = np.asarray(query.query_embedding, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1.0
+
+        # Score the candidate rows only
+        if mask is not None:
+            candidates = np.flatnonzero(mask)
+        elif ivf is not None:
+            candidates = ivf.candidates(q, self.nprobe)
+        else:
+            candidates = None
+        if candidates is None:
+            scores = matrix @ q
+            # Rows superseded or deleted by later segments
+            scores[~live] = -np.inf
+            count = int(live.sum())
+        else:
+            scores = matrix[candidates] @ q
+            count = len(candidates)
+
+        k = min(query.similarity_top_k, count)
+        if k == 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        rows = top if candidates is None else candidates[top]
+
+        nodes = [metadata_dict_to_node(metadata[i]) for i in rows]
+        return VectorStoreQueryResult(nodes=nodes,
+                                      similarities=scores[top].tolist(),
+                                      ids=[ids[i] for i in rows])
+
+def get_local_vector_store(index_name: str, namespace: str) -> LocalVectorStore:
+    """
+    Return the shared local vector store of a namespace.
+
+    Args:
+        index_name (str): The name of the index.
+        namespace (str): The namespace, i.e. the channel id.
+
+    Returns:
+        LocalVectorStore: The store, loaded from LOCAL_VECTOR_STORE_DIR on first use.
+    """
+    key = (index_name, namespace)
+    store = _local_stores.get(key)
+    if store is None:
+        root = os.environ.get('LOCAL_VECTOR_STORE_DIR', 'vector_store')
+        store = LocalVectorStore(os.path.join(root, index_name, namespace))
+        _local_stores.set(key, store)
+    return store
+
+def get_vector_store(namespace: str, index_name: Optional[str] = None) -> VectorStore:
+    """
+    Return the vector store of a namespace on the configured backend.
+
+    Args:
+        namespace (str): The namespace, i.e. the channel id.
+        index_name (str, optional): The name of the index. Defaults to VECTOR_STORE_INDEX_NAME.
+
+    Returns:
+        VectorStore: The vector store of the namespace.
+    """
+    index_name = index_name or os.environ['VECTOR_STORE_INDEX_NAME']
+    backend = os.environ.get('VECTOR_STORE_BACKEND', 'pinecone')
+    if backend == 'local':
+        return get_local_vector_store(index_name, namespace)
+    if backend == 'pinecone':
+        return PineconeVectorStore(pinecone_index=get_pinecone_index(index_name), namespace=namespace)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+def delete_nodes(vector_store: VectorStore, video_id: str, node_ids: List[str]) -> None:
+    """
+    Delete the vectors of a video.
+
+    Args:
+        vector_store (VectorStore): The vector store of the channel's namespace.
+        video_id (str): The id of the video, i.e. the ref doc id of its nodes.
+        node_ids (List[str]): The ids of the nodes to delete.
+    """
+    if not node_ids:
+        return
+    if isinstance(vector_store, PineconeVectorStore):
+        # Serverless indexes do not support deleting by metadata filter
+        vector_store.client.delete(ids=node_ids, namespace=vector_store.namespace)
+    elif isinstance(vector_store, LocalVectorStore):
+        vector_store.delete_nodes(node_ids)
+    else:
+        vector_store.delete(video_id)
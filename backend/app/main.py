@@ -2,24 +2,50 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import cookie_parser
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from contextlib import asynccontextmanager
+import asyncio
 import uvicorn
-from uuid import uuid4
 
-from app.db.db import init_db
+from app.db.db import close_db, init_db
+from app.db.migrations import compact_active_chat_sessions
 from app.chat.router import chat_router
 from app.onboarding.router import onboard_router
-from app.db.models import User
-from app.onboarding.engine import get_default_channels
+from app.onboarding.engine import default_channels
+from app.onboarding.search import channel_search
+from app.onboarding.yt_async import youtube
+from app.utils.loop_monitor import loop_monitor
+from app.utils.metrics import CONTENT_TYPE, metrics
+from app.utils.session import SESSION_COOKIE, SESSION_MAX_AGE, resolve_session_cookie, sign_session_id
+
+async def run_compaction() -> None:
+    try:
+        await compact_active_chat_sessions()
+    except Exception as e:
+        logger.error("Failed to compact the active chat sessions", e)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Initilise DB
    await init_db()
+   # Keep the default channels snapshot fresh in the background
+   refresh_default_channels = asyncio.create_task(default_channels.run())
+   # Measure how long blocking calls stall the event loop
+   monitor_loop = asyncio.create_task(loop_monitor.run())
+   # Remove duplicate chat session maps and build their unique index
+   compact_sessions = asyncio.create_task(run_compaction())
    yield
+   refresh_default_channels.cancel()
+   monitor_loop.cancel()
+   compact_sessions.cancel()
+   channel_search.shutdown()
+   youtube.shutdown()
+   close_db()
 
 #TODO: Add CORS Settings
 app = FastAPI(
@@ -27,31 +53,36 @@ app = FastAPI(
     lifespan=lifespan
     ) 
 
-class SessionMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        if request.method == 'OPTIONS':
-            response = await call_next(request)
-            return response
-       # Check if a session ID is already present in the request headers
-        session_id = None
-        
-        # If not, generate a new session ID
-        if not request.cookies.get("sessionId"):
-            session_id = str(uuid4())
-            request.cookies.update({"sessionId": session_id})
-            user = User(id=session_id)
-            user.channels = set([c.id for c in await get_default_channels()])
-            await user.save()
-
-        # Call the next middleware or the endpoint
-        response = await call_next(request)
-
-        # You can modify the response if needed
-        # For example, you can set a cookie with the session ID
-        if session_id:
-            response.set_cookie(key="sessionId", value=session_id, max_age=3600*24*365)
-
-        return response
+class SessionMiddleware:
+    """
+    Pure ASGI middleware assigning a signed session id to every request.
+
+    The session id is resolved from the cookie alone; the User document is
+    created lazily by the first call that changes the user's state.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        # Resolve the session id from the cookie, or issue a new one
+        cookies = cookie_parser(Headers(scope=scope).get("cookie", ""))
+        session_id, set_cookie = resolve_session_cookie(cookies.get(SESSION_COOKIE))
+        scope.setdefault("state", {})["session_id"] = session_id
+
+        async def send_with_cookie(message: Message) -> None:
+            # Set the signed session cookie on new or upgraded sessions
+            if set_cookie and message["type"] == "http.response.start":
+                cookie = Response()
+                cookie.set_cookie(key=SESSION_COOKIE, value=sign_session_id(session_id), max_age=SESSION_MAX_AGE)
+                MutableHeaders(scope=message).append("set-cookie", cookie.headers["set-cookie"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
 
 # Register the middleware
 origins = os.environ['ALLOWED_ORIGINS'].split(',')
@@ -70,6 +101,20 @@ app.add_middleware(SessionMiddleware)
   
 app.include_router(onboard_router, prefix="/onboard", tags=['onboard'])
 app.include_router(chat_router, prefix="/chat", tags=['chat'])
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint() -> Response:
+    """
+    Endpoint exposing the metrics of this process in the Prometheus text format.
+
+    Returns:
+    - Response: The stage timings, retries and in-flight streams, and the counters of the caches and the event loop.
+    """
+    # TODO: Restrict access only to the scrapers
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
 def start():
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
 
@@ -0,0 +1,249 @@
+"""
+On-disk archive of the fetched transcripts, so a channel can be re-indexed
+without downloading its transcripts from YouTube again.
+
+Each channel has a directory under TRANSCRIPT_ARCHIVE_DIR with append-only
+shard files of compressed `CompactTranscript` blobs, rotated once they reach
+TRANSCRIPT_ARCHIVE_SHARD_BYTES, and an append-only `index.jsonl` locating
+the blob of each (video_id, language, kind). A later index line for the same
+key overrides the earlier ones, and a torn last line left by a crash is
+ignored, so the files are only ever appended to.
+
+Appends hold an exclusive lock on the channel's index file, so the API and
+several onboarding workers can share an archive directory on a local
+filesystem. Each process reads the index lines appended by the others
+before each lookup. Without `fcntl`, e.g. on Windows, only one process may
+write to an archive.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import json
+import threading
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from app.db.models import Channel, Video
+from app.db.transcript import CompactTranscript, as_compact
+from app.utils.metrics import metrics
+
+INDEX_FILE = "index.jsonl"
+
+# Transcript kinds, in order of preference
+TRANSCRIPT_KINDS = ["manual", "generated", "translated"]
+
+def transcript_archive_enabled() -> bool:
+    return os.environ.get('TRANSCRIPT_ARCHIVE_ENABLED', 'true').lower() == 'true'
+
+class TranscriptArchive:
+    """Append-only archive of transcripts, sharded per channel."""
+
+    def __init__(self,
+                 root: str = os.environ.get('TRANSCRIPT_ARCHIVE_DIR', 'transcript_archive'),
+                 shard_bytes: int = int(os.environ.get('TRANSCRIPT_ARCHIVE_SHARD_BYTES', 64 * 2**20))) -> None:
+        """
+        Args:
+            root (str): The directory of the archive.
+            shard_bytes (int): The size after which a channel starts a new shard file.
+        """
+        self.root = root
+        self.shard_bytes = shard_bytes
+        # Index of each channel: video id -> (language, kind) -> entry
+        self._indexes: Dict[str, Dict[str, Dict[Tuple[str, str], dict]]] = {}
+        # Bytes of each channel's index file read into its index
+        self._index_offsets: Dict[str, int] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _lock(self, channel_id: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(channel_id, threading.Lock())
+
+    def _channel_dir(self, channel_id: str) -> str:
+        return os.path.join(self.root, channel_id)
+
+    def _shard_path(self, channel_id: str, shard: int) -> str:
+        return os.path.join(self._channel_dir(channel_id), f"transcripts-{shard:05d}.bin")
+
+    def _index(self, channel_id: str) -> Dict[str, Dict[Tuple[str, str], dict]]:
+        """
+        Return the index of a channel, with the lines appended to its index file since the last call,
+        e.g. by another process. Called with the channel's lock held.
+        """
+        index = self._indexes.setdefault(channel_id, {})
+        path = os.path.join(self._channel_dir(channel_id), INDEX_FILE)
+        offset = self._index_offsets.get(channel_id, 0)
+        if not os.path.exists(path) or os.path.getsize(path) <= offset:
+            return index
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A line being appended, or torn by a crash: read it once it is terminated
+                    break
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A write interrupted by a crash
+                    logger.warning(f"Skipping a torn line of the transcript archive index of {channel_id}")
+                    continue
+                index.setdefault(entry["video_id"], {})[(entry["language"], entry["kind"])] = entry
+        self._index_offsets[channel_id] = offset
+        return index
+
+    def _lock_file(self, f: BinaryIO) -> None:
+        """Hold an exclusive lock on an open index file across processes, until it is closed."""
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _current_shard(self, channel_id: str, index: Dict[str, Dict[Tuple[str, str], dict]]) -> int:
+        shard = max((entry["shard"] for entries in index.values() for entry in entries.values()), default=0)
+        path = self._shard_path(channel_id, shard)
+        if os.path.exists(path) and os.path.getsize(path) >= self.shard_bytes:
+            shard += 1
+        return shard
+
+    def put(self, video: Video, language: str, kind: str) -> None:
+        """
+        Archive the transcript of a video.
+
+        Args:
+            video (Video): The video, with its channel and transcript.
+            language (str): The language code of the transcript.
+            kind (str): The kind of the transcript: "manual", "generated" or "translated".
+        """
+        channel_id = video.channel.id
+        blob = as_compact(video.transcript).to_bytes()
+        os.makedirs(self._channel_dir(channel_id), exist_ok=True)
+        with self._lock(channel_id), open(os.path.join(self._channel_dir(channel_id), INDEX_FILE), "ab+") as index_file:
+            # Other processes append to the channel's shards and index under the same lock
+            self._lock_file(index_file)
+            index = self._index(channel_id)
+            shard = self._current_shard(channel_id, index)
+            with open(self._shard_path(channel_id, shard), "ab") as f:
+                offset = f.tell()
+                f.write(blob)
+            entry = {"video_id": video.id,
+                     "language": language,
+                     "kind": kind,
+                     "shard": shard,
+                     "offset": offset,
+                     "length": len(blob),
+                     "title": video.title,
+                     "duration": video.duration,
+                     "fetched_at": datetime.now().isoformat()}
+            # The index line is written after the blob, so it never points at missing bytes
+            line = json.dumps(entry).encode("utf-8") + b"\n"
+            # Terminate a torn last line so it does not swallow this one
+            if index_file.seek(0, os.SEEK_END) > 0:
+                index_file.seek(-1, os.SEEK_END)
+                if index_file.read(1) != b"\n":
+                    line = b"\n" + line
+            index_file.write(line)
+            index_file.flush()
+            self.writes += 1
+
+    def _best_entry(self, entries: Dict[Tuple[str, str], dict], languages: List[str]) -> Optional[dict]:
+        """Return the entry of the preferred kind, then the preferred language, like `yt_utils.select_transcript`."""
+        ranked = [(TRANSCRIPT_KINDS.index(kind), languages.index(language), entry)
+                  for (language, kind), entry in entries.items()
+                  if language in languages and kind in TRANSCRIPT_KINDS]
+        return min(ranked, key=lambda item: item[:2])[2] if ranked else None
+
+    def _read(self, channel_id: str, entry: dict) -> CompactTranscript:
+        with open(self._shard_path(channel_id, entry["shard"]), "rb") as f:
+            f.seek(entry["offset"])
+            return CompactTranscript.from_bytes(f.read(entry["length"]))
+
+    def get(self, channel_id: str, video_id: str, languages: List[str]) -> Optional[Tuple[CompactTranscript, str, str]]:
+        """
+        Return the archived transcript of a video in the preferred languages.
+
+        Args:
+            channel_id (str): The ID of the channel of the video.
+            video_id (str): The ID of the video.
+            languages (List[str]): The preferred transcript languages.
+
+        Returns:
+            Optional[Tuple[CompactTranscript, str, str]]: The transcript with its language code and kind,
+                or None if it is not archived.
+        """
+        with self._lock(channel_id):
+            entry = self._best_entry(self._index(channel_id).get(video_id, {}), languages)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._read(channel_id, entry), entry["language"], entry["kind"]
+
+    def entries(self, channel_id: str, languages: List[str]) -> List[dict]:
+        """
+        Return the index entries of the channel's archived transcripts in the preferred languages,
+        one per video, without reading the transcripts.
+
+        Args:
+            channel_id (str): The ID of the channel.
+            languages (List[str]): The preferred transcript languages.
+
+        Returns:
+            List[dict]: The entries, with the video's title and duration.
+        """
+        with self._lock(channel_id):
+            return [entry for entry in (self._best_entry(entries, languages)
+                                        for entries in self._index(channel_id).values())
+                    if entry is not None]
+
+    def read_video(self, channel: Channel, entry: dict) -> Video:
+        """
+        Return the archived video of an index entry, with its transcript.
+
+        Args:
+            channel (Channel): The channel of the video.
+            entry (dict): The entry, see `entries`.
+
+        Returns:
+            Video: The video with a populated transcript.
+        """
+        return Video(id=entry["video_id"],
+                     title=entry["title"],
+                     duration=entry["duration"],
+                     channel=channel,
+                     transcript=self._read(channel.id, entry),
+                     transcript_language=entry["language"],
+                     transcript_kind=entry["kind"])
+
+    def videos(self, channel: Channel, languages: List[str]) -> Iterator[Video]:
+        """
+        Yield the channel's archived videos with their transcripts in the preferred languages,
+        reading one transcript at a time.
+
+        Args:
+            channel (Channel): The channel.
+            languages (List[str]): The preferred transcript languages.
+
+        Yields:
+            Video: The archived videos with a populated transcript.
+        """
+        for entry in self.entries(channel.id, languages):
+            yield self.read_video(channel, entry)
+
+    def stats(self) -> dict:
+        """Return the archive counters of this process."""
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes}
+
+def get_transcript_archive() -> Optional[TranscriptArchive]:
+    """Return the transcript archive, or None if it is disabled."""
+    return transcript_archive if transcript_archive_enabled() else None
+
+transcript_archive = TranscriptArchive()
+metrics.register_stats("transcript_archive", transcript_archive.stats)
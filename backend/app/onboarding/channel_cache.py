@@ -0,0 +1,89 @@
+"""
+In-process cache of channel metadata, as shown by the UI.
+
+Channels are looked up in batches with a single query per batch, and
+unknown ids are cached too. The onboarding workers run in other processes
+and cannot invalidate this cache, so the status changes they write, e.g. a
+channel becoming ACTIVE, are only picked up once the cached entry expires:
+after CHANNEL_CACHE_TTL seconds for active channels, and after the shorter
+CHANNEL_CACHE_PENDING_TTL seconds for the channels still being onboarded
+and the unknown ids. Changes made by this process invalidate the channel
+immediately.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+from typing import Dict, Iterable, Optional
+from beanie.operators import In
+
+from app.db.models import Channel, ChannelStatusEnum, ChannelView
+from app.utils.cache import TTLCache
+from app.utils.metrics import metrics
+
+_MISSING = object()
+
+class ChannelCache:
+    """
+    Cache of channel views with versioned invalidation, local to the process.
+
+    Every invalidation bumps the cache version and records it for the
+    channel, so a lookup that read the database before the invalidation
+    does not write the stale channel back.
+    """
+
+    def __init__(self,
+                 maxsize: int = int(os.environ.get('CHANNEL_CACHE_SIZE', 4096)),
+                 ttl: float = float(os.environ.get('CHANNEL_CACHE_TTL', 30)),
+                 pending_ttl: float = float(os.environ.get('CHANNEL_CACHE_PENDING_TTL', 5))) -> None:
+        """
+        Args:
+            maxsize (int): The maximum number of channels cached.
+            ttl (float): Seconds after which a cached active channel expires.
+            pending_ttl (float): Seconds after which a cached channel that is not active, or an unknown id, expires.
+        """
+        self.pending_ttl = pending_ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._invalidated = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.version = 0
+        self.queries = 0
+
+    async def get_many(self, channel_ids: Iterable[str]) -> Dict[str, Optional[ChannelView]]:
+        """
+        Return the channels of the ids, querying the database once for the ids not cached.
+
+        Args:
+            channel_ids (Iterable[str]): The IDs of the channels.
+
+        Returns:
+            Dict[str, Optional[ChannelView]]: The channel of each id, in order, or None if it does not exist.
+        """
+        channels = {channel_id: self._cache.get(channel_id, _MISSING) for channel_id in channel_ids}
+        misses = [channel_id for channel_id, channel in channels.items() if channel is _MISSING]
+        if misses:
+            version = self.version
+            self.queries += 1
+            found = {channel.id: channel
+                     for channel in await Channel.find(In(Channel.id, misses)).project(ChannelView).to_list()}
+            for channel_id in misses:
+                channel = found.get(channel_id)
+                channels[channel_id] = channel
+                # Skip channels invalidated while they were read
+                if self._invalidated.get(channel_id, -1) <= version:
+                    # Channels being onboarded by the workers change status soon
+                    active = channel is not None and channel.status == ChannelStatusEnum.ACTIVE
+                    self._cache.set(channel_id, channel, ttl=None if active else self.pending_ttl)
+        return channels
+
+    def invalidate(self, channel_id: str) -> None:
+        """Drop a channel whose metadata or status changed."""
+        self.version += 1
+        self._invalidated.set(channel_id, self.version)
+        self._cache.pop(channel_id)
+
+    def stats(self) -> dict:
+        """Return the cache counters and the number of database queries."""
+        return {**self._cache.stats(), "queries": self.queries, "version": self.version}
+
+channel_cache = ChannelCache()
+metrics.register_stats("channel_cache", channel_cache.stats)
@@ -0,0 +1,116 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+from functools import lru_cache
+from typing import Callable, List, Optional
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.utils import get_tokenizer
+
+from app.db.models import Video
+from app.db.transcript import CompactTranscript, as_compact
+
+# Node metadata kept for citations but left out of the embedded text
+TIMESTAMP_METADATA_KEYS = ["start_ms", "end_ms"]
+
+def transcript_text(video: Video) -> str:
+    """The full transcript text of a video."""
+    if isinstance(video.transcript, CompactTranscript):
+        return video.transcript.joined_text("\n")
+    return "\n".join(segment.text for segment in video.transcript or [])
+
+def node_id(video_id: str, i: int) -> str:
+    """Derive stable node ids from the video id, so re-upserting a video overwrites its vectors."""
+    return f"{video_id}:{i}"
+
+class TranscriptChunker:
+    """
+    Splits a video's transcript into nodes along segment boundaries.
+
+    Each segment is tokenised once and the chunks are built in a single pass
+    over the columns of the CompactTranscript, so no chunk ever cuts a
+    segment in half and every node carries the start and end timestamps of
+    the segments it covers.
+    """
+
+    def __init__(self,
+                 chunk_size: int = int(os.environ.get('TRANSCRIPT_CHUNK_SIZE', 1000)),
+                 chunk_overlap: int = int(os.environ.get('TRANSCRIPT_CHUNK_OVERLAP', 100)),
+                 tokenizer: Optional[Callable[[str], List]] = None) -> None:
+        """
+        Args:
+            chunk_size (int): The token budget of a chunk. A segment longer than the budget gets a chunk of its own.
+            chunk_overlap (int): The maximum number of tokens of trailing segments repeated at the start of the next chunk.
+            tokenizer (Callable, optional): Tokenises a text. Defaults to the llama_index tokenizer.
+        """
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer or get_tokenizer()
+
+    def _node(self, video: Video, i: int, texts: List[str], start_ms: int, end_ms: int,
+              chapter: Optional[str]) -> TextNode:
+        metadata = {"video_id": video.id,
+                    "video_title": video.title,
+                    "channel_id": video.channel.id if video.channel else None,
+                    "channel_title": video.channel.title if video.channel else None,
+                    "start_ms": start_ms,
+                    "end_ms": end_ms}
+        # Vector stores such as Pinecone reject null metadata values
+        if chapter:
+            metadata["chapter"] = chapter
+        return TextNode(id_=node_id(video.id, i),
+                        text="\n".join(texts),
+                        metadata=metadata,
+                        excluded_embed_metadata_keys=TIMESTAMP_METADATA_KEYS,
+                        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=video.id)})
+
+    def chunk(self, video: Video) -> List[TextNode]:
+        """
+        Split the transcript of a video into nodes.
+
+        Args:
+            video (Video): The video with its transcript.
+
+        Returns:
+            List[TextNode]: The nodes of the video, in transcript order.
+        """
+        transcript = as_compact(video.transcript)
+        chapters = transcript.chapter_of() if transcript.chapters else None
+        # Positions of the segments with a text
+        all_texts = transcript.texts()
+        segments = [i for i, text in enumerate(all_texts) if text]
+        texts = [all_texts[i] for i in segments]
+        # Tokenise each segment once, counting the newline joining it to the next one
+        tokens = [len(self.tokenizer(text)) + 1 for text in texts]
+
+        nodes = []
+        start, end, budget_used = 0, 0, 0
+        while start < len(segments):
+            # Extend the chunk while the next segment fits the budget
+            while end < len(segments) and (end == start or budget_used + tokens[end] <= self.chunk_size):
+                budget_used += tokens[end]
+                end += 1
+            nodes.append(self._node(video, len(nodes), texts[start:end],
+                                    transcript.starts[segments[start]],
+                                    transcript.ends[segments[end - 1]],
+                                    chapters[segments[start]] if chapters else None))
+            if end == len(segments):
+                break
+
+            # Start the next chunk with the trailing segments that fit the overlap
+            next_start, overlap = end, 0
+            while next_start - 1 > start and overlap + tokens[next_start - 1] <= self.chunk_overlap:
+                next_start -= 1
+                overlap += tokens[next_start]
+            start, budget_used = next_start, overlap
+        return nodes
+
+@lru_cache(maxsize=None)
+def _chunker(chunk_size: int, chunk_overlap: int) -> TranscriptChunker:
+    return TranscriptChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def chunk_video(video: Video, chunk_size: int, chunk_overlap: int) -> List[TextNode]:
+    """Split a video's transcript into nodes. Defined at module level so it can run in a process pool."""
+    return _chunker(chunk_size, chunk_overlap).chunk(video)
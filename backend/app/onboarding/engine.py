@@ -2,21 +2,36 @@ import logging
 logger = logging.getLogger(__name__)
 
 import os
-from typing import List, Optional, Tuple
-from llama_index import ServiceContext, StorageContext, VectorStoreIndex
-from llama_index.vector_stores.pinecone import PineconeVectorStore
+import asyncio
+from datetime import datetime
+from concurrent.futures import Executor
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+from pymongo.errors import DuplicateKeyError
+from llama_index import ServiceContext
+from llama_index.vector_stores.types import VectorStore
 from beanie.odm.operators.find.logical import And
-from beanie.operators import In
 from beanie.odm.enums import SortDirection
 
 from app.onboarding.reader import YTChannelReader
-from app.onboarding import yt_utils
+from app.onboarding.fetcher import FetchProgress, TranscriptFetcher
+from app.onboarding.jobs import enqueue_request, set_request_status
+from app.onboarding.chunker import transcript_text
+from app.onboarding.pipeline import OnboardingPipeline, PipelineCheckpoint, transcript_hash
+from app.onboarding.yt_async import youtube
+from app.onboarding.search import channel_search
+from app.onboarding.channel_cache import channel_cache
+from app.utils.embedding import get_embed_model
+from app.db.vector_store import delete_nodes, get_vector_store
 from app.db.models import (
                         Channel, 
+                        ChannelView,
                         ChannelOnBoardingRequest,
                         ChannelOnBoardingRequestStatusEnum,
                         ChannelStatusEnum,
-                        User
+                        User,
+                        Video,
+                        VideoIngestion,
+                        VideoIngestionStatusEnum
                         )
 
 async def search_for_channels(query: str, region: Optional[str]='US', limit: Optional[int]=5) -> List[Channel]:
@@ -32,7 +47,7 @@ async def search_for_channels(query: str, region: Optional[str]='US', limit: Opt
         List[Channel]: A list of channels that match the query.
     """
     try:
-        channel_list = yt_utils.search_channels(query, region, limit)
+        channel_list = await channel_search.search(query, region, limit)
     
         channels = []
         if channel_list:
@@ -51,24 +66,62 @@ async def search_for_channels(query: str, region: Optional[str]='US', limit: Opt
         logger.error(f"channel search failed for query: {query}", e)
         raise e
     
-async def get_channels(channel_ids: List[str]) -> Tuple[List[Channel], List[str]]:
+async def get_channels(channel_ids: List[str]) -> Tuple[List[ChannelView], List[str]]:
     """
-    Retrieve channels by their IDs.
+    Retrieve channels by their IDs, from the channel cache.
 
     Args:
     - channel_ids (List[str]): The IDs of the channels to retrieve.
 
     Returns:
-    - Tuple[List[Channel], List[str]]: A tuple containing the active channels with the specified IDs and a list of missing channel IDs.
+    - Tuple[List[ChannelView], List[str]]: A tuple containing the channels with the specified IDs and a list of missing channel IDs.
     """
-    # Retrieve active channels
-    channels = await Channel.find(In(Channel.id, channel_ids)).to_list()
-    
-    # Find missing channel IDs
-    missing_channel_ids = [channel_id for channel_id in channel_ids if channel_id not in [c.id for c in channels]]
-    
-    return channels, missing_channel_ids
+    channels = await channel_cache.get_many(channel_ids)
+    found = [channel for channel in channels.values() if channel is not None]
+    missing_channel_ids = [channel_id for channel_id, channel in channels.items() if channel is None]
+    return found, missing_channel_ids
+
+
+class DefaultChannelsSnapshot:
+    """In-process snapshot of the default channels, refreshed in the background."""
+
+    def __init__(self,
+                 limit: int = 5,
+                 refresh_interval: float = float(os.environ.get('DEFAULT_CHANNELS_REFRESH_INTERVAL', 300))) -> None:
+        """
+        Args:
+            limit (int): The number of default channels kept in the snapshot.
+            refresh_interval (float): Seconds between two refreshes of the snapshot.
+        """
+        self.limit = limit
+        self.refresh_interval = refresh_interval
+        self.channels: Optional[List[Channel]] = None
+
+    async def refresh(self) -> List[Channel]:
+        """Reload the default channels from the database."""
+        self.channels = await Channel.find(
+            Channel.status == ChannelStatusEnum.ACTIVE,
+            limit=self.limit,
+            sort=[("updated_at", SortDirection.ASCENDING)]
+        ).to_list()
+        return self.channels
 
+    async def get(self) -> List[Channel]:
+        """Return the snapshot, loading it on first use."""
+        if self.channels is None:
+            return await self.refresh()
+        return self.channels
+
+    async def run(self) -> None:
+        """Refresh the snapshot forever; meant to run as a background task."""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("Failed to refresh default channels", e)
+            await asyncio.sleep(self.refresh_interval)
+
+default_channels = DefaultChannelsSnapshot()
 
 async def get_default_channels(limit:int=5) -> List[Channel]:
     """
@@ -80,13 +133,36 @@ async def get_default_channels(limit:int=5) -> List[Channel]:
     Returns:
         List[Channel]: A list of default channels.
     """
-    return await Channel.find(
-        Channel.status == ChannelStatusEnum.ACTIVE,
-        limit=limit,
-        sort=[("updated_at", SortDirection.ASCENDING)]
-    ).to_list()
+    if limit > default_channels.limit:
+        return await Channel.find(
+            Channel.status == ChannelStatusEnum.ACTIVE,
+            limit=limit,
+            sort=[("updated_at", SortDirection.ASCENDING)]
+        ).to_list()
+    return (await default_channels.get())[:limit]
 
-async def get_user_channels(user_session_id: str) -> List[Channel]:
+async def get_or_create_user(user_session_id: str) -> User:
+    """
+    Retrieve the user of a session, creating it with the default channels on first use.
+
+    Args:
+        user_session_id (str): The ID of the user's session.
+
+    Returns:
+        User: The user of the session.
+    """
+    user = await User.get(user_session_id)
+    if user:
+        return user
+    try:
+        user = User(id=user_session_id,
+                    channels=set([c.id for c in await get_default_channels()]))
+        return await user.insert()
+    except DuplicateKeyError:
+        # A concurrent request of the same session created the user first
+        return await User.get(user_session_id)
+
+async def get_user_channels(user_session_id: str) -> List[ChannelView]:
     """
     Retrieve the channels added by the user.
 
@@ -94,7 +170,7 @@ async def get_user_channels(user_session_id: str) -> List[Channel]:
         user_session_id (str): The ID of the user's session.
 
     Returns:
-        List[Channel]: A list of Channel objects added by the user.
+        List[ChannelView]: A list of the channels added by the user.
     """
 
     # Check if the user session ID is provided
@@ -108,7 +184,7 @@ async def get_user_channels(user_session_id: str) -> List[Channel]:
 
     # If no user session ID is provided or the user has not added any channels,
     # return default channels
-    return await get_default_channels(limit=5)
+    return [ChannelView.model_validate(channel) for channel in await get_default_channels(limit=5)]
     
 
 async def create_onboarding_request(channel_id: str, requested_by: str) -> ChannelOnBoardingRequest:
@@ -128,7 +204,7 @@ async def create_onboarding_request(channel_id: str, requested_by: str) -> Chann
         #
         channel = await Channel.get(channel_id)
         if not channel:
-            channel_info = yt_utils.get_channel_info(channel_id)
+            channel_info = await youtube.get_channel_info(channel_id)
             channel = Channel(id=channel_info['id'],
                             title=channel_info['title'],
                             description=channel_info['description'],
@@ -137,9 +213,10 @@ async def create_onboarding_request(channel_id: str, requested_by: str) -> Chann
                             status=ChannelStatusEnum.INACTIVE
                             )
             await channel.save()
+            channel_cache.invalidate(channel.id)
             
         # Add channel to user
-        user = await User.get(requested_by)
+        user = await get_or_create_user(requested_by)
         user.channels.add(channel.id)
         await user.save()
 
@@ -158,23 +235,286 @@ async def create_onboarding_request(channel_id: str, requested_by: str) -> Chann
         logger.error(f"Failed to create onboarding request for {channel_id} as requested by {requested_by}", e)
         raise e
 
-async def process_onboarding_request(request: ChannelOnBoardingRequest) -> None:
+async def create_refresh_request(channel_id: str, requested_by: str, resync: bool = False,
+                                 incremental: bool = False) -> ChannelOnBoardingRequest:
+    """
+    Create a request to delta sync an onboarded channel with its latest uploads.
+
+    Args:
+        channel_id (str): The ID of the channel to refresh.
+        requested_by (str): The user who is requesting the refresh.
+        resync (bool): Also re-fetch the transcripts of indexed videos and re-index the changed ones.
+        incremental (bool): Only sync the uploads newer than the newest indexed video.
+
+    Returns:
+        ChannelOnBoardingRequest: The created refresh request.
+
+    Raises:
+        ValueError: If the channel is not found or not active.
+    """
+    channel = await Channel.get(channel_id)
+    if not channel or channel.status != ChannelStatusEnum.ACTIVE:
+        raise ValueError(f"Channel {channel_id} not found or not active")
+
+    request = ChannelOnBoardingRequest(channel_id=channel_id,
+                                       requested_by=requested_by,
+                                       status=ChannelOnBoardingRequestStatusEnum.QUEUED,
+                                       refresh=True,
+                                       resync=resync,
+                                       incremental=incremental)
+    return await enqueue_request(await request.insert())
+
+async def create_rebuild_request(channel_id: str, requested_by: str) -> ChannelOnBoardingRequest:
+    """
+    Create a request to re-index an onboarded channel from the transcript archive, e.g. after a chunking change.
+
+    Args:
+        channel_id (str): The ID of the channel to rebuild.
+        requested_by (str): The user who is requesting the rebuild.
+
+    Returns:
+        ChannelOnBoardingRequest: The created rebuild request.
+
+    Raises:
+        ValueError: If the channel is not found or not active.
+    """
+    channel = await Channel.get(channel_id)
+    if not channel or channel.status != ChannelStatusEnum.ACTIVE:
+        raise ValueError(f"Channel {channel_id} not found or not active")
+
+    request = ChannelOnBoardingRequest(channel_id=channel_id,
+                                       requested_by=requested_by,
+                                       status=ChannelOnBoardingRequestStatusEnum.QUEUED,
+                                       refresh=True,
+                                       rebuild=True)
+    return await enqueue_request(await request.insert())
+
+async def release_video(vector_store: VectorStore, entry: VideoIngestion, reason: str) -> None:
+    """
+    Delete the vectors of an indexed video before re-indexing it.
+
+    The entry is marked pending first, so a video whose new vectors are never
+    committed, e.g. after a crash, is fetched and indexed again by the next
+    sync instead of looking committed without vectors. Its chunk ids are only
+    cleared once deleted, so an interrupted deletion is retried.
+
+    Args:
+        vector_store (VectorStore): The vector store of the channel's namespace.
+        entry (VideoIngestion): The ledger entry of the video.
+        reason (str): Why the vectors are replaced.
+    """
+    await entry.set({VideoIngestion.status: VideoIngestionStatusEnum.PENDING,
+                     VideoIngestion.status_reason: reason})
+    await asyncio.to_thread(delete_nodes, vector_store, entry.id, entry.chunk_ids)
+    await entry.set({VideoIngestion.chunk_ids: []})
+
+def ledger_checkpoint(request: ChannelOnBoardingRequest,
+                      channel: Channel) -> Callable[[PipelineCheckpoint], Awaitable[None]]:
+    """
+    Return the pipeline checkpoint callback committing the ledger entries of the indexed videos.
+
+    Args:
+        request (ChannelOnBoardingRequest): The request being processed; progress is persisted on it.
+        channel (Channel): The channel being indexed.
+
+    Returns:
+        Callable: Awaited by the pipeline after each batch upserted to the vector store.
+    """
+    async def on_checkpoint(checkpoint: PipelineCheckpoint) -> None:
+        embedded_at = datetime.now()
+        for video in checkpoint.committed:
+            await VideoIngestion(id=video.video_id,
+                                 channel_id=channel.id,
+                                 transcript_hash=video.text_hash,
+                                 transcript_language=video.transcript_language,
+                                 transcript_kind=video.transcript_kind,
+                                 chunk_ids=video.node_ids,
+                                 embedded_at=embedded_at,
+                                 status=VideoIngestionStatusEnum.COMMITTED).save()
+        await request.set({ChannelOnBoardingRequest.videos_indexed: checkpoint.videos,
+                           ChannelOnBoardingRequest.nodes_indexed: checkpoint.nodes,
+                           ChannelOnBoardingRequest.checkpointed_at: embedded_at})
+    return on_checkpoint
+
+async def sync_channel_videos(request: ChannelOnBoardingRequest,
+                              channel: Channel,
+                              executor: Optional[Executor] = None) -> PipelineCheckpoint:
+    """
+    Index the channel's videos that are not in the ingestion ledger yet.
+
+    Committed videos are not fetched again, so an interrupted run resumes
+    after the last committed video and a refresh only fetches new uploads.
+    Videos that disappeared from the channel have their vectors deleted, and
+    re-fetched transcripts that did not change are not embedded again.
+
+    The uploads are streamed page by page, so transcripts are fetched as soon
+    as the first page arrives. An incremental sync stops listing at the first
+    indexed video; it does not detect removed videos.
+
+    Args:
+        request (ChannelOnBoardingRequest): The request being processed; progress is persisted on it.
+        channel (Channel): The channel to index.
+        executor (Executor, optional): Runs the CPU-bound chunking, e.g. a process pool.
+
+    Returns:
+        PipelineCheckpoint: The totals of the run.
+    """
+    vector_store = get_vector_store(channel.id)
+    reader = YTChannelReader(channel)
+    ledger = {entry.id: entry
+              for entry in await VideoIngestion.find(VideoIngestion.channel_id == channel.id).to_list()}
+    committed_video_ids = set(entry.id for entry in ledger.values()
+                              if entry.status == VideoIngestionStatusEnum.COMMITTED)
+
+    # Only fetch the videos that are new, failed before or were interrupted,
+    # unless a resync re-checks the transcripts of every video
+    listed_video_ids = set()
+    async def pending_videos() -> AsyncIterator[Video]:
+        newer_than = committed_video_ids if request.incremental else None
+        async for video in reader.aiter_videos(min_duration=60, newer_than=newer_than):
+            listed_video_ids.add(video.id)
+            if request.resync or video.id not in committed_video_ids:
+                yield video
+
+    # Persist the transcript fetch progress on the request
+    async def on_progress(progress: FetchProgress) -> None:
+        await request.set({ChannelOnBoardingRequest.videos_total: progress.total,
+                           ChannelOnBoardingRequest.videos_fetched: progress.fetched,
+                           ChannelOnBoardingRequest.videos_failed: progress.failed})
+
+    # Record videos without a usable transcript so they are retried by the next sync
+    async def on_failure(video_id: str, e: Exception) -> None:
+        entry = ledger.get(video_id)
+        if entry and entry.status == VideoIngestionStatusEnum.COMMITTED:
+            # Keep the indexed transcript of a video that could not be re-checked
+            return
+        if entry and entry.chunk_ids:
+            # Keep the ids of vectors a previous run did not finish deleting
+            await entry.set({VideoIngestion.status: VideoIngestionStatusEnum.FAILED,
+                             VideoIngestion.status_reason: str(e)})
+            return
+        await VideoIngestion(id=video_id,
+                             channel_id=channel.id,
+                             status=VideoIngestionStatusEnum.FAILED,
+                             status_reason=str(e)).save()
+
+    # Skip unchanged transcripts and drop the vectors of changed ones before re-indexing
+    async def changed_videos(fetched_videos: AsyncIterator[Video]) -> AsyncIterator[Video]:
+        async for video in fetched_videos:
+            entry = ledger.get(video.id)
+            if entry and entry.status == VideoIngestionStatusEnum.COMMITTED:
+                if entry.transcript_hash == transcript_hash(transcript_text(video)):
+                    continue
+                await release_video(vector_store, entry, "transcript changed")
+            elif entry and entry.chunk_ids:
+                await release_video(vector_store, entry, "interrupted re-index")
+            yield video
+
+    pipeline = OnboardingPipeline(vector_store,
+                                  service_context=ServiceContext.from_defaults(embed_model=get_embed_model()),
+                                  executor=executor)
+
+    # Stream the channel's transcripts through chunking, embedding and upserts.
+    # Archived transcripts are not downloaded again, unless a resync re-checks them.
+    fetched_videos = reader.alazy_load_videos(min_duration=60,
+                                              languages_preference=["en","en-IN"],
+                                              fetcher=TranscriptFetcher(use_archive=not request.resync),
+                                              on_progress=on_progress,
+                                              on_failure=on_failure,
+                                              videos=pending_videos())
+    checkpoint = await pipeline.run(changed_videos(fetched_videos), on_checkpoint=ledger_checkpoint(request, channel))
+    logger.info(f"Synced {len(listed_video_ids)} listed videos for channel: {channel.id}")
+
+    # Delete the vectors of videos that are no longer on the channel, once every upload was listed
+    if not request.incremental:
+        for entry in ledger.values():
+            if entry.id not in listed_video_ids and (entry.status == VideoIngestionStatusEnum.COMMITTED or entry.chunk_ids):
+                await asyncio.to_thread(delete_nodes, vector_store, entry.id, entry.chunk_ids)
+                await entry.set({VideoIngestion.status: VideoIngestionStatusEnum.DELETED,
+                                 VideoIngestion.chunk_ids: []})
+    return checkpoint
+
+async def rebuild_channel_from_archive(request: ChannelOnBoardingRequest,
+                                       channel: Channel,
+                                       executor: Optional[Executor] = None) -> PipelineCheckpoint:
+    """
+    Re-index the channel's archived transcripts, without any request to YouTube.
+
+    Every archived video is chunked and embedded again, e.g. after a change of
+    chunk size or embedding model, and its previous vectors are deleted first.
+    Indexed videos missing from the archive keep their vectors.
+
+    Args:
+        request (ChannelOnBoardingRequest): The request being processed; progress is persisted on it.
+        channel (Channel): The channel to re-index.
+        executor (Executor, optional): Runs the CPU-bound chunking, e.g. a process pool.
+
+    Returns:
+        PipelineCheckpoint: The totals of the run.
+
+    Raises:
+        ValueError: If the archive has no transcripts of the channel.
+    """
+    vector_store = get_vector_store(channel.id)
+    reader = YTChannelReader(channel)
+    # Archived transcripts are read one video at a time, as the pipeline consumes them
+    videos = reader.aiter_archived_videos(min_duration=60, languages_preference=["en","en-IN"])
+    first_video = await anext(videos, None)
+    if first_video is None:
+        raise ValueError(f"No archived transcripts for the channel: {channel.id}")
+    ledger = {entry.id: entry
+              for entry in await VideoIngestion.find(VideoIngestion.channel_id == channel.id).to_list()}
+    logger.info(f"Rebuilding the archived videos of channel: {channel.id}")
+
+    # Drop the previous vectors of each video before re-indexing it
+    async def replaced_videos() -> AsyncIterator[Video]:
+        video, read = first_video, 0
+        while video is not None:
+            entry = ledger.get(video.id)
+            if entry and (entry.status == VideoIngestionStatusEnum.COMMITTED or entry.chunk_ids):
+                await release_video(vector_store, entry, "rebuild")
+            read += 1
+            if read % 25 == 0:
+                await request.set({ChannelOnBoardingRequest.videos_fetched: read})
+            yield video
+            video = await anext(videos, None)
+        await request.set({ChannelOnBoardingRequest.videos_total: read,
+                           ChannelOnBoardingRequest.videos_fetched: read,
+                           ChannelOnBoardingRequest.videos_failed: 0})
+
+    pipeline = OnboardingPipeline(vector_store,
+                                  service_context=ServiceContext.from_defaults(embed_model=get_embed_model()),
+                                  executor=executor)
+    return await pipeline.run(replaced_videos(), on_checkpoint=ledger_checkpoint(request, channel))
+
+async def _set_processing_status(request: ChannelOnBoardingRequest, status: ChannelOnBoardingRequestStatusEnum) -> None:
+    """
+    Set the status of a request being processed by this worker.
+
+    Raises:
+        RuntimeError: If another worker took the request over.
+    """
+    if not await set_request_status(request, status):
+        raise RuntimeError(f"Lost the lease of onboarding request {request.id}")
+
+async def process_onboarding_request(request: ChannelOnBoardingRequest,
+                                     executor: Optional[Executor] = None) -> None:
     """
     Process the onboarding request for a channel.
 
     Args:
         request_id (str): The ID of the onboarding request to be processed.
+        executor (Executor, optional): Runs the CPU-bound chunking, e.g. a process pool.
 
     Returns:
         None
     """
     # Retrieve channel information and create a new Channel object
     try:
-        request.status = ChannelOnBoardingRequestStatusEnum.PROCESSING
-        await request.save()
+        await _set_processing_status(request, ChannelOnBoardingRequestStatusEnum.PROCESSING)
         channel = await Channel.get(request.channel_id)
         if not channel:
-            channel_info = yt_utils.get_channel_info(request.channel_id)
+            channel_info = await youtube.get_channel_info(request.channel_id)
             channel = Channel(id=channel_info['id'],
                             title=channel_info['title'],
                             description=channel_info['description'],
@@ -184,44 +524,37 @@ async def process_onboarding_request(request: ChannelOnBoardingRequest) -> None:
                             )
             await channel.save()
 
-        if channel.status == ChannelStatusEnum.ACTIVE:
-            request.status = ChannelOnBoardingRequestStatusEnum.COMPLETED
-            await request.save()
+        if channel.status == ChannelStatusEnum.ACTIVE and not request.refresh:
+            await _set_processing_status(request, ChannelOnBoardingRequestStatusEnum.COMPLETED)
             return
 
-        # Retrieve documents for the channel
-        video_documents = YTChannelReader(channel).load_data(min_duration=60, languages_preference=["en","en-IN"])
-        logger.info(f"Retrieved {len(video_documents)} videos with transcripts for channel: {request.channel_id}")
+        if request.rebuild:
+            # Re-index the archived transcripts, offline
+            checkpoint = await rebuild_channel_from_archive(request, channel, executor=executor)
+        else:
+            # Delta sync the channel's videos against the ingestion ledger
+            checkpoint = await sync_channel_videos(request, channel, executor=executor)
+        logger.info(f"Indexed {checkpoint.videos} videos with transcripts for channel: {request.channel_id}")
 
         # Check if videos are found for the channel
-        if not video_documents:
-            request.status = ChannelOnBoardingRequestStatusEnum.FAILED
-            await request.save()
+        if not await VideoIngestion.find(VideoIngestion.channel_id == channel.id,
+                                         VideoIngestion.status == VideoIngestionStatusEnum.COMMITTED).count():
+            await _set_processing_status(request, ChannelOnBoardingRequestStatusEnum.FAILED)
             raise ValueError(f"No videos found for the channel: {request.channel_id}")
 
-        # Set up service and storage contexts
-        service_context = ServiceContext.from_defaults(chunk_size=1000)
-
-        vector_store = PineconeVectorStore(api_key=os.environ['PINECONE_API_KEY'],
-                                        index_name=os.environ['VECTOR_STORE_INDEX_NAME'],
-                                        namespace=channel.id
-                                            )
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
-        # Index the documents in the vector store
-        VectorStoreIndex.from_documents(video_documents,
-                                    storage_context=storage_context,
-                                    service_context=service_context)
-        
+        # Bumping the index version invalidates the cached answers and retrievals of every process.
+        # The API processes read it again within INDEX_VERSION_TTL seconds; the cached chat indexes
+        # only hold handles to the namespace, so they serve the re-indexed vectors as they are.
+        # Their channel caches pick the new status up within CHANNEL_CACHE_PENDING_TTL seconds.
         channel.status = ChannelStatusEnum.ACTIVE
+        channel.index_version += 1
         await channel.save()
 
         # Update the status of the onboarding request to COMPLETED
-        request.status = ChannelOnBoardingRequestStatusEnum.COMPLETED
-        await request.save()
+        await _set_processing_status(request, ChannelOnBoardingRequestStatusEnum.COMPLETED)
     except Exception as e:
         # Update the status of the onboarding request to FAILED and raise the exception
         logger.error(f"Failed to process onboarding request {request.id}", e)
-        request.status = ChannelOnBoardingRequestStatusEnum.FAILED
-        await request.save()
+        # Only while the request is still leased by this worker
+        await set_request_status(request, ChannelOnBoardingRequestStatusEnum.FAILED)
         raise e
\ No newline at end of file
@@ -0,0 +1,243 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from app.db.models import Video
+from app.db.transcript import CompactTranscript
+from app.onboarding import yt_utils
+from app.onboarding.archive import TranscriptArchive, get_transcript_archive
+from app.onboarding.yt_async import youtube
+from app.utils.metrics import ONBOARDING_STAGE_SECONDS, RETRIES
+
+# Host serving the transcripts fetched by youtube_transcript_api
+TRANSCRIPT_HOST = "www.youtube.com"
+
+class TokenBucket:
+    """
+    Async token bucket pacing requests to a host.
+
+    The rate adapts to rate limiting: it is halved every time the host answers
+    with TooManyRequests and grows back additively on success (AIMD).
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = 0.2, max_rate: Optional[float] = None) -> None:
+        """
+        Args:
+            rate (float): Initial number of requests per second.
+            burst (int): Number of requests that may be sent back to back.
+            min_rate (float): Lower bound of the rate when throttled.
+            max_rate (float, optional): Upper bound of the rate. Defaults to the initial rate.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        """Wait until a request may be sent."""
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_throttled(self) -> None:
+        self.rate = max(self.min_rate, self.rate / 2)
+        # Drop the accumulated burst so the slowdown is immediate
+        self._tokens = min(self._tokens, 0)
+
+class FetchProgress:
+    """Counters of a transcript fetch run."""
+
+    def __init__(self, total: int = 0) -> None:
+        self.total = total
+        self.fetched = 0
+        # Fetched transcripts served by the archive instead of YouTube
+        self.archived = 0
+        self.failed = 0
+        self.throttled = 0
+
+    @property
+    def done(self) -> int:
+        return self.fetched + self.failed
+
+class TranscriptFetcher:
+    """Downloads the transcripts of many videos concurrently, paced per host."""
+
+    def __init__(self,
+                 concurrency: int = int(os.environ.get('TRANSCRIPT_FETCH_CONCURRENCY', 8)),
+                 rate: float = float(os.environ.get('TRANSCRIPT_FETCH_RATE', 5)),
+                 host_concurrency: Optional[Dict[str, int]] = None,
+                 host: str = TRANSCRIPT_HOST,
+                 max_attempts: int = 3,
+                 download: Optional[Callable[..., List[dict]]] = None,
+                 archive: Optional[TranscriptArchive] = None,
+                 use_archive: bool = True) -> None:
+        """
+        Args:
+            concurrency (int): The number of worker threads downloading transcripts.
+            rate (float): Initial requests per second per host; adapts to TooManyRequests.
+            host_concurrency (Dict[str, int], optional): Caps on in-flight requests per host.
+                Hosts without a cap are limited by `concurrency` only.
+            host (str): The host the transcripts are downloaded from.
+            max_attempts (int): Attempts per video when the host rate limits the client.
+            download (Callable, optional): Downloads the raw transcript segments of a video id, blocking.
+                Defaults to the async `youtube.download_transcript`, whose retries do not hold a thread.
+            archive (TranscriptArchive, optional): Serves archived transcripts and archives the downloaded ones.
+                Defaults to the transcript archive unless TRANSCRIPT_ARCHIVE_ENABLED is false.
+            use_archive (bool): False to download every transcript, still archiving them, e.g. on resync.
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.host = host
+        self.max_attempts = max_attempts
+        self.download = download
+        self.archive = archive or get_transcript_archive()
+        self.use_archive = use_archive
+        self._host_limits = {h: asyncio.Semaphore(n) for h, n in (host_concurrency or {}).items()}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _bucket(self, host: str) -> TokenBucket:
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(rate=self.rate, burst=self.concurrency)
+        return self._buckets[host]
+
+    async def _download_segments(self, executor: ThreadPoolExecutor, video_id: str,
+                                 languages: List[str]) -> Tuple[List[dict], Optional[str], Optional[str]]:
+        """Return the raw segments of a video with their language and kind, when known."""
+        if self.download is None:
+            return await youtube.download_transcript_with_source(video_id, languages, executor=executor)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.download, video_id, languages), None, None
+
+    async def _download(self, executor: ThreadPoolExecutor, video: Video, languages: List[str],
+                        progress: FetchProgress) -> Video:
+        """Download the transcript of a video, slowing down and retrying when rate limited."""
+        if self.archive and self.use_archive:
+            archived = await asyncio.to_thread(self.archive.get, video.channel.id, video.id, languages)
+            if archived is not None:
+                progress.archived += 1
+                video.transcript, video.transcript_language, video.transcript_kind = archived
+                return video
+
+        bucket = self._bucket(self.host)
+        host_limit = self._host_limits.get(self.host)
+        for attempt in range(1, self.max_attempts + 1):
+            await bucket.acquire()
+            try:
+                with ONBOARDING_STAGE_SECONDS.labels("fetch_transcript").time():
+                    if host_limit:
+                        async with host_limit:
+                            segments, language, kind = await self._download_segments(executor, video.id, languages)
+                    else:
+                        segments, language, kind = await self._download_segments(executor, video.id, languages)
+            except Exception as e:
+                if yt_utils.is_rate_limited(e) and attempt < self.max_attempts:
+                    progress.throttled += 1
+                    RETRIES.labels("fetch_rate_limited").inc()
+                    bucket.on_throttled()
+                    logger.warning(f"Rate limited by {self.host}, slowing down to {bucket.rate:.2f} req/s")
+                    continue
+                raise e
+            bucket.on_success()
+            video.transcript = CompactTranscript.from_raw(segments)
+            video.transcript_language, video.transcript_kind = language, kind
+            # Transcripts of a custom download callable have no known language or kind to archive them under
+            if self.archive and language is not None:
+                try:
+                    await asyncio.to_thread(self.archive.put, video, language, kind)
+                except Exception as e:
+                    logger.error(f"Failed to archive the transcript of video: {video.id}", e)
+            return video
+
+    async def fetch(self,
+                    videos: Union[Iterable[Video], AsyncIterable[Video]],
+                    languages: List[str],
+                    on_progress: Optional[Callable[[FetchProgress], Awaitable[None]]] = None,
+                    on_failure: Optional[Callable[[str, Exception], Awaitable[None]]] = None,
+                    progress_every: int = 25) -> AsyncIterator[Video]:
+        """
+        Download the transcripts of the videos, yielding each video as soon as its transcript is ready.
+
+        At most `2 * concurrency` downloads are in flight, so videos are consumed
+        lazily and results are yielded in completion order.
+
+        Args:
+            videos (Iterable[Video] or AsyncIterable[Video]): The videos to fetch the transcripts of.
+                The progress total of an async iterable grows as its videos are consumed.
+            languages (List[str]): The preferred transcript languages.
+            on_progress (Callable, optional): Awaited with the progress every `progress_every` videos and at the end.
+            on_failure (Callable, optional): Awaited with the video id and error of each failed video.
+            progress_every (int): The number of processed videos between two progress reports.
+
+        Yields:
+            Video: The videos with a populated transcript.
+        """
+        if isinstance(videos, AsyncIterable):
+            progress = FetchProgress()
+            pending_videos = aiter(videos)
+        else:
+            videos = list(videos)
+            progress = FetchProgress(total=len(videos))
+            pending_videos = iter(videos)
+        exhausted = False
+        in_flight: Dict[asyncio.Task, str] = {}
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="transcripts")
+        try:
+            while True:
+                # Keep the pipeline full without materialising every task up front
+                while not exhausted and len(in_flight) < 2 * self.concurrency:
+                    if isinstance(videos, AsyncIterable):
+                        video = await anext(pending_videos, None)
+                        progress.total += video is not None
+                    else:
+                        video = next(pending_videos, None)
+                    if video is None:
+                        exhausted = True
+                        break
+                    task = asyncio.create_task(self._download(executor, video, languages, progress))
+                    in_flight[task] = video.id
+                if not in_flight:
+                    break
+
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    video_id = in_flight.pop(task)
+                    try:
+                        video = task.result()
+                    except Exception as e:
+                        # Log an error if transcript retrieval fails
+                        progress.failed += 1
+                        logger.error(f"Failed to retrieve transcript for video: {video_id}")
+                        if on_failure:
+                            await on_failure(video_id, e)
+                    else:
+                        progress.fetched += 1
+                        if video.transcript:
+                            yield video
+                    if on_progress and progress.done % progress_every == 0:
+                        await on_progress(progress)
+            if on_progress:
+                await on_progress(progress)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            if hasattr(pending_videos, "aclose"):
+                await pending_videos.aclose()
@@ -0,0 +1,183 @@
+"""
+Persistent job queue of onboarding requests, backed by the onboarding_requests collection.
+
+Workers lease queued requests with an atomic find_one_and_update, keep the
+lease alive with heartbeats and retry failed requests with exponential
+backoff. A request whose lease expires (e.g. its worker crashed) becomes
+visible again and is taken over by another worker.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+from pymongo import ReturnDocument
+
+from app.db.models import ChannelOnBoardingRequest, ChannelOnBoardingRequestStatusEnum
+
+LEASE_SECONDS = int(os.environ.get('ONBOARDING_LEASE_SECONDS', 300))
+MAX_ATTEMPTS = int(os.environ.get('ONBOARDING_MAX_ATTEMPTS', 5))
+RETRY_BACKOFF_SECONDS = int(os.environ.get('ONBOARDING_RETRY_BACKOFF_SECONDS', 60))
+MAX_RETRY_BACKOFF_SECONDS = int(os.environ.get('ONBOARDING_MAX_RETRY_BACKOFF_SECONDS', 3600))
+
+def _collection():
+    return ChannelOnBoardingRequest.get_motor_collection()
+
+async def enqueue_request(request: ChannelOnBoardingRequest) -> ChannelOnBoardingRequest:
+    """
+    Queue an onboarding request for the workers.
+
+    Args:
+        request (ChannelOnBoardingRequest): The request to queue.
+
+    Returns:
+        ChannelOnBoardingRequest: The queued request.
+    """
+    await request.set({ChannelOnBoardingRequest.status: ChannelOnBoardingRequestStatusEnum.QUEUED,
+                       ChannelOnBoardingRequest.next_attempt_at: datetime.now(),
+                       ChannelOnBoardingRequest.attempts: 0,
+                       ChannelOnBoardingRequest.last_error: None,
+                       ChannelOnBoardingRequest.updated_at: datetime.now()})
+    return request
+
+async def lease_request(owner: str, lease_seconds: int = LEASE_SECONDS) -> Optional[ChannelOnBoardingRequest]:
+    """
+    Atomically lease the next due request.
+
+    Args:
+        owner (str): The id of the leasing worker.
+        lease_seconds (int): The visibility timeout; the lease must be renewed before it expires.
+
+    Returns:
+        ChannelOnBoardingRequest, optional: The leased request, or None if no request is due.
+    """
+    now = datetime.now()
+    document = await _collection().find_one_and_update(
+        {"$or": [
+            {"status": ChannelOnBoardingRequestStatusEnum.QUEUED.value, "next_attempt_at": {"$lte": now}},
+            {"status": ChannelOnBoardingRequestStatusEnum.PROCESSING.value, "lease_expires_at": {"$lt": now}}
+        ]},
+        {"$set": {"status": ChannelOnBoardingRequestStatusEnum.PROCESSING.value,
+                  "lease_owner": owner,
+                  "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                  "heartbeat_at": now,
+                  "updated_at": now},
+         "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if document is None:
+        return None
+    request = ChannelOnBoardingRequest.model_validate(document)
+
+    # Give up on requests that keep crashing their workers
+    if request.attempts > MAX_ATTEMPTS:
+        await fail_request(request, owner, request.last_error or "Lease expired too many times")
+        return None
+    return request
+
+async def renew_lease(request: ChannelOnBoardingRequest, owner: str, lease_seconds: int = LEASE_SECONDS) -> bool:
+    """
+    Extend the lease of a request held by the worker.
+
+    Args:
+        request (ChannelOnBoardingRequest): The leased request.
+        owner (str): The id of the worker holding the lease.
+        lease_seconds (int): The new visibility timeout.
+
+    Returns:
+        bool: False if the lease was lost to another worker.
+    """
+    now = datetime.now()
+    lease_expires_at = now + timedelta(seconds=lease_seconds)
+    result = await _collection().update_one({"_id": request.id, "lease_owner": owner},
+                                            {"$set": {"lease_expires_at": lease_expires_at, "heartbeat_at": now}})
+    if not result.matched_count:
+        return False
+    # Keep the in-memory request in sync so later saves do not roll the lease back
+    request.lease_expires_at = lease_expires_at
+    request.heartbeat_at = now
+    return True
+
+async def set_request_status(request: ChannelOnBoardingRequest, status: ChannelOnBoardingRequestStatusEnum) -> bool:
+    """
+    Set the status of a request being processed, without writing back the rest of the in-memory request.
+
+    The update only applies while the request is still leased by `request.lease_owner`, so a
+    worker that lost its lease cannot roll back the lease or the state of the new owner.
+
+    Args:
+        request (ChannelOnBoardingRequest): The request being processed.
+        status (ChannelOnBoardingRequestStatusEnum): The new status.
+
+    Returns:
+        bool: False if the lease was lost to another worker.
+    """
+    now = datetime.now()
+    result = await _collection().update_one({"_id": request.id, "lease_owner": request.lease_owner},
+                                            {"$set": {"status": status.value, "updated_at": now}})
+    if not result.matched_count:
+        return False
+    request.status = status
+    request.updated_at = now
+    return True
+
+async def _release(request: ChannelOnBoardingRequest, owner: str, fields: dict, inc: Optional[dict] = None) -> None:
+    update = {"$set": {"lease_owner": None, "lease_expires_at": None, "updated_at": datetime.now(), **fields}}
+    if inc:
+        update["$inc"] = inc
+    await _collection().update_one({"_id": request.id, "lease_owner": owner}, update)
+
+async def complete_request(request: ChannelOnBoardingRequest, owner: str) -> None:
+    """
+    Release the lease of a processed request, keeping the status set while processing it.
+
+    Args:
+        request (ChannelOnBoardingRequest): The processed request.
+        owner (str): The id of the worker holding the lease.
+    """
+    await _release(request, owner, {"last_error": None})
+
+async def fail_request(request: ChannelOnBoardingRequest, owner: str, error: str) -> None:
+    """
+    Mark a request as failed for good.
+
+    Args:
+        request (ChannelOnBoardingRequest): The leased request.
+        owner (str): The id of the worker holding the lease.
+        error (str): The error of the last attempt.
+    """
+    logger.error(f"Giving up on onboarding request {request.id} after {request.attempts} attempts: {error}")
+    await _release(request, owner, {"status": ChannelOnBoardingRequestStatusEnum.FAILED.value,
+                                    "last_error": error})
+
+async def retry_request(request: ChannelOnBoardingRequest, owner: str, error: str) -> None:
+    """
+    Queue a failed request again with exponential backoff, or fail it after MAX_ATTEMPTS attempts.
+
+    Args:
+        request (ChannelOnBoardingRequest): The leased request.
+        owner (str): The id of the worker holding the lease.
+        error (str): The error of the attempt.
+    """
+    if request.attempts >= MAX_ATTEMPTS:
+        await fail_request(request, owner, error)
+        return
+    backoff = min(MAX_RETRY_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** (request.attempts - 1))
+    logger.warning(f"Retrying onboarding request {request.id} in {backoff}s (attempt {request.attempts}): {error}")
+    await _release(request, owner, {"status": ChannelOnBoardingRequestStatusEnum.QUEUED.value,
+                                    "next_attempt_at": datetime.now() + timedelta(seconds=backoff),
+                                    "last_error": error})
+
+async def release_request(request: ChannelOnBoardingRequest, owner: str) -> None:
+    """
+    Hand a request back to the queue without counting the attempt, e.g. on worker shutdown.
+
+    Args:
+        request (ChannelOnBoardingRequest): The leased request.
+        owner (str): The id of the worker holding the lease.
+    """
+    await _release(request, owner, {"status": ChannelOnBoardingRequestStatusEnum.QUEUED.value,
+                                    "next_attempt_at": datetime.now()},
+                   inc={"attempts": -1})
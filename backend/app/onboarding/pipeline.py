@@ -0,0 +1,158 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import asyncio
+import hashlib
+from concurrent.futures import Executor
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+from llama_index import ServiceContext
+from llama_index.schema import BaseNode, MetadataMode
+from llama_index.vector_stores.types import VectorStore
+
+from app.db.models import Video
+from app.onboarding.chunker import chunk_video, transcript_text
+from app.utils.metrics import ONBOARDING_STAGE_SECONDS
+
+def transcript_hash(text: str) -> str:
+    """Hash of a video's transcript text, used to skip unchanged transcripts."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class CommittedVideo:
+    """A video whose nodes were upserted to the vector store."""
+
+    def __init__(self, video_id: str, node_ids: List[str], text_hash: str,
+                 transcript_language: Optional[str] = None, transcript_kind: Optional[str] = None) -> None:
+        self.video_id = video_id
+        self.node_ids = node_ids
+        self.text_hash = text_hash
+        # The transcript track the nodes were chunked from
+        self.transcript_language = transcript_language
+        self.transcript_kind = transcript_kind
+
+class PipelineCheckpoint:
+    """Progress of an onboarding pipeline run, reported after each committed batch."""
+
+    def __init__(self) -> None:
+        self.videos = 0
+        self.nodes = 0
+        # The videos committed by the last batch
+        self.committed: List[CommittedVideo] = []
+
+class OnboardingPipeline:
+    """
+    Streams videos through chunking, embedding and vector store upserts in bounded batches.
+
+    Videos are consumed as they are produced and whole videos are committed
+    per batch, so memory stays flat regardless of the channel size and a
+    failure only loses the batch in flight.
+    """
+
+    def __init__(self,
+                 vector_store: VectorStore,
+                 service_context: ServiceContext,
+                 batch_size: int = int(os.environ.get('ONBOARDING_BATCH_SIZE', 200)),
+                 queue_size: int = 16,
+                 chunk_size: int = int(os.environ.get('TRANSCRIPT_CHUNK_SIZE', 1000)),
+                 chunk_overlap: int = int(os.environ.get('TRANSCRIPT_CHUNK_OVERLAP', 100)),
+                 executor: Optional[Executor] = None) -> None:
+        """
+        Args:
+            vector_store (VectorStore): The vector store of the channel's namespace.
+            service_context (ServiceContext): Provides the embedding model.
+            batch_size (int): The number of nodes buffered before a batch is embedded and upserted.
+            queue_size (int): The number of videos read ahead of the chunking stage.
+            chunk_size (int): The token budget of a chunk.
+            chunk_overlap (int): The maximum number of overlapping tokens between consecutive chunks.
+            executor (Executor, optional): Runs the CPU-bound chunking, e.g. a process pool.
+                Chunking runs on the event loop when not set.
+        """
+        self.vector_store = vector_store
+        self.service_context = service_context
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.executor = executor
+
+    async def chunk(self, video: Video) -> List[BaseNode]:
+        """Split a video's transcript into nodes, in the executor when one is set."""
+        if self.executor is None:
+            return chunk_video(video, self.chunk_size, self.chunk_overlap)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, chunk_video, video, self.chunk_size, self.chunk_overlap)
+
+    async def embed(self, nodes: List[BaseNode]) -> None:
+        """Embed the nodes in place; the embedding model batches and caches the requests."""
+        embeddings = await self.service_context.embed_model.aget_text_embedding_batch(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+
+    async def upsert(self, nodes: List[BaseNode]) -> None:
+        """Upsert embedded nodes to the vector store off the event loop."""
+        await asyncio.to_thread(self.vector_store.add, nodes)
+
+    async def _commit(self, nodes: List[BaseNode], videos: List[CommittedVideo], checkpoint: PipelineCheckpoint,
+                      on_checkpoint: Optional[Callable[[PipelineCheckpoint], Awaitable[None]]]) -> None:
+        with ONBOARDING_STAGE_SECONDS.labels("embed").time():
+            await self.embed(nodes)
+        with ONBOARDING_STAGE_SECONDS.labels("upsert").time():
+            await self.upsert(nodes)
+        checkpoint.videos += len(videos)
+        checkpoint.nodes += len(nodes)
+        checkpoint.committed = videos
+        if on_checkpoint:
+            with ONBOARDING_STAGE_SECONDS.labels("checkpoint").time():
+                await on_checkpoint(checkpoint)
+
+    async def run(self,
+                  videos: AsyncIterator[Video],
+                  on_checkpoint: Optional[Callable[[PipelineCheckpoint], Awaitable[None]]] = None
+                  ) -> PipelineCheckpoint:
+        """
+        Index the videos.
+
+        Args:
+            videos (AsyncIterator[Video]): The videos with their transcripts, e.g. from YTChannelReader.alazy_load_videos.
+            on_checkpoint (Callable, optional): Awaited after each committed batch.
+
+        Returns:
+            PipelineCheckpoint: The totals of the run.
+        """
+        # Read videos ahead in the background so fetching overlaps embedding
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        done = object()
+
+        async def produce():
+            try:
+                async for video in videos:
+                    await queue.put(video)
+            finally:
+                await queue.put(done)
+
+        producer = asyncio.create_task(produce())
+        checkpoint = PipelineCheckpoint()
+        nodes: List[BaseNode] = []
+        committed: List[CommittedVideo] = []
+        try:
+            while (video := await queue.get()) is not done:
+                with ONBOARDING_STAGE_SECONDS.labels("chunk").time():
+                    video_nodes = await self.chunk(video)
+                nodes.extend(video_nodes)
+                committed.append(CommittedVideo(video_id=video.id,
+                                                node_ids=[node.node_id for node in video_nodes],
+                                                text_hash=transcript_hash(transcript_text(video)),
+                                                transcript_language=video.transcript_language,
+                                                transcript_kind=video.transcript_kind))
+                # Commit whole videos once the batch is full
+                if len(nodes) >= self.batch_size:
+                    await self._commit(nodes, committed, checkpoint, on_checkpoint)
+                    nodes, committed = [], []
+            if committed:
+                await self._commit(nodes, committed, checkpoint, on_checkpoint)
+            # Surface errors raised while reading the videos
+            await producer
+        finally:
+            producer.cancel()
+        return checkpoint
@@ -1,11 +1,17 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from typing import List, Any, Optional
+import asyncio
+from typing import List, Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Container, Iterator, Optional, Union
 from llama_index.readers.schema.base import Document
 from llama_index.readers.base import BaseReader
-from app.db.models import Channel, Video, TranscriptSegment
+from app.db.models import Video
+from app.db.transcript import CompactTranscript
 from app.onboarding import yt_utils
+from app.onboarding.yt_async import youtube
+from app.onboarding.fetcher import TranscriptFetcher, FetchProgress
+from app.onboarding.archive import TranscriptArchive, get_transcript_archive
+from app.onboarding.chunker import transcript_text
 
 class YTChannelReader(BaseReader):
     """Class to convert YT channel id to Document objects for reader."""
@@ -14,50 +20,161 @@ class YTChannelReader(BaseReader):
         super().__init__()
         self.channel = channel
         
-    def _fetch_videos(self, min_duration: int = 0
-                      , languages_preference: List[str] = ["en","en-IN"]
-                      ) -> List[Video]:
+    def _to_video(self, video_info: dict) -> Video:
+        """Create the Video object of an upload filtered by `yt_utils.filter_videos`, without transcript."""
+        return Video(id=video_info['id'],
+                     title=video_info['title'],
+                     channel=self.channel,
+                     duration=video_info['duration_seconds'],
+                     )
+
+    async def aiter_videos(self, min_duration: int = 0,
+                           newer_than: Optional[Container[str]] = None) -> AsyncIterator[Video]:
+        """
+        Streams the videos of the channel, newest first, without transcripts, as the uploads are paged through.
+
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            newer_than (Container[str], optional): Stop at the first of these video ids, e.g. the indexed
+                videos of an incremental sync.
+
+        Yields:
+            Video: The videos of the channel.
+        """
+        count = 0
+        async for video_info in youtube.iter_channel_videos(self.channel.id, min_duration, newer_than):
+            count += 1
+            yield self._to_video(video_info)
+        logger.info("Retrieved %d videos for channel: %s", count, self.channel.id)
+
+    async def alist_videos(self, min_duration: int = 0) -> List[Video]:
         """
-        Retrieves all videos from a given channel and returns a list of Video objects.
+        Retrieves the videos of the channel, without transcripts.
 
         Args:
-            channel (Channel): The channel from which to retrieve videos.
+            min_duration (int): Videos shorter than this many seconds are skipped.
 
         Returns:
-            List[Video]: A list of Video objects from the specified channel.
+            List[Video]: The videos of the channel.
         """
+        return [video async for video in self.aiter_videos(min_duration)]
 
-        video_info_list = yt_utils.get_channel_videos(self.channel.id)
-        # Log the number of retrieved videos and create Video objects
-        logger.info("Retrieved %d videos for channel: %s", len(video_info_list), self.channel.id)
-        videos = [Video(id=video['id'],
-                        title=video['title'],
-                        channel=self.channel,
-                        duration=yt_utils.duration_str_to_seconds(video['duration']),
-                        )
-                    for video in video_info_list]
+    async def alazy_load_videos(self, min_duration: int = 0
+                                , languages_preference: List[str] = ["en","en-IN"]
+                                , fetcher: Optional[TranscriptFetcher] = None
+                                , on_progress: Optional[Callable[[FetchProgress], Awaitable[None]]] = None
+                                , on_failure: Optional[Callable[[str, Exception], Awaitable[None]]] = None
+                                , videos: Optional[Union[List[Video], AsyncIterable[Video]]] = None
+                                ) -> AsyncIterator[Video]:
+        """
+        Concurrently retrieves the videos of the channel with their transcripts.
+
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            languages_preference (List[str]): The preferred transcript languages.
+            fetcher (TranscriptFetcher, optional): The fetcher downloading the transcripts.
+            on_progress (Callable, optional): Awaited with the fetch progress.
+            on_failure (Callable, optional): Awaited with the video id and error of each failed video.
+            videos (List[Video] or AsyncIterable[Video], optional): The videos to fetch.
+                Defaults to all videos of the channel, streamed so fetching starts with the first page.
+
+        Yields:
+            Video: The videos with a populated transcript, in completion order.
+        """
+        if videos is None:
+            videos = self.aiter_videos(min_duration)
+
+        logger.info(f"Retrieveing transcripts of videos from channel_id:{self.channel.id}")
+        fetcher = fetcher or TranscriptFetcher()
+        async for video in fetcher.fetch(videos, languages_preference, on_progress=on_progress, on_failure=on_failure):
+            yield video
+
+    async def aiter_archived_videos(self, min_duration: int = 0
+                                    , languages_preference: List[str] = ["en","en-IN"]
+                                    , archive: Optional[TranscriptArchive] = None
+                                    ) -> AsyncIterator[Video]:
+        """
+        Streams the channel's videos from the transcript archive, without any request to YouTube.
 
-        # Filter out videos that are too short
-        videos = [video for video in videos if video.duration > min_duration]
+        Transcripts are read off the event loop one video at a time, as the videos are consumed.
 
-        logger.info(f"Retrieveing transcript for {len(videos)} videos from channel_id:{self.channel.id}")
-        # Retrieve and populate the transcript for each video
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            languages_preference (List[str]): The preferred transcript languages.
+            archive (TranscriptArchive, optional): The archive to read. Defaults to the transcript archive.
+
+        Yields:
+            Video: The archived videos with a populated transcript.
+
+        Raises:
+            ValueError: If the transcript archive is disabled.
+        """
+        archive = archive or get_transcript_archive()
+        if archive is None:
+            raise ValueError("The transcript archive is disabled")
+        entries = await asyncio.to_thread(archive.entries, self.channel.id, languages_preference)
+        entries = [entry for entry in entries if (entry["duration"] or 0) > min_duration]
+        logger.info(f"Streaming {len(entries)} archived videos for channel_id:{self.channel.id}")
+        for entry in entries:
+            yield await asyncio.to_thread(archive.read_video, self.channel, entry)
+
+    def _fetch_videos(self, min_duration: int = 0
+                      , languages_preference: List[str] = ["en","en-IN"]
+                      ) -> Iterator[Video]:
+        """
+        Retrieves the videos of the channel one at a time, with their transcripts.
+
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            languages_preference (List[str]): The preferred transcript languages.
+
+        Yields:
+            Video: The videos with a populated transcript.
+        """
+
+        # Page through the uploads, requesting the next page once the videos of the current one are processed
+        videos = (self._to_video(video_info)
+                  for page in yt_utils.iter_channel_video_pages(self.channel.id)
+                  for video_info in yt_utils.filter_videos(page, min_duration)[0])
+
+        logger.info(f"Retrieveing transcripts of videos from channel_id:{self.channel.id}")
+        # Retrieve and populate the transcript for each video, from the archive when it has it
+        archive = get_transcript_archive()
         for video in videos:
+            archived = archive.get(self.channel.id, video.id, languages_preference) if archive else None
+            if archived is not None:
+                video.transcript, video.transcript_language, video.transcript_kind = archived
+                yield video
+                continue
             try:
-                video.transcript = [
-                    TranscriptSegment(text=segment['text'],
-                                      start_ms=int(segment['start']*1000),
-                                      end_ms=int((segment['start']
-                                                  + segment['duration'])*1000))
-                                    for segment in 
-                                    yt_utils.download_transcript(video.id, languages=languages_preference)
-                                    ]
+                video.transcript = CompactTranscript.from_raw(
+                    yt_utils.download_transcript(video.id, languages=languages_preference))
             except Exception as e:
                 # Log an error if transcript retrieval fails
                 logger.error(f"Failed to retrieve transcript for video: {video.id}")
 
-        # Return only the videos with a populated transcript
-        return [video for video in videos if video.transcript]
+            # Yield only the videos with a populated transcript
+            if video.transcript:
+                yield video
+
+    def lazy_load_data(
+        self,
+        min_duration: Optional[int],
+        languages_preference: Optional[List[str]],
+        **load_kwargs: Any,
+    ) -> Iterator[Document]:
+        """
+        Load the channel's videos one document per video, as they are fetched.
+
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            languages_preference (List[str]): The preferred transcript languages.
+
+        Yields:
+            Document: A Document containing the transcribed text and extra information of a video.
+        """
+        for video in self._fetch_videos(min_duration=min_duration, languages_preference=languages_preference):
+            yield self._to_document(video)
 
     def load_data(
         self,
@@ -74,15 +191,70 @@ class YTChannelReader(BaseReader):
         Returns:
             List[Document]: A list of Document objects containing the transcribed text and extra information.
         """
-        videos = self._fetch_videos(min_duration=min_duration, languages_preference=languages_preference)
-        results = []
-        for video in videos:
-            chunk_text = [chunk.text for chunk in video.transcript]
-            transcript = "\n".join(chunk_text)
-            results.append(Document(text=transcript, extra_info={"video_id": video.id
-                                                                 ,'video_title': video.title
-                                                                 , "channel_id": video.channel.id
-                                                                 ,'channel_title': video.channel.title
-                                                                 }))
-        return results
+        return list(self.lazy_load_data(min_duration=min_duration, languages_preference=languages_preference))
+
+    async def alazy_load_data(
+        self,
+        min_duration: Optional[int],
+        languages_preference: Optional[List[str]],
+        fetcher: Optional[TranscriptFetcher] = None,
+        on_progress: Optional[Callable[[FetchProgress], Awaitable[None]]] = None,
+        on_failure: Optional[Callable[[str, Exception], Awaitable[None]]] = None,
+        videos: Optional[Union[List[Video], AsyncIterable[Video]]] = None,
+        **load_kwargs: Any,
+    ) -> AsyncIterator[Document]:
+        """
+        Load the channel's videos with concurrently fetched transcripts, one document per video.
+
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            languages_preference (List[str]): The preferred transcript languages.
+            fetcher (TranscriptFetcher, optional): The fetcher downloading the transcripts.
+            on_progress (Callable, optional): Awaited with the fetch progress.
+            on_failure (Callable, optional): Awaited with the video id and error of each failed video.
+            videos (List[Video] or AsyncIterable[Video], optional): The videos to load. Defaults to all videos of the channel.
+
+        Yields:
+            Document: A Document per video, in completion order.
+        """
+        async for video in self.alazy_load_videos(min_duration=min_duration,
+                                               languages_preference=languages_preference,
+                                               fetcher=fetcher,
+                                               on_progress=on_progress,
+                                               on_failure=on_failure,
+                                               videos=videos):
+            yield self._to_document(video)
+
+    async def aload_data(
+        self,
+        min_duration: Optional[int],
+        languages_preference: Optional[List[str]],
+        fetcher: Optional[TranscriptFetcher] = None,
+        on_progress: Optional[Callable[[FetchProgress], Awaitable[None]]] = None,
+        **load_kwargs: Any,
+    ) -> List[Document]:
+        """
+        Load the channel's videos with concurrently fetched transcripts as documents.
+
+        Args:
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            languages_preference (List[str]): The preferred transcript languages.
+            fetcher (TranscriptFetcher, optional): The fetcher downloading the transcripts.
+            on_progress (Callable, optional): Awaited with the fetch progress.
+
+        Returns:
+            List[Document]: A list of Document objects containing the transcribed text and extra information.
+        """
+        return [document async for document in self.alazy_load_data(min_duration=min_duration,
+                                                                    languages_preference=languages_preference,
+                                                                    fetcher=fetcher,
+                                                                    on_progress=on_progress)]
+
+    def _to_document(self, video: Video) -> Document:
+        """Convert a video with its transcript to a Document."""
+        return Document(id_=video.id, text=transcript_text(video), extra_info={"video_id": video.id
+                                                                   ,'video_title': video.title
+                                                                   , "channel_id": video.channel.id
+                                                                   ,'channel_title': video.channel.title
+                                                                   })
     
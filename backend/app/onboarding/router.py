@@ -5,16 +5,23 @@ from typing import Optional, List
 from fastapi import APIRouter, HTTPException, Request, Body
 
 from app.onboarding.engine import (create_onboarding_request,
-                                   process_onboarding_request,
+                                   create_refresh_request,
+                                   create_rebuild_request,
                                    search_for_channels,
                                    get_user_channels,
-                                   get_channels
+                                   get_channels,
+                                   get_or_create_user
                                    )
 from app.db.models import (Channel,
+                           ChannelView,
                            ChannelOnBoardingRequest,
-                           ChannelOnBoardingRequestStatusEnum,
-                           User
+                           ChannelOnBoardingRequestStatusEnum
                            )
+from app.onboarding.jobs import enqueue_request
+from app.onboarding.search import channel_search
+from app.onboarding.channel_cache import channel_cache
+from app.onboarding.yt_async import youtube
+from app.utils.session import get_session_id
 
 onboard_router = APIRouter()
 
@@ -40,7 +47,7 @@ async def search_channels(query: str
     
 @onboard_router.post("/channel_details/")
 async def channel_details(request: Request,
-                     channel_id: str = Body(..., embed=True)) -> Channel:
+                     channel_id: str = Body(..., embed=True)) -> ChannelView:
     """
     Retrieves the channel with the given channel_id if it is active.
 
@@ -66,7 +73,7 @@ async def channel_details(request: Request,
         raise HTTPException(status_code=404, detail=f"Channel {channel_id} not found or not active")
 
 @onboard_router.post("/user_channels")
-async def user_channels(request: Request) -> List[Channel]:
+async def user_channels(request: Request) -> List[ChannelView]:
     """
     Retrieves the added channels for the user session.
 
@@ -74,10 +81,10 @@ async def user_channels(request: Request) -> List[Channel]:
         request (Request): The incoming request.
 
     Returns:
-        List[Channel]: The list of top channels.
+        List[ChannelView]: The list of top channels.
     """
     # Get the user session ID from the request cookies
-    user_session_id = request.cookies.get('sessionId')
+    user_session_id = get_session_id(request)
 
     # Return the list of channels
     return await get_user_channels(user_session_id)
@@ -95,15 +102,13 @@ async def remove_user_channel(request: Request, channel_id: str = Body(..., embe
         None
     """
     # Get the user session ID from the request cookies
-    user_session_id = request.cookies.get('sessionId')
+    user_session_id = get_session_id(request)
     # Remove the channel from the user's list of channels
-    user = await User.get(user_session_id)
-    if user and user.channels:
-        user.channels.remove(channel_id)
+    user = await get_or_create_user(user_session_id)
+    if user.channels:
+        user.channels.discard(channel_id)
         await user.save()
-        return 
-    else:
-        return HTTPException(status_code=404, detail=f"User {user_session_id} not found")
+    return
 
 @onboard_router.post("/initiate_request")
 async def initiate_request(request: Request,
@@ -121,7 +126,7 @@ async def initiate_request(request: Request,
     """
     #TODO: Restrict access only to logged-in users
     # Get the user session ID from the request cookies
-    user_session_id = request.cookies.get('sessionId')
+    user_session_id = get_session_id(request)
     try:
         return await create_onboarding_request(channel_id, requested_by=user_session_id)
     except Exception as e:
@@ -131,7 +136,7 @@ async def initiate_request(request: Request,
 async def process_request(request: Request,
                           request_id: str = Body(..., embed=True)) -> dict:
     """
-    Process an onboarding request and returns a dictionary with a message and the request_id.
+    Queue an onboarding request for the onboarding workers and returns a dictionary with a message and the request_id.
 
     Parameters:
     - request_id: a string representing the ID of the onboarding request
@@ -153,18 +158,91 @@ async def process_request(request: Request,
         raise HTTPException(status_code=404, detail=f"Onboarding request ({onboarding_request.id}) is not in the QUEUED state. Request status: {onboarding_request.status}")
 
     # Check if the channel has already been onboarded
-    existingRequest = await ChannelOnBoardingRequest.find_one(ChannelOnBoardingRequest.channel_id == onboarding_request.channel_id)
-    if existingRequest and existingRequest.status == ChannelOnBoardingRequestStatusEnum.COMPLETED:
+    existingRequest = await ChannelOnBoardingRequest.find_one(
+        ChannelOnBoardingRequest.channel_id == onboarding_request.channel_id,
+        ChannelOnBoardingRequest.status == ChannelOnBoardingRequestStatusEnum.COMPLETED)
+    if existingRequest:
         onboarding_request.status = ChannelOnBoardingRequestStatusEnum.COMPLETED
         await onboarding_request.save()
-        raise HTTPException(status_code=404, detail=f"Channel {onboarding_request.channel_id} for request {onboarding_request.id} has already been onboarded. Channel status: {channel.status}")
+        raise HTTPException(status_code=404, detail=f"Channel {onboarding_request.channel_id} for request {onboarding_request.id} has already been onboarded by request {existingRequest.id}")
 
     try:
-        await process_onboarding_request(onboarding_request)
+        await enqueue_request(onboarding_request)
         return {
-            "message": f"Onboarding request successfully processed!",
+            "message": "Onboarding request successfully queued!",
             "request_id": request_id
         }
     except Exception as e:
-        raise HTTPException(status_code=500, detail="Request processing failed")
-    
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Request queueing failed")
+    
+
+@onboard_router.post("/refresh_channel")
+async def refresh_channel(request: Request,
+                          channel_id: str = Body(..., embed=True),
+                          resync: bool = Body(False, embed=True),
+                          incremental: bool = Body(False, embed=True)) -> dict:
+    """
+    Queue a delta sync of an onboarded channel: index its new uploads and delete the vectors of removed videos.
+
+    Parameters:
+    - channel_id: a string representing the ID of the channel
+    - resync: also re-fetch the transcripts of indexed videos and re-index the changed ones
+    - incremental: only list the uploads newer than the newest indexed video, without deleting removed videos
+
+    Returns:
+    - a dictionary with keys "message" and "request_id"
+    """
+    # TODO: Restrict access only to admins
+    user_session_id = get_session_id(request)
+    try:
+        onboarding_request = await create_refresh_request(channel_id, requested_by=user_session_id,
+                                                          resync=resync, incremental=incremental)
+        return {
+            "message": "Channel refresh successfully queued!",
+            "request_id": str(onboarding_request.id)
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception:
+        raise HTTPException(status_code=500, detail="Channel refresh failed")
+
+@onboard_router.post("/rebuild_channel")
+async def rebuild_channel(request: Request,
+                          channel_id: str = Body(..., embed=True)) -> dict:
+    """
+    Queue a re-index of an onboarded channel from the transcript archive, without downloading its transcripts again.
+
+    Parameters:
+    - channel_id: a string representing the ID of the channel
+
+    Returns:
+    - a dictionary with keys "message" and "request_id"
+    """
+    # TODO: Restrict access only to admins
+    user_session_id = get_session_id(request)
+    try:
+        onboarding_request = await create_rebuild_request(channel_id, requested_by=user_session_id)
+        return {
+            "message": "Channel rebuild successfully queued!",
+            "request_id": str(onboarding_request.id)
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception:
+        raise HTTPException(status_code=500, detail="Channel rebuild failed")
+
+@onboard_router.get("/stats/")
+async def stats() -> dict:
+    """
+    Endpoint exposing the counters of the channel search, the channel cache and the YouTube requests of this process.
+
+    The transcript archive is only used by the onboarding workers, which expose its counters
+    on their METRICS_PORT.
+
+    Returns:
+    - dict: The counters of the channel search, of the channel cache and of the YouTube requests.
+    """
+    # TODO: Restrict access only to admins
+    return {"channel_search": channel_search.stats(),
+            "channel_cache": channel_cache.stats(),
+            "youtube": youtube.stats()}
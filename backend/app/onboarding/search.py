@@ -0,0 +1,130 @@
+"""
+Async, cached YouTube channel search.
+
+youtubesearchpython scrapes YouTube synchronously, so searches run in a
+dedicated thread pool. Identical searches in flight are coalesced into one
+upstream request, and results are cached by (query, region): a search with
+a smaller limit is served from the first results of a cached larger one.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from app.onboarding.yt_async import youtube
+from app.utils.cache import TTLCache
+from app.utils.metrics import metrics
+
+def normalise_search_query(query: str) -> str:
+    """Lowercase the query and collapse whitespace."""
+    return re.sub(r"\s+", " ", query.lower()).strip()
+
+class ChannelSearchService:
+    """
+    Channel search with single-flight coalescing and a TTL cache.
+
+    Cache entries hold the results of the largest limit searched so far for a
+    (query, region), so every smaller limit is a prefix of them. An entry with
+    fewer results than its limit is exhaustive and serves any limit.
+    """
+
+    def __init__(self,
+                 maxsize: int = int(os.environ.get('SEARCH_CACHE_SIZE', 1024)),
+                 ttl: float = float(os.environ.get('SEARCH_CACHE_TTL', 3600)),
+                 max_workers: int = int(os.environ.get('SEARCH_MAX_WORKERS', 4))) -> None:
+        """
+        Args:
+            maxsize (int): The maximum number of (query, region) entries cached.
+            ttl (float): Seconds after which cached results expire.
+            max_workers (int): The number of threads running the scraper.
+        """
+        self.max_workers = max_workers
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._in_flight: Dict[Tuple[str, str, int], asyncio.Future] = {}
+        self.upstream_requests = 0
+        self.coalesced = 0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="channel-search")
+        return self._executor
+
+    def _cached(self, key: Tuple[str, str], limit: int) -> Optional[List[dict]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        cached_limit, results = entry
+        if limit <= cached_limit or len(results) < cached_limit:
+            return results[:limit]
+        return None
+
+    def _joinable(self, key: Tuple[str, str], limit: int) -> Optional[asyncio.Future]:
+        """Return an in-flight search of the (query, region) whose results cover the limit."""
+        for (query, region, in_flight_limit), future in self._in_flight.items():
+            if (query, region) == key and in_flight_limit >= limit:
+                return future
+        return None
+
+    async def _fetch(self, query: str, region: Optional[str], limit: int) -> List[dict]:
+        self.upstream_requests += 1
+        return await youtube.search_channels(query, region, limit, executor=self.executor)
+
+    async def search(self, query: str, region: Optional[str] = 'US', limit: int = 5) -> List[dict]:
+        """
+        Search for channels, from the cache or an in-flight search when possible.
+
+        Args:
+            query (str): The query to search for.
+            region (str, optional): The region to search in.
+            limit (int): The maximum number of results to return.
+
+        Returns:
+            List[dict]: The channels found, as returned by `yt_utils.search_channels`.
+        """
+        key = (normalise_search_query(query), region or "")
+        results = self._cached(key, limit)
+        if results is not None:
+            return results
+
+        future = self._joinable(key, limit)
+        if future is not None:
+            self.coalesced += 1
+            # Shield the shared search from the cancellation of one of its callers
+            return (await asyncio.shield(future))[:limit]
+
+        flight = (*key, limit)
+        future = asyncio.ensure_future(self._fetch(query, region, limit))
+        self._in_flight[flight] = future
+        try:
+            results = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._in_flight.pop(flight, None)
+            else:
+                future.add_done_callback(lambda _: self._in_flight.pop(flight, None))
+
+        entry = self._cache.get(key)
+        if entry is None or entry[0] <= limit:
+            self._cache.set(key, (limit, results))
+        return results[:limit]
+
+    def stats(self) -> dict:
+        """Return the cache counters, the upstream requests and the coalesced searches."""
+        return {**self._cache.stats(),
+                "upstream_requests": self.upstream_requests,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight)}
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+channel_search = ChannelSearchService()
+metrics.register_stats("channel_search", channel_search.stats)
@@ -0,0 +1,171 @@
+"""
+Background worker processing the queued onboarding requests. Run with `python -m app.onboarding.worker`.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import signal
+import socket
+import asyncio
+from uuid import uuid4
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, Optional
+
+from app.db.models import ChannelOnBoardingRequest
+from app.onboarding import jobs
+from app.onboarding.engine import process_onboarding_request
+from app.onboarding.yt_async import youtube
+from app.utils.loop_monitor import loop_monitor
+from app.utils.metrics import metrics
+
+class OnboardingWorker:
+    """
+    Leases onboarding requests from the queue and processes up to `concurrency` of them at a time.
+
+    Leases are renewed by a heartbeat while a request is processed. If the
+    lease is lost, e.g. the worker stalled past the visibility timeout and
+    another worker took the request over, processing is cancelled.
+    """
+
+    def __init__(self,
+                 concurrency: int = int(os.environ.get('ONBOARDING_WORKER_CONCURRENCY', 2)),
+                 chunk_processes: int = int(os.environ.get('ONBOARDING_CHUNK_PROCESSES', os.cpu_count() or 1)),
+                 poll_interval: float = float(os.environ.get('ONBOARDING_POLL_SECONDS', 5)),
+                 lease_seconds: int = jobs.LEASE_SECONDS,
+                 heartbeat_seconds: Optional[float] = None) -> None:
+        """
+        Args:
+            concurrency (int): The number of requests processed at a time.
+            chunk_processes (int): The size of the process pool chunking transcripts. 0 chunks on the event loop.
+            poll_interval (float): Seconds to wait before polling an empty queue again.
+            lease_seconds (int): The visibility timeout of a leased request.
+            heartbeat_seconds (float, optional): Seconds between lease renewals. Defaults to a third of the lease.
+        """
+        self.id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.concurrency = concurrency
+        self.chunk_processes = chunk_processes
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 3
+        self._jobs: Dict[asyncio.Task, ChannelOnBoardingRequest] = {}
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        """Stop leasing new requests; in-flight requests are handed back to the queue."""
+        self._stopping.set()
+
+    async def _heartbeat(self, request: ChannelOnBoardingRequest, job: asyncio.Task) -> None:
+        """Renew the lease of a request until it is processed, cancelling the job if the lease is lost."""
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            try:
+                if not await jobs.renew_lease(request, self.id, self.lease_seconds):
+                    logger.error(f"Lost the lease of onboarding request {request.id}, cancelling it")
+                    job.cancel()
+                    return
+            except Exception as e:
+                # Keep processing; the lease only lapses if the DB stays unreachable
+                logger.error(f"Failed to renew the lease of onboarding request {request.id}", e)
+
+    async def _process(self, request: ChannelOnBoardingRequest, executor: Optional[Executor]) -> None:
+        logger.info(f"Processing onboarding request {request.id} for channel {request.channel_id} "
+                    f"(attempt {request.attempts})")
+        job = asyncio.create_task(process_onboarding_request(request, executor=executor))
+        heartbeat = asyncio.create_task(self._heartbeat(request, job))
+        try:
+            await job
+            await jobs.complete_request(request, self.id)
+        except asyncio.CancelledError:
+            if self._stopping.is_set():
+                await jobs.release_request(request, self.id)
+        except Exception as e:
+            await jobs.retry_request(request, self.id, str(e))
+        finally:
+            heartbeat.cancel()
+
+    async def _acquire_slot(self, slots: asyncio.Semaphore) -> bool:
+        """Wait for a free slot, returning False without holding one if the worker is stopped first."""
+        acquire = asyncio.ensure_future(slots.acquire())
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        try:
+            await asyncio.wait([acquire, stopping], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopping.cancel()
+            if not acquire.done():
+                acquire.cancel()
+                try:
+                    await acquire
+                except asyncio.CancelledError:
+                    pass
+        if acquire.cancelled():
+            return False
+        if self._stopping.is_set():
+            # Stopped while a slot freed up: do not lease another request
+            slots.release()
+            return False
+        return True
+
+    async def run(self) -> None:
+        """Process queued requests until stopped."""
+        logger.info(f"Onboarding worker {self.id} started with concurrency {self.concurrency}")
+        executor = ProcessPoolExecutor(max_workers=self.chunk_processes) if self.chunk_processes > 0 else None
+        slots = asyncio.Semaphore(self.concurrency)
+        try:
+            while not self._stopping.is_set():
+                if not await self._acquire_slot(slots):
+                    break
+                try:
+                    request = await jobs.lease_request(self.id, self.lease_seconds)
+                except Exception as e:
+                    logger.error("Failed to lease an onboarding request", e)
+                    request = None
+                if request is None:
+                    slots.release()
+                    # Wait for the next poll, waking up early on stop
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                task = asyncio.create_task(self._process(request, executor))
+                self._jobs[task] = request
+                task.add_done_callback(lambda t: (self._jobs.pop(t, None), slots.release()))
+        finally:
+            # Hand the in-flight requests back to the queue
+            for task in list(self._jobs):
+                task.cancel()
+            await asyncio.gather(*self._jobs, return_exceptions=True)
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            logger.info(f"Onboarding worker {self.id} stopped")
+
+async def main() -> None:
+    from app.db.db import close_db, init_db
+    await init_db()
+    worker = OnboardingWorker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    monitor_loop = asyncio.create_task(loop_monitor.run())
+    # Workers have no API, expose their metrics on their own port when one is configured
+    serve_metrics = None
+    if metrics.enabled and os.environ.get('METRICS_PORT'):
+        serve_metrics = asyncio.create_task(metrics.serve(int(os.environ['METRICS_PORT'])))
+    try:
+        await worker.run()
+    finally:
+        monitor_loop.cancel()
+        if serve_metrics:
+            serve_metrics.cancel()
+        youtube.shutdown()
+        close_db()
+        logger.info(f"Event loop lag: {loop_monitor.stats()}")
+
+def start() -> None:
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
+
+if __name__ == '__main__':
+    start()
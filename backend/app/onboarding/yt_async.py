@@ -0,0 +1,217 @@
+"""
+Async facade over `app.onboarding.yt_utils`.
+
+The YouTube clients are synchronous, so every call runs on a dedicated,
+bounded thread pool instead of the event loop or its default executor.
+Retries back off with `asyncio.sleep`, so a throttled request does not hold
+a thread while it waits. The transcript lists of videos are cached for the
+duration of an onboarding, so retrying a video only fetches its track again.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import asyncio
+import functools
+from concurrent.futures import Executor, ThreadPoolExecutor
+from collections import Counter
+from typing import Any, AsyncIterator, Callable, Container, List, Optional, Tuple
+from youtube_transcript_api import YouTubeTranscriptApi, TranscriptList
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random, retry_if_exception
+
+from app.onboarding import yt_utils
+from app.utils.cache import TTLCache
+from app.utils.metrics import metrics, retry_counter
+
+class AsyncYouTube:
+    """Runs the blocking YouTube calls on a bounded executor, with async retries."""
+
+    def __init__(self,
+                 max_workers: int = int(os.environ.get('YOUTUBE_IO_MAX_WORKERS', 16)),
+                 max_attempts: int = 5,
+                 min_wait: float = 1,
+                 max_wait: float = 3,
+                 transcript_list_cache_size: int = int(os.environ.get('TRANSCRIPT_LIST_CACHE_SIZE', 1000)),
+                 transcript_list_ttl: float = float(os.environ.get('TRANSCRIPT_LIST_CACHE_TTL', 3600))) -> None:
+        """
+        Args:
+            max_workers (int): The number of threads running YouTube calls.
+            max_attempts (int): Attempts per call when YouTube fails or rate limits the client.
+            min_wait (float): The minimum number of seconds between two attempts.
+            max_wait (float): The maximum number of seconds between two attempts.
+            transcript_list_cache_size (int): The maximum number of transcript lists cached. 0 disables the cache.
+            transcript_list_ttl (float): Seconds after which a cached transcript list expires.
+                The track URLs it holds are signed and eventually expire too.
+        """
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._transcript_lists = (TTLCache(maxsize=transcript_list_cache_size, ttl=transcript_list_ttl)
+                                  if transcript_list_cache_size > 0 else None)
+        # HTTP requests sent per operation, counting every attempt
+        self.requests = Counter()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="youtube")
+        return self._executor
+
+    async def _run(self, fn: Callable[..., Any], *args: Any, executor: Optional[Executor] = None, **kwargs: Any) -> Any:
+        """Run a blocking call on the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor or self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def _retry(self, fn: Callable[..., Any], *args: Any, executor: Optional[Executor] = None,
+                     operation: Optional[str] = None) -> Any:
+        """Run a blocking call on the executor, retrying failed and rate limited requests."""
+        async def attempt() -> Any:
+            if operation:
+                self.requests[operation] += 1
+            return await self._run(fn, *args, executor=executor)
+
+        retrying = AsyncRetrying(stop=stop_after_attempt(self.max_attempts),
+                                 wait=wait_random(min=self.min_wait, max=self.max_wait),
+                                 retry=retry_if_exception(yt_utils.is_transient),
+                                 before_sleep=retry_counter(operation or getattr(fn, "__name__", "youtube")))
+        return await retrying(attempt)
+
+    async def search_channels(self, query: str, region: Optional[str], limit: Optional[int],
+                              executor: Optional[Executor] = None) -> List[dict]:
+        """See `yt_utils.search_channels`."""
+        return await self._run(yt_utils.search_channels, query, region, limit, executor=executor)
+
+    async def get_channel_info(self, channel_id: str) -> dict:
+        """See `yt_utils.get_channel_info`."""
+        return await self._run(yt_utils.get_channel_info, channel_id)
+
+    async def get_channel_videos(self, channel_id: str) -> List[dict]:
+        """See `yt_utils.get_channel_videos`."""
+        return await self._run(yt_utils.get_channel_videos, channel_id)
+
+    async def iter_channel_videos(self, channel_id: str, min_duration: int = 0,
+                                  newer_than: Optional[Container[str]] = None) -> AsyncIterator[dict]:
+        """
+        Stream the uploads of a channel, newest first, as the pages of the uploads playlist arrive.
+
+        The next page is requested while the videos of the current one are consumed.
+
+        Args:
+            channel_id (str): The ID of the channel.
+            min_duration (int): Videos shorter than this many seconds are skipped.
+            newer_than (Container[str], optional): Video ids of the cutoff, see `yt_utils.filter_videos`.
+
+        Yields:
+            dict: The metadata of each video, with its duration in seconds as `duration_seconds`.
+        """
+        pages = yt_utils.iter_channel_video_pages(channel_id)
+        next_page = asyncio.ensure_future(self._run(next, pages, None))
+        try:
+            while True:
+                page = await next_page
+                if page is None:
+                    return
+                videos, cutoff = yt_utils.filter_videos(page, min_duration, newer_than)
+                if not cutoff:
+                    next_page = asyncio.ensure_future(self._run(next, pages, None))
+                for video in videos:
+                    yield video
+                if cutoff:
+                    return
+        finally:
+            next_page.cancel()
+
+    async def download_transcript(self, video_id: str, languages: List[str] = ['en', 'en-IN'],
+                                  executor: Optional[Executor] = None) -> List[dict]:
+        """
+        Download the transcript of a video in the given languages, see `yt_utils.download_transcript`.
+
+        Args:
+            video_id (str): The ID of the video.
+            languages (list): A list of language codes for the desired transcripts.
+            executor (Executor, optional): Runs the requests instead of the facade's executor.
+
+        Returns:
+            List[dict]: The downloaded transcript segments.
+
+        Raises:
+            ValueError: If the transcript download fails.
+        """
+        segments, _, _ = await self.download_transcript_with_source(video_id, languages, executor=executor)
+        return segments
+
+    async def download_transcript_with_source(self, video_id: str, languages: List[str] = ['en', 'en-IN'],
+                                              executor: Optional[Executor] = None) -> Tuple[List[dict], str, str]:
+        """
+        Download the transcript of a video in the given languages, with its language and kind.
+
+        Args:
+            video_id (str): The ID of the video.
+            languages (list): A list of language codes for the desired transcripts.
+            executor (Executor, optional): Runs the requests instead of the facade's executor.
+
+        Returns:
+            Tuple[List[dict], str, str]: The downloaded transcript segments, their language code,
+                and their kind: "manual", "generated" or "translated".
+
+        Raises:
+            ValueError: If the transcript download fails.
+        """
+        try:
+            transcript_list = await self.list_transcripts(video_id, executor=executor)
+            tracks = yt_utils.rank_transcripts(transcript_list, languages)
+            if not tracks:
+                raise ValueError(f"No transcripts found for video: {video_id}")
+            # Fall back to the next best track when a track fails, without listing the tracks again
+            for i, (transcript, kind) in enumerate(tracks):
+                try:
+                    segments = await self._retry(transcript.fetch, executor=executor, operation="fetch_transcript")
+                except Exception as e:
+                    if yt_utils.is_rate_limited(e) or i == len(tracks) - 1:
+                        raise e
+                    logger.warning(f"Failed to fetch the {kind} {transcript.language_code} transcript "
+                                   f"of video {video_id}, trying the next track: {e}")
+                    continue
+                # The video is done, its track URLs are not needed anymore
+                if self._transcript_lists is not None:
+                    self._transcript_lists.pop(video_id)
+                return segments, transcript.language_code, kind
+        except ValueError as e:
+            raise e
+        except Exception as e:
+            logger.error(e)
+            raise ValueError(f"Failed to download transcript for video: {video_id}") from e
+
+    async def list_transcripts(self, video_id: str, executor: Optional[Executor] = None) -> TranscriptList:
+        """
+        Return the transcript tracks of a video, from the cache when they were listed recently.
+
+        Args:
+            video_id (str): The ID of the video.
+            executor (Executor, optional): Runs the request instead of the facade's executor.
+
+        Returns:
+            TranscriptList: The transcript tracks of the video.
+        """
+        transcript_list = self._transcript_lists.get(video_id) if self._transcript_lists is not None else None
+        if transcript_list is None:
+            transcript_list = await self._retry(YouTubeTranscriptApi.list_transcripts, video_id,
+                                                executor=executor, operation="list_transcripts")
+            if self._transcript_lists is not None:
+                self._transcript_lists.set(video_id, transcript_list)
+        return transcript_list
+
+    def stats(self) -> dict:
+        """Return the HTTP requests sent per operation and the transcript list cache counters."""
+        return {"requests": dict(self.requests),
+                "transcript_lists": self._transcript_lists.stats() if self._transcript_lists is not None else None}
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+youtube = AsyncYouTube()
+metrics.register_stats("youtube", youtube.stats)
@@ -1,18 +1,21 @@
 import logging
 logger = logging.getLogger(__name__)
 
-from typing import List, Optional
+from typing import Container, Iterable, Iterator, List, Optional, Tuple
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptList, Transcript
 from youtube_transcript_api._errors import YouTubeRequestFailed, TooManyRequests
 import youtubesearchpython as yps
-from tenacity import retry, stop_after_attempt, wait_random, retry_if_exception
+from tenacity import retry, stop_after_attempt, wait_random, retry_if_exception, RetryError
+
+from app.utils.metrics import retry_counter
 
 def duration_str_to_seconds(duration_str: str) -> int:
     """
     Convert a duration string in the format 'days:hours:minutes:seconds' to seconds.
     
     Args:
-    duration_str (str): A string representing the duration in the format 'days:hours:minutes:seconds'
+    duration_str (str): A string representing the duration in the format 'days:hours:minutes:seconds',
+        without the leading units that are zero, e.g. '12:34'
     
     Returns:
     int: The total duration in seconds
@@ -23,11 +26,53 @@ def duration_str_to_seconds(duration_str: str) -> int:
     # Define the conversion factors for each time unit
     conversion_factors = [86400, 3600, 60, 1]
     
-    # Calculate the total duration in seconds
-    total_seconds = sum([a*b for a,b in zip(conversion_factors, time_units)])
+    # Calculate the total duration in seconds, the string omits the leading units, e.g. '12:34'
+    total_seconds = sum([a*b for a,b in zip(conversion_factors[-len(time_units):], time_units)])
     
     return total_seconds
 
+def is_rate_limited(e: BaseException) -> bool:
+    """
+    Check whether an exception was caused by YouTube rate limiting the client.
+
+    Args:
+        e (BaseException): The raised exception, possibly wrapping the original error.
+
+    Returns:
+        bool: True if a TooManyRequests error, or a track download answered with
+            a 429 status, is found in the exception chain.
+    """
+    seen = set()
+    while e is not None and id(e) not in seen:
+        seen.add(id(e))
+        if isinstance(e, TooManyRequests):
+            return True
+        # Track downloads report a 429 as a failed request
+        if isinstance(e, YouTubeRequestFailed) and "Too Many Requests" in str(e):
+            return True
+        if isinstance(e, RetryError):
+            e = e.last_attempt.exception()
+        else:
+            e = e.__cause__ or e.__context__
+    return False
+
+def is_transient(e: BaseException) -> bool:
+    """
+    Check whether a failed YouTube request is worth retrying.
+
+    Args:
+        e (BaseException): The raised exception.
+
+    Returns:
+        bool: True if YouTube rate limited the client or failed to answer. Other
+            client errors, such as a track that no longer exists, fail the same way again.
+    """
+    if isinstance(e, TooManyRequests):
+        return True
+    if isinstance(e, YouTubeRequestFailed):
+        return is_rate_limited(e) or "Client Error" not in str(e)
+    return False
+
 def search_channels(query: str, region: Optional[str], limit: Optional[int]) -> List[dict]:
     """
     Search for channels based on the query and optional region.
@@ -58,33 +103,83 @@ def get_channel_info(channel_id: str) -> dict:
     """
     return yps.Channel.get(channel_id)
 
-def get_channel_videos(channel_id: str) -> dict:
+def iter_channel_video_pages(channel_id: str) -> Iterator[List[dict]]:
     """
-    Get videos from a given YouTube channel by channel ID.
+    Page through the uploads playlist of a channel, newest first.
+
+    Each page is requested when the previous one has been consumed, and the
+    pages already returned are not kept.
 
     Args:
         channel_id: The ID of the YouTube channel to retrieve videos from.
 
-    Returns:
-        A dictionary of videos from the given channel.
+    Yields:
+        List[dict]: The videos of each page, of about 100 videos.
+
+    Raises:
+        Exception: If a page cannot be retrieved or the channel has no videos.
     """
     try:
-        # Retrieve the playlist for the given channel
-        playlist = yps.Playlist.getVideos(yps.playlist_from_channel_id(channel_id))
+        playlist = yps.Playlist(yps.playlist_from_channel_id(channel_id))
     except Exception as e:
-        # Log an error if videos retrieval fails and re-raise the exception
         logger.error(e)
         raise Exception(f"Failed to retrieve videos for channel: {channel_id}")
 
-    # If no videos are found, log a message and return an empty list
-    if not playlist or not playlist['videos']:
+    if not playlist.videos:
         raise Exception(f"No videos found for channel: {channel_id}")
 
-    return playlist['videos']
+    while True:
+        # The playlist appends every page to the same list, drop the pages already returned
+        page = list(playlist.videos)
+        playlist.videos.clear()
+        yield page
+        if not playlist.hasMoreVideos:
+            return
+        try:
+            playlist.getNextVideos()
+        except Exception as e:
+            logger.error(e)
+            raise Exception(f"Failed to retrieve videos for channel: {channel_id}")
+
+def get_channel_videos(channel_id: str) -> List[dict]:
+    """
+    Get videos from a given YouTube channel by channel ID.
+
+    Args:
+        channel_id: The ID of the YouTube channel to retrieve videos from.
+
+    Returns:
+        A list of the videos of the given channel.
+    """
+    return [video for page in iter_channel_video_pages(channel_id) for video in page]
+
+def filter_videos(videos: Iterable[dict], min_duration: int = 0,
+                  newer_than: Optional[Container[str]] = None) -> Tuple[List[dict], bool]:
+    """
+    Filter a page of the uploads playlist by duration, up to a cutoff.
+
+    Args:
+        videos (Iterable[dict]): The videos of the page, newest first.
+        min_duration (int): Videos shorter than this many seconds are skipped, as are live streams without duration.
+        newer_than (Container[str], optional): Video ids of the cutoff; only the videos listed before the first
+            of them are kept.
+
+    Returns:
+        Tuple[List[dict], bool]: The kept videos, with their duration in seconds, and whether the cutoff was reached.
+    """
+    kept = []
+    for video in videos:
+        if newer_than is not None and video['id'] in newer_than:
+            return kept, True
+        if not video.get('duration'):
+            continue
+        duration = duration_str_to_seconds(video['duration'])
+        if duration > min_duration:
+            kept.append({**video, 'duration_seconds': duration})
+    return kept, False
 
 @retry(stop=stop_after_attempt(5), wait=wait_random(min=1, max=3),
-       retry=(retry_if_exception(YouTubeRequestFailed) | retry_if_exception(TooManyRequests))
-       )
+       retry=retry_if_exception(is_transient), before_sleep=retry_counter("list_transcripts"))
 def list_transcripts(video_id: str) -> TranscriptList:
     """
     Fetches the list of transcripts for a given video ID.
@@ -98,8 +193,7 @@ def list_transcripts(video_id: str) -> TranscriptList:
     return YouTubeTranscriptApi.list_transcripts(video_id=video_id)
 
 @retry(stop=stop_after_attempt(5), wait=wait_random(min=1, max=3),
-       retry=(retry_if_exception(YouTubeRequestFailed) | retry_if_exception(TooManyRequests))
-       )
+       retry=retry_if_exception(is_transient), before_sleep=retry_counter("fetch_transcript"))
 def fetch_transcript(transcript: Transcript) -> str:
     """
     Retries fetching the transcript up to 5 attempts with random wait time between 1 and 3 seconds.
@@ -112,6 +206,65 @@ def fetch_transcript(transcript: Transcript) -> str:
     """
     return transcript.fetch()
 
+# Preference policy of the transcript tracks: kinds first, then the order of the requested languages
+TRACK_KIND_PREFERENCE = ["manual", "generated", "translated"]
+
+def rank_transcripts(transcript_list: TranscriptList, languages: List[str]) -> List[Tuple[Transcript, str]]:
+    """
+    Rank the transcript tracks of a video in the requested languages, in a single pass over the tracks.
+
+    Tracks are ranked by kind, following TRACK_KIND_PREFERENCE, then by the
+    order of the languages. Translations are only considered for the languages
+    without a manual or generated track, from the best translatable track.
+
+    Args:
+        transcript_list (TranscriptList): The available transcripts of the video.
+        languages (list): A list of language codes for the desired transcripts.
+
+    Returns:
+        List[Tuple[Transcript, str]]: The tracks and their kind: "manual", "generated" or "translated",
+            best first. Translated tracks are built locally and cost no request until they are fetched.
+    """
+    ranked, available, source = [], set(), None
+    for transcript in transcript_list:
+        kind = "generated" if transcript.is_generated else "manual"
+        if transcript.language_code in languages:
+            ranked.append(((TRACK_KIND_PREFERENCE.index(kind), languages.index(transcript.language_code)),
+                           transcript, kind))
+            available.add(transcript.language_code)
+        # Translate from the first translatable manual track, else from a generated one
+        if transcript.is_translatable and (source is None or (source.is_generated and not transcript.is_generated)):
+            source = transcript
+
+    if source is not None:
+        translation_codes = set(language['language_code'] for language in source.translation_languages)
+        for lang in languages:
+            if lang in translation_codes and lang not in available:
+                ranked.append(((TRACK_KIND_PREFERENCE.index("translated"), languages.index(lang)),
+                               source.translate(lang), "translated"))
+
+    ranked.sort(key=lambda track: track[0])
+    return [(transcript, kind) for _, transcript, kind in ranked]
+
+def select_transcript(transcript_list: TranscriptList, languages: List[str]) -> Tuple[Transcript, str]:
+    """
+    Select the transcript to download from the transcripts of a video, see `rank_transcripts`.
+
+    Args:
+        transcript_list (TranscriptList): The available transcripts of the video.
+        languages (list): A list of language codes for the desired transcripts.
+
+    Returns:
+        Tuple[Transcript, str]: The transcript to fetch and its kind: "manual", "generated" or "translated".
+
+    Raises:
+        ValueError: If no transcript is available in the languages.
+    """
+    ranked = rank_transcripts(transcript_list, languages)
+    if not ranked:
+        raise ValueError(f"No transcripts found for video: {transcript_list.video_id}")
+    return ranked[0]
+
 def download_transcript(video_id, languages=['en','en-IN']):
     """
     Download transcript for the specified video in the given languages.
@@ -129,38 +282,10 @@ def download_transcript(video_id, languages=['en','en-IN']):
     try:
         # Get the list of available transcripts for the video
         transcript_list = list_transcripts(video_id)
-        
-        # Check for manually created transcripts
-        manual_langs = set(transcript_list._manually_created_transcripts.keys())
-        if set(languages).intersection(manual_langs):
-            for lang in languages:
-                if lang in manual_langs:
-                    t = transcript_list.find_manually_created_transcript(language_codes=[lang])
-                    data = fetch_transcript(t)
-                    return data
-        
-        # Check for generated transcripts
-        generated_langs = set(transcript_list._generated_transcripts.keys())
-        if set(languages).intersection(generated_langs):
-            for lang in languages:
-                if lang in generated_langs:
-                    t = transcript_list.find_generated_transcript(language_codes=[lang])
-                    data = fetch_transcript(t)
-                    return data
-
-        # Check for translated transcripts
-        translated_langs = set([t['language_code'] for t in transcript_list._translation_languages])
-        if set(languages).intersection(translated_langs):
-            for lang in languages:
-                if lang in translated_langs:
-                    t = t = transcript_list.find_transcript(language_codes=manual_langs.union(generated_langs)).translate(lang)
-                    data = fetch_transcript(t)
-                    return data
+        transcript, _ = select_transcript(transcript_list, languages)
+        return fetch_transcript(transcript)
+    except ValueError as e:
+        raise e
     except Exception as e:
         logger.error(e)
-        raise ValueError(f"Failed to download transcript for video: {video_id}")
-    
-    raise ValueError(f"No transcripts found for video: {video_id}")
-    
-
-        
\ No newline at end of file
+        raise ValueError(f"Failed to download transcript for video: {video_id}") from e
@@ -0,0 +1,108 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU cache whose entries also expire after a TTL."""
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None) -> None:
+        """
+        Args:
+            maxsize (int): The maximum number of entries kept in the cache.
+            ttl (float, optional): Seconds after which an entry expires. None disables expiry.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_expired(self, expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the cached value for the key and mark it as recently used.
+
+        Args:
+            key (Hashable): The cache key.
+            default (Any): Value returned on a miss.
+
+        Returns:
+            Any: The cached value or the default.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._is_expired(entry[1]):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Insert or replace a value, evicting the least recently used entry when full.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The value to cache.
+            ttl (float, optional): Overrides the cache TTL for this entry.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove the key from the cache and return its value."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Remove every entry whose key matches the predicate.
+
+        Args:
+            predicate (Callable[[Hashable], bool]): Returns True for keys to drop.
+
+        Returns:
+            int: The number of removed entries.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """Return a snapshot of the live (key, value) pairs, without marking them as used."""
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._data.items() if not self._is_expired(entry[1])]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Return the hit/miss/eviction counters and the current size."""
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "size": len(self._data),
+                    "maxsize": self.maxsize}
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,233 @@
+"""
+Embedding service shared by onboarding and the chat query path.
+
+Embeddings are cached by a hash of their text, in memory and in the
+embedding_cache collection, so identical chunks (re-uploads, reposted
+clips, recurring intros and outros) are only ever embedded once.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import asyncio
+import hashlib
+from typing import Dict, List, Optional, Union
+import numpy as np
+from pymongo.errors import BulkWriteError
+from beanie.operators import In
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.embeddings.utils import resolve_embed_model
+
+from app.db.models import EmbeddingCacheEntry
+from app.utils.cache import TTLCache
+
+# Number of cache keys looked up per query
+CACHE_LOOKUP_BATCH_SIZE = 1000
+
+_WORD_RE = re.compile(r"\w+")
+
+class HashEmbedding(BaseEmbedding):
+    """
+    Deterministic, offline embedding backend for tests and benchmarks.
+
+    Words are feature-hashed into a signed, L2-normalised bag-of-words vector,
+    so texts sharing words are close to each other, and the same text always
+    gets the same vector across processes.
+    """
+
+    embed_dim: int = Field(default=1536, description="The dimension of the embeddings.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _embed(self, text: str) -> Embedding:
+        vector = np.zeros(self.embed_dim, dtype=np.float32)
+        for word in _WORD_RE.findall(text.lower()):
+            digest = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+            vector[digest % self.embed_dim] += 1.0 if digest >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed(text)
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model with batching, bounded parallelism and a content-hash cache.
+
+    Texts are deduplicated per call, looked up in an in-memory LRU and then in
+    MongoDB, and only the misses are sent to the wrapped model, in batches of
+    `embed_batch_size` with at most `parallelism` requests in flight. The
+    synchronous methods only use the in-memory cache.
+    """
+
+    parallelism: int = Field(default=4, description="Maximum number of concurrent embedding requests.")
+    persist: bool = Field(default=True, description="Persist embeddings in the embedding_cache collection.")
+    _embed_model: BaseEmbedding = PrivateAttr()
+    # Embeddings as float32 arrays, a quarter of the size of lists of floats
+    _memory: TTLCache = PrivateAttr()
+
+    def __init__(self,
+                 embed_model: BaseEmbedding,
+                 embed_batch_size: int = 100,
+                 parallelism: int = 4,
+                 persist: bool = True,
+                 memory_cache_size: int = 10000) -> None:
+        """
+        Args:
+            embed_model (BaseEmbedding): The embedding model computing the cache misses.
+            embed_batch_size (int): The number of texts per embedding request.
+            parallelism (int): The maximum number of concurrent embedding requests.
+            persist (bool): Persist embeddings in the embedding_cache collection.
+            memory_cache_size (int): The number of embeddings kept in memory.
+        """
+        super().__init__(model_name=embed_model.model_name,
+                         embed_batch_size=embed_batch_size,
+                         parallelism=parallelism,
+                         persist=persist)
+        embed_model.embed_batch_size = embed_batch_size
+        self._embed_model = embed_model
+        self._memory = TTLCache(maxsize=memory_cache_size)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _key(self, text: str, kind: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode()).hexdigest()
+
+    def _remember(self, key: str, embedding: Union[Embedding, np.ndarray]) -> np.ndarray:
+        """Keep an embedding in memory as a float32 array, returning the array."""
+        vector = np.asarray(embedding, dtype=np.float32)
+        self._memory.set(key, vector)
+        return vector
+
+    async def _lookup(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Return the cached embeddings of the keys, from memory then MongoDB."""
+        found = {}
+        for key in keys:
+            vector = self._memory.get(key)
+            if vector is not None:
+                found[key] = vector
+        missing = [key for key in keys if key not in found]
+        if self.persist and missing:
+            for start in range(0, len(missing), CACHE_LOOKUP_BATCH_SIZE):
+                entries = await EmbeddingCacheEntry.find(
+                    In(EmbeddingCacheEntry.id, missing[start:start + CACHE_LOOKUP_BATCH_SIZE])).to_list()
+                for entry in entries:
+                    found[entry.id] = self._remember(entry.id, np.frombuffer(entry.vector, dtype="<f4"))
+        return found
+
+    async def _store(self, embeddings: Dict[str, Embedding]) -> Dict[str, np.ndarray]:
+        """Cache computed embeddings in memory and MongoDB, returning them as float32 arrays."""
+        vectors = {key: self._remember(key, embedding) for key, embedding in embeddings.items()}
+        if not self.persist or not vectors:
+            return vectors
+        entries = [EmbeddingCacheEntry(id=key,
+                                       embedding_model=self.model_name,
+                                       vector=vector.astype("<f4", copy=False).tobytes())
+                   for key, vector in vectors.items()]
+        try:
+            await EmbeddingCacheEntry.insert_many(entries, ordered=False)
+        except BulkWriteError:
+            # Entries cached concurrently by another worker
+            pass
+        return vectors
+
+    async def _aembed(self, texts: List[str], kind: str) -> List[Embedding]:
+        keys = [self._key(text, kind) for text in texts]
+        unique = dict(zip(keys, texts))
+        cached = await self._lookup(list(unique))
+        misses = [(key, text) for key, text in unique.items() if key not in cached]
+
+        if misses:
+            semaphore = asyncio.Semaphore(self.parallelism)
+
+            async def embed_batch(batch: List[str]) -> List[Embedding]:
+                async with semaphore:
+                    if kind == "query":
+                        return [await self._embed_model.aget_query_embedding(batch[0])]
+                    return await self._embed_model.aget_text_embedding_batch(batch)
+
+            batch_size = 1 if kind == "query" else self.embed_batch_size
+            batches = [misses[start:start + batch_size] for start in range(0, len(misses), batch_size)]
+            results = await asyncio.gather(*[embed_batch([text for _, text in batch]) for batch in batches])
+            computed = {key: embedding
+                        for batch, embeddings in zip(batches, results)
+                        for (key, _), embedding in zip(batch, embeddings)}
+            cached.update(await self._store(computed))
+            logger.debug(f"Embedded {len(misses)} of {len(texts)} texts, {len(texts) - len(misses)} from cache")
+        return [cached[key].tolist() for key in keys]
+
+    def _embed(self, texts: List[str], kind: str) -> List[Embedding]:
+        keys = [self._key(text, kind) for text in texts]
+        found = {key: self._memory.get(key) for key in keys}
+        misses = list({key: text for key, text in zip(keys, texts) if found[key] is None}.items())
+        if misses:
+            if kind == "query":
+                embeddings = [self._embed_model.get_query_embedding(text) for _, text in misses]
+            else:
+                embeddings = self._embed_model.get_text_embedding_batch([text for _, text in misses])
+            for (key, _), embedding in zip(misses, embeddings):
+                found[key] = self._remember(key, embedding)
+        return [found[key].tolist() for key in keys]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._embed([query], "query")[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return (await self._aembed([query], "query"))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed([text], "text")[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed(texts, "text")
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._aembed(texts, "text")
+
+    async def aget_text_embedding_batch(self, texts: List[str], show_progress: bool = False) -> List[Embedding]:
+        """Embed the texts, deduplicating and batching across the whole list."""
+        return await self._aget_text_embeddings(texts)
+
+    def get_text_embedding_batch(self, texts: List[str], show_progress: bool = False, **kwargs) -> List[Embedding]:
+        """Embed the texts, deduplicating and batching across the whole list."""
+        return self._get_text_embeddings(texts)
+
+_embed_model: Optional[CachedEmbedding] = None
+
+def get_embed_model() -> CachedEmbedding:
+    """
+    Return the shared embedding service, configured from the environment.
+
+    EMBEDDING_BACKEND selects the wrapped model: "default" for llama_index's
+    default (OpenAI) embedding model, or "local" for the offline HashEmbedding.
+
+    Returns:
+        CachedEmbedding: The embedding service.
+    """
+    global _embed_model
+    if _embed_model is None:
+        backend = os.environ.get('EMBEDDING_BACKEND', 'default')
+        if backend == 'local':
+            embed_model = HashEmbedding(embed_dim=int(os.environ.get('EMBEDDING_DIM', 1536)))
+        else:
+            embed_model = resolve_embed_model(backend)
+        _embed_model = CachedEmbedding(embed_model,
+                                       embed_batch_size=int(os.environ.get('EMBEDDING_BATCH_SIZE', 100)),
+                                       parallelism=int(os.environ.get('EMBEDDING_PARALLELISM', 4)),
+                                       persist=os.environ.get('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true',
+                                       memory_cache_size=int(os.environ.get('EMBEDDING_MEMORY_CACHE_SIZE', 10000)))
+    return _embed_model
@@ -0,0 +1,69 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import time
+import asyncio
+from collections import deque
+import numpy as np
+
+from app.utils.metrics import metrics
+
+LOOP_LAG_SECONDS = metrics.histogram("yt_chat_event_loop_lag_seconds",
+                                     "How late a periodic sleep of the event loop wakes up",
+                                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+class LoopLagMonitor:
+    """
+    Measures the lag of the event loop: how late a periodic sleep wakes up.
+
+    Any blocking call on the loop shows up as lag, and every chat stream
+    served by the process is delayed by as much.
+    """
+
+    def __init__(self,
+                 interval: float = float(os.environ.get('LOOP_MONITOR_INTERVAL', 0.1)),
+                 threshold: float = float(os.environ.get('LOOP_LAG_WARN_SECONDS', 0.1)),
+                 window: int = 3000) -> None:
+        """
+        Args:
+            interval (float): Seconds between two measurements.
+            threshold (float): Lag in seconds above which a stall is counted and logged.
+            window (int): The number of recent measurements the percentiles are computed over.
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self._lags = deque(maxlen=window)
+        self.samples = 0
+        self.stalls = 0
+        self.max_lag = 0.0
+
+    def record(self, lag: float) -> None:
+        self._lags.append(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+        self.samples += 1
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self.threshold:
+            self.stalls += 1
+            logger.warning(f"Event loop blocked for {lag * 1000:.0f} ms")
+
+    async def run(self) -> None:
+        """Measure the lag until cancelled."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.perf_counter() - start - self.interval))
+
+    def stats(self) -> dict:
+        """Return the lag percentiles of the recent measurements, in milliseconds, and the stall counters."""
+        lags = np.fromiter(self._lags, dtype=np.float64) * 1000
+        p50, p99 = np.percentile(lags, [50, 99]) if len(lags) else (0.0, 0.0)
+        return {"samples": self.samples,
+                "stalls": self.stalls,
+                "lag_p50_ms": round(float(p50), 2),
+                "lag_p99_ms": round(float(p99), 2),
+                "lag_max_ms": round(self.max_lag * 1000, 2)}
+
+loop_monitor = LoopLagMonitor()
+metrics.register_stats("event_loop", loop_monitor.stats)
+
@@ -0,0 +1,332 @@
+"""
+Process metrics in the Prometheus text exposition format.
+
+Hot paths record their stages in histograms and their events in counters.
+The counters kept by the caches, the event loop monitor and the streams are
+read at scrape time by collectors, so they cost nothing between scrapes.
+With METRICS_ENABLED=false recording is a no-op and nothing is exposed.
+"""
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cache hit to a long LLM answer or a large upsert
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def metrics_enabled() -> bool:
+    return os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Timer:
+    """Context manager observing its duration in a histogram."""
+
+    __slots__ = ("_observe", "_start")
+
+    def __init__(self, observe: Callable[[float], None]) -> None:
+        self._observe = observe
+
+    def __enter__(self) -> "_Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._observe(time.perf_counter() - self._start)
+
+class _NoopChild:
+    """Child of a disabled metric; every call is a no-op."""
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def time(self) -> "_NoopChild":
+        return self
+
+    def __enter__(self) -> "_NoopChild":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+_NOOP = _NoopChild()
+
+class _ValueChild:
+    """Value of a counter or gauge for one set of label values."""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+class _HistogramChild:
+    """Buckets of a histogram for one set of label values."""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self.observe)
+
+class Metric:
+    """A metric family with optional labels, e.g. `metric.labels("embed").observe(0.2)`."""
+
+    type = "untyped"
+
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str,
+                 labelnames: Sequence[str] = ()) -> None:
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Return the child of the label values, in the order of the label names."""
+        if not self.registry.enabled:
+            return _NOOP
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self) -> _ValueChild:
+        return _ValueChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for values, child in list(self._children.items()):
+            yield f"{self.name}_total", _format_labels(self.labelnames, values), child.value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self) -> _ValueChild:
+        return _ValueChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for values, child in list(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, values), child.value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, registry: "MetricsRegistry", name: str, documentation: str,
+                 labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"'),
+                       cumulative)
+            yield f"{self.name}_sum", _format_labels(self.labelnames, values), total
+            yield f"{self.name}_count", _format_labels(self.labelnames, values), count
+
+class MetricsRegistry:
+    """The metrics of the process and the collectors of the counters kept by other components."""
+
+    def __init__(self, enabled: Optional[bool] = None) -> None:
+        """
+        Args:
+            enabled (bool, optional): Record and expose the metrics. Defaults to METRICS_ENABLED.
+        """
+        self.enabled = metrics_enabled() if enabled is None else enabled
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix: str, stats: Callable[[], dict]) -> None:
+        """
+        Expose the numeric values of a `stats()` dict as gauges, read at scrape time.
+
+        Nested dicts are flattened, e.g. {"requests": {"fetch": 3}} under the prefix
+        "youtube" becomes the gauge `yt_chat_youtube_requests_fetch`.
+
+        Args:
+            prefix (str): The prefix of the gauge names, e.g. the component name.
+            stats (Callable[[], dict]): Returns the counters of the component.
+        """
+        self._collectors[prefix] = stats
+
+    def _collected(self) -> Iterator[Tuple[str, float]]:
+        def flatten(prefix: str, value) -> Iterator[Tuple[str, float]]:
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    yield from flatten(f"{prefix}_{key}", item)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield prefix, value
+
+        for prefix, stats in list(self._collectors.items()):
+            try:
+                yield from flatten(f"yt_chat_{prefix}", stats())
+            except Exception as e:
+                logger.error(f"Failed to collect the {prefix} metrics", e)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        for name, value in self._collected():
+            name = "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int) -> None:
+        """
+        Serve the metrics over HTTP until cancelled, for processes without an API such as the workers.
+
+        Args:
+            port (int): The port answering every GET request with the metrics.
+        """
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            try:
+                # Read the request line and headers; the path is not checked
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                body = self.render().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\n"
+                             + f"Content-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                               f"Connection: close\r\n\r\n".encode()
+                             + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, port=port)
+        logger.info(f"Serving metrics on port {port}")
+        async with server:
+            await server.serve_forever()
+
+def retry_counter(operation: str) -> Callable[[object], None]:
+    """
+    Return a tenacity `before_sleep` callback counting the retries of an operation.
+
+    Args:
+        operation (str): The label of the retried operation, e.g. "list_transcripts".
+    """
+    def before_sleep(retry_state) -> None:
+        RETRIES.labels(operation).inc()
+    return before_sleep
+
+metrics = MetricsRegistry()
+
+# Stages of a chat turn: index setup, history loading, retrieval, LLM first token and stream, message saves
+CHAT_STAGE_SECONDS = metrics.histogram("yt_chat_chat_stage_seconds",
+                                       "Duration of the stages of a chat turn", ["stage"])
+# Stages of onboarding: listing, transcript fetch, chunking, embedding, upserts and ledger checkpoints
+ONBOARDING_STAGE_SECONDS = metrics.histogram("yt_chat_onboarding_stage_seconds",
+                                             "Duration of the stages of channel onboarding", ["stage"])
+RETRIES = metrics.counter("yt_chat_retries",
+                          "Retried calls, including the tenacity retries of YouTube requests", ["operation"])
+SSE_STREAMS_IN_FLIGHT = metrics.gauge("yt_chat_sse_streams_in_flight", "Chat answers being streamed")
+SSE_STREAMS_IN_FLIGHT.set(0)
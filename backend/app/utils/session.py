@@ -0,0 +1,76 @@
+import os
+import hmac
+import base64
+import hashlib
+from datetime import datetime
+from uuid import UUID, uuid4
+from typing import Optional, Tuple
+from starlette.requests import Request
+
+SESSION_COOKIE = "sessionId"
+SESSION_MAX_AGE = 3600*24*365
+
+# Key signing the session cookies, checked when the API starts rather than on every request
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+if not SESSION_SECRET:
+    raise RuntimeError("SESSION_SECRET must be set to sign the session cookies")
+
+# Unsigned session cookies, issued before cookies were signed, are upgraded until this
+# date (ISO format). Unset, they are replaced by new sessions.
+LEGACY_SESSION_UPGRADE_UNTIL = (datetime.fromisoformat(os.environ['LEGACY_SESSION_UPGRADE_UNTIL'])
+                                if os.environ.get('LEGACY_SESSION_UPGRADE_UNTIL') else None)
+
+def _signature(session_id: str) -> str:
+    digest = hmac.new(SESSION_SECRET.encode(), session_id.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+def sign_session_id(session_id: str) -> str:
+    """
+    Sign a session id for use as the session cookie value.
+
+    Args:
+        session_id (str): The session id.
+
+    Returns:
+        str: The signed cookie value.
+    """
+    return f"{session_id}.{_signature(session_id)}"
+
+def _is_uuid(value: str) -> bool:
+    try:
+        UUID(value)
+        return True
+    except ValueError:
+        return False
+
+def resolve_session_cookie(cookie: Optional[str]) -> Tuple[str, bool]:
+    """
+    Resolve the session id of a request from its session cookie, without a DB round trip.
+
+    Args:
+        cookie (str, optional): The value of the session cookie.
+
+    Returns:
+        Tuple[str, bool]: The session id and whether a (new or re-signed) cookie must be set.
+    """
+    if cookie:
+        session_id, _, signature = cookie.partition(".")
+        if signature and hmac.compare_digest(signature, _signature(session_id)):
+            return session_id, False
+        # Sessions issued before cookies were signed are upgraded in place during the migration window
+        if (not signature and LEGACY_SESSION_UPGRADE_UNTIL and datetime.now() < LEGACY_SESSION_UPGRADE_UNTIL
+                and _is_uuid(session_id)):
+            return session_id, True
+    return str(uuid4()), True
+
+def get_session_id(request: Request) -> Optional[str]:
+    """
+    Return the session id resolved by the SessionMiddleware for the request.
+
+    Args:
+        request (Request): The incoming request.
+
+    Returns:
+        str, optional: The session id.
+    """
+    return getattr(request.state, "session_id", None)
@@ -0,0 +1,83 @@
+"""
+Measure the time until the first video of a large channel is available and
+the memory held while listing its uploads, when the whole uploads playlist is
+listed up front or streamed page by page.
+
+The uploads playlist is simulated: each page of 100 videos takes --latency seconds.
+
+Usage:
+    python -m benchmarks.channel_listing --videos 20000 --latency 0.05
+"""
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+from app.db.models import Channel
+from app.onboarding import yt_utils
+from app.onboarding.reader import YTChannelReader
+from app.onboarding.yt_async import AsyncYouTube
+from app.onboarding import reader as reader_module
+
+PAGE_SIZE = 100
+
+def simulated_playlist(videos: int, latency: float):
+    class Playlist:
+        """Pages like `youtubesearchpython.Playlist`, appending each page to `videos`."""
+
+        def __init__(self, link: str) -> None:
+            self.videos = []
+            self._listed = 0
+            self.getNextVideos()
+
+        def getNextVideos(self) -> None:
+            time.sleep(latency)
+            for i in range(self._listed, min(self._listed + PAGE_SIZE, videos)):
+                self.videos.append({"id": f"video{i:07d}",
+                                    "title": f"Video {i} " + "title " * 10,
+                                    "duration": f"{i % 50}:{i % 60:02d}",
+                                    "thumbnails": [{"url": f"https://i.ytimg.com/vi/video{i:07d}/hqdefault.jpg",
+                                                    "width": 168, "height": 94}] * 4})
+            self._listed += PAGE_SIZE
+            self.hasMoreVideos = self._listed < videos
+    return Playlist
+
+async def measure(streamed: bool) -> dict:
+    """List the uploads, returning the seconds to the first video, the total seconds and the peak memory."""
+    reader = YTChannelReader(Channel.model_construct(id="channel", title="channel"))
+    tracemalloc.start()
+    start = time.perf_counter()
+    first, count = None, 0
+    if streamed:
+        async for _ in reader.aiter_videos(min_duration=60):
+            first = first or time.perf_counter() - start
+            count += 1
+    else:
+        # Listing every upload before building and filtering the videos, as before
+        video_infos = await asyncio.to_thread(yt_utils.get_channel_videos, "channel")
+        videos = [reader._to_video(video) for video in yt_utils.filter_videos(video_infos, min_duration=60)[0]]
+        first = time.perf_counter() - start
+        count = len(videos)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"videos": count, "first": first, "seconds": elapsed, "peak": peak}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=20000, help="Uploads of the simulated channel")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per page of 100 videos")
+    args = parser.parse_args()
+    yt_utils.yps.Playlist = simulated_playlist(args.videos, args.latency)
+    yt_utils.yps.playlist_from_channel_id = lambda channel_id: channel_id
+
+    print(f"{'listing':>9} {'videos':>7} {'first video (s)':>16} {'total (s)':>10} {'peak memory (MB)':>17}")
+    for name, streamed in [("up front", False), ("streamed", True)]:
+        reader_module.youtube = AsyncYouTube()
+        result = asyncio.run(measure(streamed))
+        reader_module.youtube.shutdown()
+        print(f"{name:>9} {result['videos']:>7} {result['first']:>16.2f} {result['seconds']:>10.2f} "
+              f"{result['peak'] / 2**20:>17.1f}")
+
+if __name__ == '__main__':
+    main()
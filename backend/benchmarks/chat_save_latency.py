@@ -0,0 +1,60 @@
+"""
+Compare per-turn save latency of the legacy embedded chat history against the
+append-only chat_messages collection as the conversation grows.
+
+Needs a MongoDB reachable at MONGO_URI; data is written to BENCHMARK_DB_NAME.
+
+Usage:
+    python -m benchmarks.chat_save_latency --turns 2000 --report-every 250
+"""
+import os
+import time
+import asyncio
+import argparse
+from motor.motor_asyncio import AsyncIOMotorClient
+from beanie import init_beanie
+from llama_index.core.llms.types import MessageRole
+
+from app.db.models import Chat, ChatMessage, ChatResponse
+from app.chat.engine import save_chat_messages
+
+def make_turn(turn: int) -> list:
+    """Return a user and assistant pair with a realistic answer length."""
+    return [ChatResponse(role=MessageRole.USER, content=f"question {turn} " * 10),
+            ChatResponse(role=MessageRole.ASSISTANT, content=f"answer {turn} " * 150)]
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=2000, help="Turns per conversation")
+    parser.add_argument("--report-every", type=int, default=250, help="Turns between reported samples")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URI'])
+    database = client[os.environ.get('BENCHMARK_DB_NAME', 'yt_chat_benchmark')]
+    await init_beanie(database=database, document_models=[Chat, ChatMessage])
+
+    embedded_chat = await Chat(vector_index_name="benchmark", vector_namespace="benchmark").insert()
+    appended_chat = await Chat(vector_index_name="benchmark", vector_namespace="benchmark").insert()
+    try:
+        print(f"{'turns':>8} {'embedded save (ms)':>20} {'insert_many (ms)':>18}")
+        for turn in range(1, args.turns + 1):
+            # Legacy path: append to the embedded list and rewrite the whole document
+            start = time.perf_counter()
+            embedded_chat.chat_history.extend(make_turn(turn))
+            await embedded_chat.save()
+            embedded_ms = (time.perf_counter() - start) * 1000
+
+            # New path: append the pair to the chat_messages collection
+            start = time.perf_counter()
+            await save_chat_messages(appended_chat, make_turn(turn))
+            appended_ms = (time.perf_counter() - start) * 1000
+
+            if turn % args.report_every == 0:
+                print(f"{turn:>8} {embedded_ms:>20.2f} {appended_ms:>18.2f}")
+    finally:
+        await embedded_chat.delete()
+        await appended_chat.delete()
+        await ChatMessage.find(ChatMessage.chat_id == appended_chat.id).delete()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+"""
+Seed MongoDB with realistic data volumes and report the p50/p99 latency of the
+database access of each router endpoint. In-process caches are bypassed.
+
+Needs a MongoDB reachable at MONGO_URI; data is written to BENCHMARK_DB_NAME,
+which is dropped afterwards. With --audit, the query auditor reports the
+queries that scan a whole collection.
+
+Usage:
+    python -m benchmarks.db_access --channels 5000 --users 20000 --chats 5000 --requests 300 --audit
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorClient
+from beanie import init_beanie
+from beanie.operators import In
+from beanie.odm.enums import SortDirection
+from llama_index.core.llms.types import MessageRole
+
+from app.db.models import (ActiveChatSessionMap, Channel, ChannelOnBoardingRequest,
+                           ChannelOnBoardingRequestStatusEnum, ChannelStatusEnum, ChannelView, Chat,
+                           ChatMessage, User, VideoIngestion, VideoIngestionStatusEnum)
+from app.db.query_audit import QueryAuditor
+from app.chat.engine import get_active_chat_id, get_chat_history
+from app.db.migrations import compact_active_chat_sessions
+
+BATCH_SIZE = 5000
+
+async def insert_batched(model, documents: list) -> None:
+    for start in range(0, len(documents), BATCH_SIZE):
+        await model.insert_many(documents[start:start + BATCH_SIZE])
+
+async def seed(args, rng: random.Random) -> dict:
+    """Insert the channels, users, chats, sessions, messages, requests and ledger entries."""
+    now = datetime.now()
+    channel_ids = [f"UC{i:022d}" for i in range(args.channels)]
+    await insert_batched(Channel, [Channel(id=channel_id,
+                                           title=f"Channel {i}",
+                                           url=f"https://www.youtube.com/channel/{channel_id}",
+                                           status=ChannelStatusEnum.ACTIVE if rng.random() < 0.2
+                                           else ChannelStatusEnum.INACTIVE,
+                                           updated_at=now - timedelta(minutes=rng.randint(0, 10**5)))
+                                   for i, channel_id in enumerate(channel_ids)])
+
+    user_ids = [f"session{i}" for i in range(args.users)]
+    await insert_batched(User, [User(id=user_id, channels=set(rng.sample(channel_ids, 5))) for user_id in user_ids])
+
+    chats = [Chat(vector_index_name="benchmark", vector_namespace=rng.choice(channel_ids)) for _ in range(args.chats)]
+    await insert_batched(Chat, chats)
+    chats = await Chat.find_all().to_list()
+    sessions = [ActiveChatSessionMap(user_session_id=rng.choice(user_ids),
+                                     channel_id=chat.vector_namespace,
+                                     active_chat_id=str(chat.id),
+                                     updated_at=now - timedelta(minutes=rng.randint(0, 10**5)))
+                for chat in chats]
+    await insert_batched(ActiveChatSessionMap, sessions)
+    await insert_batched(ChatMessage, [ChatMessage(chat_id=chat.id,
+                                                   role=MessageRole.USER if turn % 2 == 0 else MessageRole.ASSISTANT,
+                                                   content=f"message {turn} " * 50,
+                                                   created_at=now + timedelta(seconds=turn))
+                                       for chat in chats for turn in range(args.messages)])
+
+    statuses = list(ChannelOnBoardingRequestStatusEnum)
+    await insert_batched(ChannelOnBoardingRequest, [ChannelOnBoardingRequest(channel_id=rng.choice(channel_ids),
+                                                                             requested_by=rng.choice(user_ids),
+                                                                             status=rng.choice(statuses))
+                                                    for _ in range(args.channels * 4)])
+    await insert_batched(VideoIngestion, [VideoIngestion(id=f"{channel_id}:{v}",
+                                                         channel_id=channel_id,
+                                                         status=VideoIngestionStatusEnum.COMMITTED)
+                                          for channel_id in channel_ids[:args.channels // 5]
+                                          for v in range(args.videos)])
+    return {"channel_ids": channel_ids, "user_ids": user_ids, "sessions": sessions, "chats": chats}
+
+def endpoints(data: dict, rng: random.Random) -> dict:
+    """Return the database access of each endpoint, as a coroutine factory picking random keys."""
+    async def user_channels():
+        user = await User.get(rng.choice(data["user_ids"]))
+        await Channel.find(In(Channel.id, list(user.channels))).project(ChannelView).to_list()
+
+    async def channel_details():
+        await Channel.find(In(Channel.id, [rng.choice(data["channel_ids"])])).project(ChannelView).to_list()
+
+    async def default_channels():
+        await Channel.find(Channel.status == ChannelStatusEnum.ACTIVE,
+                           limit=5, sort=[("updated_at", SortDirection.ASCENDING)]).to_list()
+
+    async def get_chat_id():
+        session = rng.choice(data["sessions"])
+        await get_active_chat_id(session.user_session_id, session.channel_id)
+
+    async def chat_history():
+        await get_chat_history(str(rng.choice(data["chats"]).id), limit=100)
+
+    async def process_request():
+        await ChannelOnBoardingRequest.find_one(
+            ChannelOnBoardingRequest.channel_id == rng.choice(data["channel_ids"]),
+            ChannelOnBoardingRequest.status == ChannelOnBoardingRequestStatusEnum.COMPLETED)
+
+    async def channel_ledger():
+        await VideoIngestion.find(VideoIngestion.channel_id == rng.choice(data["channel_ids"]),
+                                  VideoIngestion.status == VideoIngestionStatusEnum.COMMITTED).count()
+
+    return {"user_channels": user_channels,
+            "channel_details": channel_details,
+            "default_channels": default_channels,
+            "get_chat_id": get_chat_id,
+            "chat_history": chat_history,
+            "process_request": process_request,
+            "channel_ledger": channel_ledger}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--channels", type=int, default=5000, help="Channels, 20%% of them active")
+    parser.add_argument("--users", type=int, default=20000, help="Users with 5 channels each")
+    parser.add_argument("--chats", type=int, default=5000, help="Chats, each with a session map")
+    parser.add_argument("--messages", type=int, default=40, help="Messages per chat")
+    parser.add_argument("--videos", type=int, default=200, help="Ledger entries per onboarded channel")
+    parser.add_argument("--requests", type=int, default=300, help="Timed calls per endpoint")
+    parser.add_argument("--audit", action="store_true", help="Report the queries scanning a whole collection")
+    args = parser.parse_args()
+
+    auditor = QueryAuditor(os.environ['MONGO_URI'], slow_ms=float("inf")) if args.audit else None
+    client = AsyncIOMotorClient(os.environ['MONGO_URI'], event_listeners=[auditor] if auditor else [])
+    database_name = os.environ.get('BENCHMARK_DB_NAME', 'yt_chat_benchmark')
+    await init_beanie(database=client[database_name],
+                      document_models=[ActiveChatSessionMap, Channel, ChannelOnBoardingRequest, Chat,
+                                       ChatMessage, User, VideoIngestion])
+    rng = random.Random(0)
+    try:
+        start = time.perf_counter()
+        data = await seed(args, rng)
+        await compact_active_chat_sessions()
+        print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'endpoint':>18} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+        for name, access in endpoints(data, rng).items():
+            latencies = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                await access()
+                latencies.append((time.perf_counter() - start) * 1000)
+            p50, p99 = np.percentile(latencies, [50, 99])
+            print(f"{name:>18} {p50:>9.2f} {p99:>9.2f}")
+    finally:
+        if auditor:
+            # Wait for the pending explains before dropping the data
+            auditor.close()
+            for finding in auditor.findings:
+                if finding["collection_scan"]:
+                    print(f"COLLSCAN {finding['command']} on {finding['collection']}: {finding['query']}")
+            print(f"{auditor.stats()['collection_scans']} collection scans "
+                  f"in {auditor.stats()['explained_shapes']} query shapes")
+        await client.drop_database(database_name)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+Measure the event loop lag caused by slow YouTube calls, made directly on the
+loop as onboarding did before, or through the async facade.
+
+YouTube is simulated by channel lookups sleeping --latency seconds.
+
+Usage:
+    python -m benchmarks.event_loop_lag --calls 20 --latency 0.2
+"""
+import time
+import asyncio
+import argparse
+
+from app.onboarding import yt_utils
+from app.onboarding.yt_async import AsyncYouTube
+from app.utils.loop_monitor import LoopLagMonitor
+
+async def measure(calls: int, blocking: bool) -> dict:
+    """Make the channel lookups concurrently while measuring the loop lag."""
+    youtube = AsyncYouTube(max_workers=calls)
+    monitor = LoopLagMonitor(interval=0.01, threshold=float("inf"))
+    monitor_loop = asyncio.create_task(monitor.run())
+
+    async def lookup(channel_id: str) -> dict:
+        if blocking:
+            return yt_utils.get_channel_info(channel_id)
+        return await youtube.get_channel_info(channel_id)
+
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await asyncio.gather(*[lookup(f"channel{i}") for i in range(calls)])
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.05)
+    monitor_loop.cancel()
+    youtube.shutdown()
+    return {**monitor.stats(), "seconds": elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=20, help="Concurrent channel lookups")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds each lookup takes")
+    args = parser.parse_args()
+
+    def get_channel_info(channel_id: str) -> dict:
+        time.sleep(args.latency)
+        return {"id": channel_id}
+    yt_utils.get_channel_info = get_channel_info
+
+    print(f"{'path':>10} {'seconds':>8} {'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for name, blocking in (("blocking", True), ("facade", False)):
+        stats = asyncio.run(measure(args.calls, blocking))
+        print(f"{name:>10} {stats['seconds']:>8.2f} {stats['lag_p50_ms']:>11.1f} "
+              f"{stats['lag_p99_ms']:>11.1f} {stats['lag_max_ms']:>11.1f}")
+
+if __name__ == '__main__':
+    main()
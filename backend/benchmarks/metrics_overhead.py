@@ -0,0 +1,49 @@
+"""
+Measure the cost of the stage timings and counters on the hot paths, with
+metrics enabled and disabled, and the time to render a scrape.
+
+Usage:
+    python -m benchmarks.metrics_overhead --iterations 1000000
+"""
+import time
+import argparse
+
+from app.utils.metrics import MetricsRegistry
+
+def per_call_ns(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+def measure(enabled: bool, iterations: int) -> dict:
+    registry = MetricsRegistry(enabled=enabled)
+    stages = registry.histogram("stage_seconds", "Stage durations", ["stage"])
+    retries = registry.counter("retries", "Retries", ["operation"])
+
+    def timed():
+        with stages.labels("retrieve").time():
+            pass
+
+    result = {"baseline": per_call_ns(lambda: None, iterations),
+              "observe": per_call_ns(lambda: stages.labels("embed").observe(0.2), iterations),
+              "time": per_call_ns(timed, iterations),
+              "inc": per_call_ns(lambda: retries.labels("fetch_transcript").inc(), iterations)}
+    start = time.perf_counter()
+    registry.render()
+    result["render_ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1000000, help="Calls per measured operation")
+    args = parser.parse_args()
+
+    print(f"{'metrics':>8} {'baseline (ns)':>14} {'observe (ns)':>13} {'time() (ns)':>12} {'inc (ns)':>9} {'render (ms)':>12}")
+    for name, enabled in [("enabled", True), ("disabled", False)]:
+        result = measure(enabled, args.iterations)
+        print(f"{name:>8} {result['baseline']:>14.0f} {result['observe']:>13.0f} {result['time']:>12.0f} "
+              f"{result['inc']:>9.0f} {result['render_ms']:>12.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Compare bytes sent and CPU time per answer of the snapshot and delta stream modes.
+
+Usage:
+    python -m benchmarks.stream_encoding --tokens 800 --answers 20
+"""
+import time
+import argparse
+from sse_starlette.sse import ServerSentEvent
+from llama_index.core.llms.types import MessageRole
+
+from app.db.models import ChatResponse, ChatResponseStatusEnum
+from app.chat.stream import StreamModeEnum, get_stream_encoder
+
+def synthetic_deltas(tokens: int) -> list:
+    """Return a list of token-sized deltas resembling an LLM answer."""
+    words = "the channel recommends a slow and steady approach to training".split()
+    return [f" {words[i % len(words)]}" for i in range(tokens)]
+
+def encode_answer(stream_mode: StreamModeEnum, deltas: list) -> int:
+    """Encode one answer the way message_stream does and return the bytes sent."""
+    encoder = get_stream_encoder(stream_mode)
+    chat_response = ChatResponse(role=MessageRole.ASSISTANT, content="", status=ChatResponseStatusEnum.IN_PROGRESS)
+    events = []
+    start_event = encoder.start(chat_response)
+    if start_event:
+        events.append(start_event)
+    received = []
+    for delta in deltas:
+        received.append(delta)
+        if stream_mode == StreamModeEnum.SNAPSHOT:
+            chat_response.content = "".join(received)
+        events.append(encoder.delta(chat_response, delta))
+    chat_response.content = "".join(received)
+    chat_response.status = ChatResponseStatusEnum.COMPLETED
+    events.append(encoder.completed(chat_response))
+    return sum(len(ServerSentEvent(**e).encode() if isinstance(e, dict) else ServerSentEvent(data=e).encode())
+               for e in events)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=800, help="Deltas per answer")
+    parser.add_argument("--answers", type=int, default=20, help="Answers per mode")
+    args = parser.parse_args()
+
+    deltas = synthetic_deltas(args.tokens)
+    for stream_mode in StreamModeEnum:
+        start = time.process_time()
+        sent = [encode_answer(stream_mode, deltas) for _ in range(args.answers)]
+        cpu_ms = (time.process_time() - start) * 1000 / args.answers
+        print(f"{stream_mode.value:>8}: {sum(sent) / len(sent) / 1024:10.1f} KiB/answer"
+              f" {cpu_ms:10.2f} ms CPU/answer")
+
+if __name__ == '__main__':
+    main()
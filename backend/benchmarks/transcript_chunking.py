@@ -0,0 +1,71 @@
+"""
+Compare the chunking throughput of the TranscriptChunker with the previous path, which
+joined the transcript into a Document and re-split it with llama_index's SentenceSplitter.
+
+Usage:
+    python -m benchmarks.transcript_chunking --videos 200 --segments 1500
+"""
+import time
+import random
+import argparse
+from llama_index.node_parser import SentenceSplitter
+from llama_index.schema import Document
+
+from app.db.models import Channel, Video, TranscriptSegment
+from app.db.transcript import CompactTranscript
+from app.onboarding.chunker import TranscriptChunker, transcript_text
+
+WORDS = ("so today we are going to talk about how the training plan works and why "
+         "you should start slow before adding more volume to every session").split()
+
+def synthetic_channel(videos: int, segments: int, seed: int = 0) -> list:
+    """Return videos with transcripts resembling auto-generated captions."""
+    rng = random.Random(seed)
+    # Channel is a beanie Document; build it without a database
+    channel = Channel.model_construct(id="UCbenchmark", title="Benchmark channel")
+    result = []
+    for v in range(videos):
+        transcript, start_ms = [], 0
+        for _ in range(segments):
+            duration_ms = rng.randint(1500, 4500)
+            transcript.append(TranscriptSegment(text=" ".join(rng.choices(WORDS, k=rng.randint(4, 12))),
+                                                start_ms=start_ms,
+                                                end_ms=start_ms + duration_ms))
+            start_ms += duration_ms
+        result.append(Video(id=f"video{v}", title=f"Video {v}", channel=channel,
+                            transcript=CompactTranscript.from_segments(transcript)))
+    return result
+
+def sentence_splitter_path(videos: list) -> int:
+    """Chunk the videos the way onboarding did before, returning the number of nodes."""
+    splitter = SentenceSplitter(chunk_size=1000)
+    nodes = 0
+    for video in videos:
+        document = Document(id_=video.id, text=transcript_text(video), extra_info={"video_id": video.id,
+                                                                                  "video_title": video.title})
+        nodes += len(splitter.get_nodes_from_documents([document]))
+    return nodes
+
+def transcript_chunker_path(videos: list) -> int:
+    """Chunk the videos along their segments, returning the number of nodes."""
+    chunker = TranscriptChunker(chunk_size=1000)
+    return sum(len(chunker.chunk(video)) for video in videos)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=200, help="Videos in the synthetic channel")
+    parser.add_argument("--segments", type=int, default=1500, help="Transcript segments per video")
+    args = parser.parse_args()
+
+    videos = synthetic_channel(args.videos, args.segments)
+    total_segments = args.videos * args.segments
+    print(f"{'path':>18} {'nodes':>8} {'seconds':>8} {'segments/sec':>13}")
+    for name, path in (("sentence_splitter", sentence_splitter_path),
+                       ("transcript_chunker", transcript_chunker_path)):
+        start = time.perf_counter()
+        nodes = path(videos)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>18} {nodes:>8} {elapsed:>8.2f} {total_segments / elapsed:>13.0f}")
+
+if __name__ == '__main__':
+    main()
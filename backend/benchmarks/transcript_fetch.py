@@ -0,0 +1,90 @@
+"""
+Measure transcript fetch throughput (videos/sec) at different concurrency levels
+against a local fake YouTube transcript server.
+
+The server answers each request after a configurable latency and rate limits
+a fraction of them with HTTP 429, which the fake client turns into the
+TooManyRequests error raised by youtube_transcript_api.
+
+Usage:
+    python -m benchmarks.transcript_fetch --videos 200 --latency-ms 150 --throttle 0.02
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from youtube_transcript_api._errors import TooManyRequests
+
+from app.db.models import Video
+from app.onboarding.fetcher import TranscriptFetcher
+
+class FakeTranscriptHandler(BaseHTTPRequestHandler):
+    latency = 0.15
+    throttle = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if random.random() < self.throttle:
+            self.send_response(429)
+            self.end_headers()
+            return
+        segments = [{"text": f"caption line {i}", "start": i * 2.0, "duration": 2.0} for i in range(300)]
+        body = json.dumps(segments).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTranscriptHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_download(base_url: str):
+    session = requests.Session()
+    def download(video_id: str, languages: list) -> list:
+        response = session.get(f"{base_url}/transcript/{video_id}")
+        if response.status_code == 429:
+            raise TooManyRequests(video_id)
+        response.raise_for_status()
+        return response.json()
+    return download
+
+async def run(base_url: str, videos: int, concurrency: int, rate: float) -> tuple:
+    fetcher = TranscriptFetcher(concurrency=concurrency, rate=rate, host="127.0.0.1",
+                                download=make_download(base_url))
+    video_list = [Video(id=f"video{i}", title=f"Video {i}", duration=600) for i in range(videos)]
+    start = time.perf_counter()
+    fetched = [video async for video in fetcher.fetch(video_list, ["en"])]
+    return len(fetched), time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--throttle", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--rate", type=float, default=100, help="Initial requests/sec of the token bucket")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    FakeTranscriptHandler.latency = args.latency_ms / 1000
+    FakeTranscriptHandler.throttle = args.throttle
+    server = start_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"{'concurrency':>12} {'fetched':>8} {'seconds':>8} {'videos/sec':>11}")
+    for concurrency in args.concurrency:
+        fetched, elapsed = asyncio.run(run(base_url, args.videos, concurrency, args.rate))
+        print(f"{concurrency:>12} {fetched:>8} {elapsed:>8.2f} {fetched / elapsed:>11.1f}")
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare the build time and memory of transcripts stored as lists of TranscriptSegment
+models with the CompactTranscript columns, and the size of their serialised forms.
+
+Usage:
+    python -m benchmarks.transcript_memory --videos 100 --segments 1500
+"""
+import json
+import time
+import random
+import argparse
+import tracemalloc
+
+from app.db.models import TranscriptSegment
+from app.db.transcript import CompactTranscript
+from benchmarks.transcript_chunking import WORDS
+
+def raw_transcripts(videos: int, segments: int, seed: int = 0) -> list:
+    """Return transcripts as returned by youtube_transcript_api, resembling auto-generated captions."""
+    rng = random.Random(seed)
+    result = []
+    for _ in range(videos):
+        transcript, start = [], 0.0
+        for _ in range(segments):
+            duration = rng.uniform(1.5, 4.5)
+            transcript.append({"text": " ".join(rng.choices(WORDS, k=rng.randint(4, 12))),
+                               "start": round(start, 3),
+                               "duration": round(duration, 3)})
+            start += duration
+        result.append(transcript)
+    return result
+
+def models_path(transcripts: list) -> list:
+    return [[TranscriptSegment(text=segment['text'],
+                               start_ms=int(segment['start']*1000),
+                               end_ms=int((segment['start'] + segment['duration'])*1000))
+             for segment in transcript]
+            for transcript in transcripts]
+
+def compact_path(transcripts: list) -> list:
+    return [CompactTranscript.from_raw(transcript) for transcript in transcripts]
+
+def measure(path, transcripts: list):
+    """Build the transcripts, returning them with the seconds and the bytes allocated."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    built = path(transcripts)
+    elapsed = time.perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, elapsed, allocated
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=100, help="Videos in the synthetic channel")
+    parser.add_argument("--segments", type=int, default=1500, help="Transcript segments per video")
+    args = parser.parse_args()
+
+    transcripts = raw_transcripts(args.videos, args.segments)
+    total_segments = args.videos * args.segments
+    print(f"{'form':>8} {'seconds':>8} {'segments/sec':>13} {'memory (MB)':>12} {'serialised (MB)':>16}")
+
+    models, elapsed, allocated = measure(models_path, transcripts)
+    serialised = sum(len(json.dumps([segment.model_dump() for segment in transcript])) for transcript in models)
+    print(f"{'models':>8} {elapsed:>8.2f} {total_segments / elapsed:>13.0f} "
+          f"{allocated / 2**20:>12.1f} {serialised / 2**20:>16.1f}")
+    del models
+
+    compact, elapsed, allocated = measure(compact_path, transcripts)
+    serialised = sum(len(transcript.to_bytes()) for transcript in compact)
+    print(f"{'compact':>8} {elapsed:>8.2f} {total_segments / elapsed:>13.0f} "
+          f"{allocated / 2**20:>12.1f} {serialised / 2**20:>16.1f}")
+
+if __name__ == '__main__':
+    main()
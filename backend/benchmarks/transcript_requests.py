@@ -0,0 +1,158 @@
+"""
+Count the YouTube requests per video of a transcript fetch run, with the
+single-pass track resolver and transcript list cache, or with the previous
+track selection, which listed the tracks again on every attempt.
+
+YouTube is simulated: listing the tracks of a video and fetching a track are
+one request each, a --throttle fraction of the requests is rate limited, and
+a --broken fraction of the manual tracks fails to download. A --translated
+fraction of the videos only has German tracks, some of them not translatable.
+
+Usage:
+    python -m benchmarks.transcript_requests --videos 500 --throttle 0.2 --broken 0.05
+"""
+import os
+import random
+import logging
+import asyncio
+import argparse
+from collections import Counter
+from requests import HTTPError
+from youtube_transcript_api import YouTubeTranscriptApi, TranscriptList
+from youtube_transcript_api._errors import TooManyRequests
+
+from app.db.models import Channel, Video
+from app.onboarding import fetcher as fetcher_module
+from app.onboarding.fetcher import TokenBucket, TranscriptFetcher
+from app.onboarding.yt_async import AsyncYouTube
+
+TRANSCRIPT_XML = '<transcript><text start="0.0" dur="2.0">hello world</text></transcript>'
+
+class Response:
+    def __init__(self, status_code: int, text: str = "") -> None:
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            reason = "Too Many Requests" if self.status_code == 429 else "Not Found"
+            raise HTTPError(f"{self.status_code} Client Error: {reason} for url")
+
+class SimulatedYouTube:
+    """An http client and a `list_transcripts` answering like YouTube, counting the requests."""
+
+    def __init__(self, videos: int, throttle: float, broken: float, translated: float, seed: int = 0) -> None:
+        self.rng = random.Random(seed)
+        self.throttle = throttle
+        self.requests = Counter()
+        self.captions = {}
+        for i in range(videos):
+            translatable = self.rng.random() < 0.5
+            if self.rng.random() < translated:
+                tracks = [self._track(f"v{i}", "de", generated=False, translatable=False),
+                          self._track(f"v{i}", "de", generated=True, translatable=translatable)]
+            else:
+                tracks = [self._track(f"v{i}", "en", generated=True, translatable=True)]
+                if self.rng.random() < 0.5:
+                    tracks.append(self._track(f"v{i}", "en", generated=False, translatable=True,
+                                              broken=self.rng.random() < broken))
+            self.captions[f"v{i}"] = {"captionTracks": tracks,
+                                      "translationLanguages": [{"languageName": {"simpleText": "English"},
+                                                                "languageCode": "en"}]}
+
+    def _track(self, video_id: str, language: str, generated: bool, translatable: bool, broken: bool = False) -> dict:
+        url = f"https://www.youtube.com/api/timedtext?v={video_id}&lang={language}&kind={generated}&broken={broken}"
+        return {"baseUrl": url, "name": {"simpleText": language}, "languageCode": language,
+                "kind": "asr" if generated else "", "isTranslatable": translatable}
+
+    def _throttled(self) -> bool:
+        return self.rng.random() < self.throttle
+
+    def get(self, url: str, headers: dict = None) -> Response:
+        self.requests["fetch_transcript"] += 1
+        if self._throttled():
+            return Response(429)
+        if "broken=True" in url:
+            return Response(404)
+        return Response(200, TRANSCRIPT_XML)
+
+    def list_transcripts(self, video_id: str, proxies=None, cookies=None) -> TranscriptList:
+        self.requests["list_transcripts"] += 1
+        if self._throttled():
+            raise TooManyRequests(video_id)
+        return TranscriptList.build(self, video_id, self.captions[video_id])
+
+def legacy_select_transcript(transcript_list: TranscriptList, languages: list):
+    """The track selection before the single-pass resolver."""
+    manual_langs = set(transcript_list._manually_created_transcripts.keys())
+    for lang in languages:
+        if lang in manual_langs:
+            return transcript_list.find_manually_created_transcript(language_codes=[lang]), "manual"
+    generated_langs = set(transcript_list._generated_transcripts.keys())
+    for lang in languages:
+        if lang in generated_langs:
+            return transcript_list.find_generated_transcript(language_codes=[lang]), "generated"
+    translated_langs = set([t['language_code'] for t in transcript_list._translation_languages])
+    for lang in languages:
+        if lang in translated_langs:
+            return transcript_list.find_transcript(language_codes=manual_langs.union(generated_langs)).translate(lang), "translated"
+    raise ValueError(f"No transcripts found for video: {transcript_list.video_id}")
+
+class LegacyYouTube(AsyncYouTube):
+    """Lists the tracks on every attempt and downloads the selected track only."""
+
+    async def download_transcript_with_source(self, video_id, languages=['en', 'en-IN'], executor=None):
+        try:
+            transcript_list = await self._retry(YouTubeTranscriptApi.list_transcripts, video_id, executor=executor)
+            transcript, kind = legacy_select_transcript(transcript_list, languages)
+            return await self._retry(transcript.fetch, executor=executor), transcript.language_code, kind
+        except ValueError as e:
+            raise e
+        except Exception as e:
+            raise ValueError(f"Failed to download transcript for video: {video_id}") from e
+
+async def run(youtube: AsyncYouTube, simulated: SimulatedYouTube) -> dict:
+    fetcher_module.youtube = youtube
+    YouTubeTranscriptApi.list_transcripts = simulated.list_transcripts
+    channel = Channel.model_construct(id="channel", title="channel")
+    videos = [Video(id=video_id, title=video_id, channel=channel) for video_id in simulated.captions]
+    fetcher = TranscriptFetcher(concurrency=16, max_attempts=4)
+    # Retry throttled videos without pacing, only the requests are measured
+    fetcher._buckets[fetcher.host] = TokenBucket(rate=10**6, burst=16, min_rate=10**6)
+    failures = Counter()
+
+    async def on_failure(video_id: str, e: Exception) -> None:
+        failures[type(e.__cause__ or e).__name__] += 1
+
+    fetched = [video async for video in fetcher.fetch(videos, ["en", "en-IN"], on_failure=on_failure)]
+    youtube.shutdown()
+    return {"fetched": len(fetched),
+            "failed": sum(failures.values()),
+            "requests": sum(simulated.requests.values()),
+            "requests/video": sum(simulated.requests.values()) / len(videos),
+            "requests/fetched": sum(simulated.requests.values()) / max(len(fetched), 1),
+            "list requests": simulated.requests["list_transcripts"],
+            "fetch requests": simulated.requests["fetch_transcript"]}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--videos", type=int, default=500, help="Videos in the simulated channel")
+    parser.add_argument("--throttle", type=float, default=0.2, help="Fraction of rate limited requests")
+    parser.add_argument("--broken", type=float, default=0.05, help="Fraction of manual tracks failing to download")
+    parser.add_argument("--translated", type=float, default=0.1, help="Fraction of videos with German tracks only")
+    args = parser.parse_args()
+    # Measure the requests to YouTube only
+    os.environ['TRANSCRIPT_ARCHIVE_ENABLED'] = 'false'
+    logging.disable(logging.CRITICAL)
+
+    print(f"{'selection':>9} {'fetched':>8} {'failed':>7} {'requests':>9} {'req/video':>10} "
+          f"{'req/fetched':>12} {'lists':>6} {'fetches':>8}")
+    for name, facade in [("legacy", LegacyYouTube), ("resolver", AsyncYouTube)]:
+        simulated = SimulatedYouTube(args.videos, args.throttle, args.broken, args.translated)
+        result = asyncio.run(run(facade(max_attempts=2, min_wait=0, max_wait=0), simulated))
+        print(f"{name:>9} {result['fetched']:>8} {result['failed']:>7} {result['requests']:>9} "
+              f"{result['requests/video']:>10.2f} {result['requests/fetched']:>12.2f} "
+              f"{result['list requests']:>6} {result['fetch requests']:>8}")
+
+if __name__ == '__main__':
+    main()
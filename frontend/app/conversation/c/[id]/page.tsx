@@ -109,22 +109,37 @@ const Page = ({ params }: { params: { id: string } }) => {
       status: ConversationResponseStatusEnum.IN_PROGRESS,
     });
     const events = new EventSource(url);
-    events.onmessage = (event: MessageEvent) => {
-      const parsedData: Message = JSON.parse(event.data);
+    const parseMessage = (data: string): Message => {
+      const parsedData: Message = JSON.parse(data);
       parsedData.status =
         ConversationResponseStatusEnum[
           parsedData.status as unknown as keyof typeof ConversationResponseStatusEnum
         ];
-      systemSendMessage(parsedData);
-
-      if (
-        parsedData.status === ConversationResponseStatusEnum.COMPLETED ||
-        parsedData.status === ConversationResponseStatusEnum.FAILED
-      ) {
-        events.close();
-        setIsMessagePending(false);
-      }
+      return parsedData;
     };
+    // The start event carries the response metadata, deltas only the new text
+    let streamedMessage: Message | null = null;
+    events.addEventListener("start", (event: MessageEvent) => {
+      streamedMessage = { ...parseMessage(event.data), content: "" };
+      systemSendMessage(streamedMessage);
+    });
+    events.addEventListener("delta", (event: MessageEvent) => {
+      if (!streamedMessage) {
+        return;
+      }
+      const { delta } = JSON.parse(event.data);
+      streamedMessage = {
+        ...streamedMessage,
+        content: streamedMessage.content + delta,
+      };
+      systemSendMessage(streamedMessage);
+    });
+    events.addEventListener("completed", (event: MessageEvent) => {
+      const parsedData = parseMessage(event.data);
+      systemSendMessage(parsedData);
+      events.close();
+      setIsMessagePending(false);
+    });
   };
 
   useEffect(() => {